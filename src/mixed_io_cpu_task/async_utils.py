@@ -1,26 +1,203 @@
 import asyncio
+import logging
+import time
+from typing import Dict, Optional, Union
 
+logger = logging.getLogger("default")
 
-async def limit_concurrency(aws, limit):
+
+class AdaptiveLimit:
+    """AIMD concurrency limit driven by observed latency and errors.
+
+    A completion is slow when a short EWMA of latency (about short_window completions)
+    exceeds tolerance times the baseline: the lowest long EWMA (about window
+    completions) seen at the current limit or a lower one. Jitter independent of load
+    averages out of both, while queueing above capacity shows as latency rising over
+    that of lower limits. When reset_after slow cuts in a row leave latency where it
+    was, it does not depend on the limit and the baseline starts over from it.
+
+    Every completion that is not slow adds 1/limit, so the limit grows by one per
+    window of successful completions. Errors halve the limit and slow completions cut
+    it by a tenth, at most once per window (and per short_window for slow ones, so the
+    short EWMA shows the last cut), so a burst of timeouts from one overload counts as
+    a single signal.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 100,
+        tolerance: float = 1.5,
+        window: int = 100,
+        short_window: int = 20,
+        reset_after: int = 5,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._long_alpha = 1 / window
+        self._short_alpha = 1 / short_window
+        self._short_window = short_window
+        self._long_latency: Optional[float] = None
+        self._short_latency: Optional[float] = None
+        self.reset_after = reset_after
+        # lowest long EWMA latency seen at every limit since the last reset
+        self._baselines: Dict[int, float] = {}
+        self._slow_decreases = 0
+        # short EWMA latency at the first of consecutive slow decreases
+        self._slow_latency = 0.0
+        self._since_decrease = 0
+        self.history = [(time.perf_counter(), self.limit)]
+
+    @property
+    def limit(self) -> int:
+        """Returns the current limit rounded down"""
+        return int(self._limit)
+
+    def record(self, latency: float, error: bool = False):
+        """Updates the limit with latency of a completed awaitable"""
+        if self._long_latency is None:
+            self._long_latency = self._short_latency = latency
+        self._long_latency += self._long_alpha * (latency - self._long_latency)
+        self._short_latency += self._short_alpha * (latency - self._short_latency)
+        self._baselines[self.limit] = min(
+            self._baselines.get(self.limit, self._long_latency), self._long_latency
+        )
+        baseline = min(
+            value for limit, value in self._baselines.items() if limit <= self.limit
+        )
+        self._since_decrease += 1
+        previous = self.limit
+        slow = self._short_latency > self.tolerance * baseline
+        # the short average needs short_window completions to show the last cut
+        wait = self.limit if error else max(self.limit, self._short_window)
+        if (error or slow) and self._since_decrease >= wait:
+            self._limit *= 0.5 if error else 0.9
+            self._since_decrease = 0
+            if slow and not self._slow_decreases:
+                self._slow_latency = self._short_latency
+            self._slow_decreases += slow
+            if self._slow_decreases >= self.reset_after:
+                # cutting the limit did not lower latency, it is not caused by load
+                if self._short_latency > 0.9 * self._slow_latency:
+                    self._baselines.clear()
+                self._slow_decreases = 0
+        elif not error and not slow:
+            self._limit += 1 / self._limit
+        if not slow:
+            self._slow_decreases = 0
+        self._limit = min(max(self._limit, self.min_limit), self.max_limit)
+        if self.limit != previous:
+            self.history.append((time.perf_counter(), self.limit))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"{self.name} concurrency limit {previous} -> {self.limit}, "
+                    f"latency {latency * 1000:.1f} ms, error {error}"
+                )
+
+    def summary(self) -> dict:
+        """Returns final, min, max and time weighted mean limit"""
+        limits = [limit for _, limit in self.history]
+        now = time.perf_counter()
+        times = [t for t, _ in self.history] + [now]
+        total = now - times[0]
+        mean = (
+            sum(
+                limit * (end - start)
+                for limit, start, end in zip(limits, times, times[1:])
+            )
+            / total
+            if total > 0
+            else limits[-1]
+        )
+        return {
+            "final": limits[-1],
+            "min": min(limits),
+            "max": max(limits),
+            "mean": round(mean, 1),
+            "changes": len(limits) - 1,
+        }
+
+    async def track(self, aw):
+        """Awaits aw and records its latency and whether it raised"""
+        start = time.perf_counter()
+        try:
+            result = await aw
+        except Exception:
+            self.record(time.perf_counter() - start, error=True)
+            raise
+        self.record(time.perf_counter() - start)
+        return result
+
+
+async def limit_concurrency(aws, limit: Union[int, AdaptiveLimit]):
     """Source: https://death.andgravity.com/limit-concurrency
     Great blog post - you should check it out!
+
+    limit is a fixed number or an AdaptiveLimit fed with latency of every awaitable.
     """
     aws = iter(aws)
     aws_ended = False
     pending = set()
+    done = set()
+    adaptive = isinstance(limit, AdaptiveLimit)
+
+    try:
+        while pending or not aws_ended:
+            while len(pending) < (limit.limit if adaptive else limit) and not aws_ended:
+                try:
+                    aw = next(aws)
+                except StopIteration:
+                    aws_ended = True
+                else:
+                    pending.add(
+                        asyncio.ensure_future(limit.track(aw) if adaptive else aw)
+                    )
+
+            if not pending:
+                return
+
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            while done:
+                yield done.pop()
+    finally:
+        # a consumer stopping early, e.g. on an error, leaves tasks behind
+        for task in pending | done:
+            task.cancel()
+            task.add_done_callback(_retrieve_exception)
+
+
+def _retrieve_exception(task: asyncio.Future):
+    # errors of abandoned tasks are not logged as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+async def measure_loop_lag(samples: list, interval: float = 0.05):
+    """Appends how late every wakeup of a sleep of interval seconds happens to samples
+    until cancelled. A loop blocked by CPU work wakes the coroutine late.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
 
-    while pending or not aws_ended:
-        while len(pending) < limit and not aws_ended:
-            try:
-                aw = next(aws)
-            except StopIteration:
-                aws_ended = True
-            else:
-                pending.add(asyncio.ensure_future(aw))
-
-        if not pending:
-            return
-
-        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-        while done:
-            yield done.pop()
+def lag_summary(samples: list) -> dict:
+    """Returns mean, p95 and max of event loop lag samples in milliseconds"""
+    if not samples:
+        return {"samples": 0, "mean_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+    ordered = sorted(samples)
+    return {
+        "samples": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 2),
+        "p95_ms": round(1000 * ordered[int(0.95 * (len(ordered) - 1))], 2),
+        "max_ms": round(1000 * ordered[-1], 2),
+    }
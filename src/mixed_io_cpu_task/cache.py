@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import threading
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+
+class ByteBudgetCache:
+    """Thread-safe LRU cache bounded by the total size of the stored values.
+
+    Concurrent misses for the same key share a single load - threads wait for the
+    thread which started it and asyncio tasks await the task which started it.
+    max_bytes <= 0 disables caching, every call loads the value.
+    on_evict(key, value) is called for every evicted entry outside of the cache lock.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 0,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, concurrent.futures.Future] = {}
+        self._in_flight_async: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Returns False when the cache has no budget and every load runs"""
+        return self.max_bytes > 0
+
+    def resize(self, max_bytes: int):
+        """Changes the budget, evicting entries which no longer fit"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            evicted = self._evict()
+        self._notify_evicted(evicted)
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any], size: Callable):
+        """Returns cached value for key or loads it with load() and caches it"""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return load()
+        with self._lock:
+            if key in self._entries:
+                return self._hit(key)
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            evicted = self._put(key, value, size(value))
+        future.set_result(value)
+        self._notify_evicted(evicted)
+        return value
+
+    async def get_or_load_async(
+        self, key: Hashable, load: Callable[[], Awaitable[Any]], size: Callable
+    ):
+        """Async twin of get_or_load, load() returns an awaitable"""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return await load()
+        with self._lock:
+            if key in self._entries:
+                return self._hit(key)
+            future = self._in_flight_async.get(key)
+            owner = future is None
+            if owner:
+                future = asyncio.get_running_loop().create_future()
+                self._in_flight_async[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return await asyncio.shield(future)
+        try:
+            value = await load()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight_async[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # mark exception as retrieved when nobody else waits for it
+                future.exception()
+            raise
+        with self._lock:
+            del self._in_flight_async[key]
+            evicted = self._put(key, value, size(value))
+        future.set_result(value)
+        self._notify_evicted(evicted)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss/eviction counters and current usage"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def _hit(self, key: Hashable) -> Any:
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def _put(
+        self, key: Hashable, value: Any, nbytes: int
+    ) -> List[Tuple[Hashable, Any]]:
+        if nbytes > self.max_bytes:
+            return [(key, value)]
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self._size += nbytes
+        return self._evict()
+
+    def _evict(self) -> List[Tuple[Hashable, Any]]:
+        evicted = []
+        while self._size > self.max_bytes and self._entries:
+            key, (value, nbytes) = self._entries.popitem(last=False)
+            self._size -= nbytes
+            self.evictions += 1
+            evicted.append((key, value))
+        return evicted
+
+    def _notify_evicted(self, evicted: List[Tuple[Hashable, Any]]):
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+
+def merge_stats(stats: Iterable[Dict[str, int]]) -> Dict[str, int]:
+    """Sums cache stats collected from many processes"""
+    merged: Dict[str, int] = {}
+    for process_stats in stats:
+        for name, value in process_stats.items():
+            merged[name] = merged.get(name, 0) + value
+    return merged
@@ -4,6 +4,14 @@ from mixed_io_cpu_task.commands.serial import serial
 from mixed_io_cpu_task.commands.asynchronous import asynchronous
 from mixed_io_cpu_task.commands.plot_logs import plot_logs
 from mixed_io_cpu_task.commands.concurrency import multi
+from mixed_io_cpu_task.commands.decode_benchmark import decode_benchmark
+from mixed_io_cpu_task.commands.encode_benchmark import encode_benchmark
+from mixed_io_cpu_task.commands.encode_sweep import encode_sweep
+from mixed_io_cpu_task.commands.log_overhead import log_overhead
+from mixed_io_cpu_task.commands.mmap_benchmark import mmap_benchmark
+from mixed_io_cpu_task.commands.pipeline import pipeline
+from mixed_io_cpu_task.commands.bench import bench
+from mixed_io_cpu_task.commands.gcs_emulator import gcs_emulator
 
 
 @click.group()
@@ -15,3 +23,11 @@ cli.add_command(serial)
 cli.add_command(asynchronous)
 cli.add_command(multi)
 cli.add_command(plot_logs)
+cli.add_command(decode_benchmark)
+cli.add_command(encode_benchmark)
+cli.add_command(encode_sweep)
+cli.add_command(log_overhead)
+cli.add_command(mmap_benchmark)
+cli.add_command(pipeline)
+cli.add_command(bench)
+cli.add_command(gcs_emulator)
@@ -1,108 +1,386 @@
 import asyncio
+import functools
 import logging
+import os
 import pathlib
 import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from multiprocessing import Queue
+from typing import Optional
 
 import PIL
 import click
 import numpy as np
-from gcloud.aio.storage import Storage
 from tqdm.asyncio import tqdm
 
-from mixed_io_cpu_task.async_utils import limit_concurrency
-from mixed_io_cpu_task.cropping import crop_with_pil_async
+from mixed_io_cpu_task.async_utils import (
+    AdaptiveLimit,
+    limit_concurrency,
+    measure_loop_lag,
+    lag_summary,
+)
+from mixed_io_cpu_task.cache import merge_stats
+from mixed_io_cpu_task.commands.common_options import (
+    ProcessOptions,
+    configure_from_options,
+    crop_options,
+    io_options,
+    log_filename,
+    logging_options,
+    output_options,
+    task_options,
+)
+from mixed_io_cpu_task.commands.concurrency import worker_process_initializer
+from mixed_io_cpu_task.commands.pipeline import crop_task
+from mixed_io_cpu_task.cropping import (
+    crop_with_pil,
+    crop_with_pil_async,
+    crop_path_stats,
+    encode_stats,
+    describe_encode_stats,
+    decoded_images,
+)
 from mixed_io_cpu_task.io_utils import (
     remove_dir,
     download_crops_and_image_async,
     save_image_buffers_async,
     remove_dir_async,
+    download_cache,
+    open_async_storage,
+    async_storage_stats,
+    gs_prefix,
+    download_throughput_stats,
+    describe_download_throughput,
+    close_packed_output,
+    packed_output_stats,
+    describe_packed_output,
+    count_output_files,
+)
+from mixed_io_cpu_task.manifest import iter_tasks
+from mixed_io_cpu_task.memory_utils import peak_rss
+from mixed_io_cpu_task.retry import retry_stats
+from mixed_io_cpu_task.logging_utils import (
+    configure_logger,
+    LOG_LEVELS,
+    LogOptions,
+    BatchQueueListener,
+    configure_log_sampling,
+    merge_process_logs,
+    remove_process_logs,
+)
+from mixed_io_cpu_task.spans import (
+    describe_span_summary,
+    merge_span_samples,
+    pop_span_samples,
+    span_summary,
 )
-from mixed_io_cpu_task.logging_utils import configure_logger
 
 
 @click.command()
-@click.argument("input_image", type=click.Path(path_type=str))
-@click.argument("crops", type=click.Path(path_type=str))
-@click.argument("output_dir", type=click.Path(path_type=str))
-@click.option("--num-repeats", "-r", default=1, help="Number of repeats")
-@click.option("--remove", "-rm", is_flag=True, help="Remove output dir before running")
+@task_options
 @click.option("--batch-size", "-b", default=10, help="Batch size")
+@click.option(
+    "--adaptive-concurrency",
+    is_flag=True,
+    help="Adapt task and upload concurrency to latency and errors (AIMD), "
+    "starting from --batch-size",
+)
+@click.option(
+    "--max-concurrency",
+    default=100,
+    help="Upper bound of the adaptive task and upload concurrency",
+)
+@io_options
+@crop_options
+@output_options
+@click.option(
+    "--cpu-executor",
+    default="inline",
+    help="Where crop/encode runs, inline blocks the event loop between PIL calls",
+    type=click.Choice(["inline", "thread", "process"]),
+)
+@click.option(
+    "--cpu-workers",
+    type=int,
+    default=None,
+    help="Workers of the thread or process CPU executor, defaults to CPU count / 2",
+)
+@click.option(
+    "--connection-pool-size",
+    default=100,
+    help="Connections of the HTTP session shared by all GCS requests, 0 means no limit",
+)
+@logging_options(
+    "How records of process CPU workers reach the log file: a queue record by "
+    "record, batched lists of records or a file per process merged after the run"
+)
 def asynchronous(
     input_image: str,
     crops: str,
     output_dir: str,
     num_repeats: int,
     remove: bool,
+    manifest: str,
     batch_size: int,
+    adaptive_concurrency: bool,
+    max_concurrency: int,
+    roi_decode: bool,
+    cpu_executor: str,
+    cpu_workers: int,
+    connection_pool_size: int,
+    log_level: str,
+    log_sample: int,
+    log_transport: str,
+    **process_options,
 ):
+    options = configure_from_options(**process_options)
     loop = asyncio.get_event_loop()
     return loop.run_until_complete(
-        _async_main(crops, input_image, num_repeats, output_dir, remove, batch_size)
+        _async_main(
+            crops,
+            input_image,
+            num_repeats,
+            output_dir,
+            remove,
+            batch_size,
+            manifest,
+            roi_decode,
+            cpu_executor,
+            cpu_workers or max(1, os.cpu_count() // 2),
+            connection_pool_size,
+            adaptive_concurrency,
+            max_concurrency,
+            options,
+            LogOptions(log_transport, LOG_LEVELS[log_level], log_sample),
+        )
     )
 
 
-async def _async_main(crops, input_image, num_repeats, output_dir, remove, batch_size):
+async def _async_main(
+    crops,
+    input_image,
+    num_repeats,
+    output_dir,
+    remove,
+    batch_size,
+    manifest,
+    roi_decode,
+    cpu_executor="inline",
+    cpu_workers=1,
+    connection_pool_size=100,
+    adaptive_concurrency=False,
+    max_concurrency=100,
+    options: ProcessOptions = ProcessOptions(),
+    log_options: LogOptions = LogOptions(),
+):
     # configure logger
     logging.basicConfig()
     logger = logging.getLogger("default")
-    log_filename = "asynchronous"
-    if "gs://" in output_dir:
-        log_filename += "-remote"
-    else:
-        log_filename += "-local"
-    configure_logger(logger, log_filename)
+    log_options = log_options._replace(
+        filename=log_filename("asynchronous", options, output_dir)
+    )
+    if log_options.transport == "files":
+        remove_process_logs(log_options.filename)
+    configure_logger(logger, log_options.filename, log_options.level)
+    configure_log_sampling(log_options.sample_every)
     logger.debug(f"PIL: {PIL.__version__}")
     logger.debug(f"NumPy: {np.__version__}")
-    logger.info(f"input image {input_image}, input crops {crops}")
+    logger.info(f"input image {input_image}, input crops {crops}, manifest {manifest}")
+    logger.info(f"Crop engine: {options.engine}")
+    logger.info(f"Output encoding: {options.encoding.describe()}")
+    logger.info(
+        f"Logging: {log_options.transport} transport, "
+        f"{logging.getLevelName(log_options.level).lower()} level, "
+        f"1 in {log_options.sample_every} traces"
+    )
+
+    # one HTTP session and storage client for every GCS request of the run
+    async with open_async_storage(connection_pool_size) as client:
+        # cleanup old data
+        if remove and not output_dir.startswith("gs://"):
+            logger.debug(f"Removing output dir {output_dir}")
+            remove_dir(output_dir)
+        elif remove and output_dir.startswith("gs://"):
+            logger.debug(f"Removing output dir {output_dir}")
+            await remove_dir_async(output_dir)
+        if not output_dir.startswith("gs://"):
+            pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
 
-    # cleanup old data
-    if remove and not output_dir.startswith("gs://"):
-        logger.debug(f"Removing output dir {output_dir}")
-        remove_dir(output_dir)
-    elif remove and output_dir.startswith("gs://"):
-        logger.debug(f"Removing output dir {output_dir}")
-        await remove_dir_async(output_dir)
-    if not output_dir.startswith("gs://"):
-        pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
-    # start benchmark
-    start = time.perf_counter()
-    tasks = (
-        _process_task_async(
-            crops, i, input_image, output_dir, max_concurrency=batch_size
+        # persistent pool running crop/encode, the event loop only drives I/O
+        cpu_pool = None
+        log_listener = None
+        if cpu_executor == "process":
+            logging_queue = Queue()
+            # workers of the files transport write their own log files
+            if log_options.transport != "files":
+                log_listener = BatchQueueListener(logging_queue, *logger.handlers)
+                log_listener.start()
+            # CPU workers neither download nor upload, the download cache stays off
+            cpu_pool = ProcessPoolExecutor(
+                cpu_workers,
+                initializer=worker_process_initializer,
+                initargs=(
+                    logging_queue,
+                    options._replace(cache_size_mb=0),
+                    log_options,
+                ),
+            )
+        elif cpu_executor == "thread":
+            cpu_pool = ThreadPoolExecutor(cpu_workers, thread_name_prefix="crop")
+        logger.info(
+            f"CPU count: {os.cpu_count()}, cropping with {cpu_executor} executor"
+            + (f" of {cpu_workers} workers" if cpu_pool is not None else "")
         )
-        for i in range(num_repeats)
-    )
-    async for _ in tqdm(
-        limit_concurrency(tasks, batch_size),
-        total=num_repeats,
-        desc="Processing images",
-    ):
-        pass
+        cpu_stats = {
+            "decoded": {},
+            "crop_paths": {},
+            "encode": {},
+            "spans": {},
+        }
+        lag_samples = []
+        task_limit = upload_limit = batch_size
+        if adaptive_concurrency:
+            task_limit = AdaptiveLimit("task", batch_size, max_limit=max_concurrency)
+            upload_limit = AdaptiveLimit(
+                "upload", batch_size, max_limit=max_concurrency
+            )
+        lag_monitor = asyncio.ensure_future(measure_loop_lag(lag_samples))
+        # start benchmark
+        start = time.perf_counter()
+        tasks = (
+            _process_task_async(
+                task.crops_path,
+                task.trace_id,
+                task.image_path,
+                task.output_dir,
+                max_concurrency=upload_limit,
+                roi_decode=roi_decode,
+                cpu_pool=cpu_pool,
+                cpu_stats=cpu_stats,
+            )
+            for task in iter_tasks(
+                input_image, crops, output_dir, num_repeats, manifest
+            )
+        )
+        num_images = 0
+        expected_files = 0
+        async for done in tqdm(
+            limit_concurrency(tasks, task_limit),
+            total=None if manifest else num_repeats,
+            desc="Processing images",
+        ):
+            num_images += 1
+            expected_files += done.result()
+        # the last shards are saved on a thread, gs shards with the sync client
+        await asyncio.to_thread(close_packed_output)
 
-    elapsed = time.perf_counter() - start
-    logger.info(
-        f"Elapsed {elapsed:.2f} seconds, average {num_repeats / elapsed:.2f} img/s"
-    )
+        elapsed = time.perf_counter() - start
+        lag_monitor.cancel()
+        if cpu_pool is not None:
+            cpu_pool.shutdown()
+        if log_listener is not None:
+            log_listener.stop()
+        if cpu_executor != "process":
+            cpu_stats["decoded"][os.getpid()] = decoded_images.stats()
+            cpu_stats["crop_paths"][os.getpid()] = crop_path_stats()
+            cpu_stats["encode"][os.getpid()] = encode_stats()
+        # keep the elapsed message last, plot-logs reads the average speed from it
+        logger.info(f"Event loop lag: {lag_summary(lag_samples)}")
+        logger.info(f"Storage connection stats: {async_storage_stats()}")
+        logger.info(f"GCS retry stats: {retry_stats()}")
+        logger.info(
+            f"Download throughput: {describe_download_throughput(download_throughput_stats())}"
+        )
+        packed = None
+        if options.packed_output:
+            packed = await asyncio.to_thread(packed_output_stats, output_dir)
+            logger.info(f"Packed output: {describe_packed_output(packed)}")
+        logger.info(f"Peak RSS: {peak_rss() / 2**20:.1f} MB")
+        if adaptive_concurrency:
+            logger.info(f"Task concurrency limit: {task_limit.summary()}")
+            logger.info(f"Upload concurrency limit: {upload_limit.summary()}")
+        logger.info(f"Download cache stats: {download_cache.stats()}")
+        logger.info(
+            f"Decoded image cache stats: {merge_stats(cpu_stats['decoded'].values())}"
+        )
+        if options.lossless_crops != "off":
+            crop_paths = merge_stats(cpu_stats["crop_paths"].values())
+            logger.info(f"Crop paths: {crop_paths}")
+        encoded = merge_stats(cpu_stats["encode"].values())
+        logger.info(f"Encode stats: {describe_encode_stats(encoded)}")
+        merge_span_samples([pop_span_samples()], cpu_stats["spans"])
+        spans = span_summary(cpu_stats["spans"])
+        logger.info(
+            f"Stage latency: {describe_span_summary(spans)}", extra={"spans": spans}
+        )
+        logger.info(
+            f"Elapsed {elapsed:.2f} seconds, average {num_images / elapsed:.2f} img/s"
+        )
+        if log_options.transport == "files":
+            merge_process_logs(logger, log_options.filename)
 
-    # validate the output dir contains the expected number of files
-    crops_per_image = 50  # TODO read from file
-    expected_files = num_repeats * crops_per_image
-    if not output_dir.startswith("gs://"):
-        assert len(list(pathlib.Path(output_dir).glob("*.jpg"))) == expected_files
-    else:
-        async with Storage() as client:
+        # validate the output dir contains the expected number of files
+        if packed is not None:
+            assert packed["crops"] == expected_files
+        elif not output_dir.startswith("gs://"):
+            assert count_output_files(output_dir) == expected_files
+        else:
             bucket_name = output_dir.split("/")[2]
             bucket = client.get_bucket(bucket_name)
 
-            blobs = await bucket.list_blobs(prefix="/".join(output_dir.split("/")[3:]))
+            blobs = await bucket.list_blobs(prefix=gs_prefix(output_dir))
             assert len(blobs) == expected_files
 
 
-async def _process_task_async(crops, i, input_image, output_dir, max_concurrency):
+async def _process_task_async(
+    crops,
+    trace_id,
+    input_image,
+    output_dir,
+    max_concurrency,
+    roi_decode=False,
+    cpu_pool: Optional[Executor] = None,
+    cpu_stats: Optional[dict] = None,
+) -> int:
+    """Processes single image and returns number of saved crops.
+
+    With cpu_pool cropping and encoding run on the pool instead of the event loop.
+    """
     image_buffer, crops_to_cut = await download_crops_and_image_async(
-        crops, input_image, trace_id=str(i)
+        crops, input_image, trace_id=trace_id
     )
-    buffers = await crop_with_pil_async(image_buffer, crops_to_cut, trace_id=str(i))
+    loop = asyncio.get_running_loop()
+    if isinstance(cpu_pool, ProcessPoolExecutor):
+        encoded, pid, stats = await loop.run_in_executor(
+            cpu_pool,
+            crop_task,
+            image_buffer.getvalue(),
+            crops_to_cut,
+            trace_id,
+            roi_decode,
+        )
+        cpu_stats["decoded"][pid] = stats["decoded"]
+        cpu_stats["crop_paths"][pid] = stats["crop_paths"]
+        cpu_stats["encode"][pid] = stats["encode"]
+        merge_span_samples([stats["spans"]], cpu_stats["spans"])
+        buffers = [BytesIO(data) for data in encoded]
+    elif cpu_pool is not None:
+        buffers = await loop.run_in_executor(
+            cpu_pool,
+            functools.partial(
+                crop_with_pil,
+                image_buffer,
+                crops_to_cut,
+                trace_id=trace_id,
+                roi_decode=roi_decode,
+            ),
+        )
+    else:
+        buffers = await crop_with_pil_async(
+            image_buffer, crops_to_cut, trace_id=trace_id, roi_decode=roi_decode
+        )
     await save_image_buffers_async(
-        buffers, output_dir, trace_id=str(i), max_concurrency=max_concurrency
+        buffers, output_dir, trace_id=trace_id, max_concurrency=max_concurrency
     )
+    return len(buffers)
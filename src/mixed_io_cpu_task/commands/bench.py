@@ -0,0 +1,341 @@
+import datetime
+import itertools
+import json
+import logging
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, NamedTuple
+
+import click
+import numpy as np
+import pandas as pd
+
+from mixed_io_cpu_task.commands.plot_logs import THROUGHPUT_PATTERN, read_log
+from mixed_io_cpu_task.logging_utils import configure_logger
+
+# options of every strategy taking an executor, a worker count or a batch size,
+# strategies without an option run every value of it with their default
+STRATEGIES = {
+    "serial": {},
+    "multi": {"executor": "-e", "workers": "--workers"},
+    "pipeline": {
+        "executor": "--crop-executor",
+        "workers": "--crop-workers",
+        "batch_size": "--queue-size",
+    },
+    "asynchronous": {
+        "executor": "--cpu-executor",
+        "workers": "--cpu-workers",
+        "batch_size": "--batch-size",
+    },
+}
+# executors accepted by every strategy taking one, cells with another are skipped
+EXECUTORS = {
+    "multi": ("thread", "process"),
+    "pipeline": ("thread", "process"),
+    "asynchronous": ("inline", "thread", "process"),
+}
+
+
+class BenchCell(NamedTuple):
+    """One combination of the benchmark matrix, 0 workers or batch size and an empty
+    executor keep the default of the strategy"""
+
+    strategy: str
+    executor: str
+    workers: int
+    batch_size: int
+    target: str
+
+    def normalized(self) -> "BenchCell":
+        """Returns the cell with settings its strategy ignores reset"""
+        options = STRATEGIES[self.strategy]
+        return self._replace(
+            executor=self.executor if "executor" in options else "",
+            workers=self.workers if "workers" in options else 0,
+            batch_size=self.batch_size if "batch_size" in options else 0,
+        )
+
+    @property
+    def supported(self) -> bool:
+        """Returns False when the strategy doesn't accept the executor of the cell"""
+        return not self.executor or self.executor in EXECUTORS[self.strategy]
+
+    @property
+    def name(self) -> str:
+        """Returns the strategy followed by the settings the cell overrides"""
+        name = self.strategy
+        if self.executor:
+            name += f"-{self.executor}"
+        if self.workers:
+            name += f"-w{self.workers}"
+        if self.batch_size:
+            name += f"-b{self.batch_size}"
+        return name
+
+    def output_dir(self) -> str:
+        """Returns the output dir of the cell under its target"""
+        return f"{self.target.rstrip('/')}/bench-{self.name}"
+
+    def args(self, input_image: str, crops: str, num_repeats: int) -> List[str]:
+        """Returns the benchmark command of the cell, the output dir of the cell is
+        removed before every run"""
+        options = STRATEGIES[self.strategy]
+        args = [self.strategy, input_image, crops, self.output_dir()]
+        args += ["-r", str(num_repeats), "-rm"]
+        if self.executor:
+            args += [options["executor"], self.executor]
+        if self.workers:
+            args += [options["workers"], str(self.workers)]
+        if self.batch_size:
+            args += [options["batch_size"], str(self.batch_size)]
+        return args
+
+
+def run_benchmark(benchmark_args: List[str], own_log: pathlib.Path) -> pathlib.Path:
+    """Runs a benchmark command in a new process and returns the log file it wrote, the
+    newest log of the working directory other than own_log"""
+    started = time.time()
+    subprocess.run(
+        [sys.executable, "-m", "mixed_io_cpu_task.commands", *benchmark_args],
+        check=True,
+    )
+    logs = [
+        path
+        for path in pathlib.Path().glob("*.log")
+        if path.stat().st_mtime >= started and path.resolve() != own_log.resolve()
+    ]
+    if not logs:
+        raise click.ClickException(f"{benchmark_args[0]} wrote no log file")
+    return max(logs, key=lambda path: path.stat().st_mtime)
+
+
+def image_latencies(df: pd.DataFrame) -> np.ndarray:
+    """Returns seconds from the start of the first to the end of the last timing span
+    of every image of a log read by read_log"""
+    spans = df[df["span"] != ""]
+    if spans.empty:
+        return np.array([])
+    bounds = spans.groupby("trace_id", observed=True).agg(
+        start=("start", "min"), end=("end", "max")
+    )
+    return (bounds["end"] - bounds["start"]).to_numpy()
+
+
+def describe_samples(
+    values, confidence: float = 0.95, resamples: int = 2000
+) -> Dict[str, float]:
+    """Returns count, median, quartiles and IQR and a bootstrap confidence interval of
+    the median, the samples are not assumed to be normally distributed"""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {"n": 0}
+    p25, median, p75 = np.percentile(values, [25, 50, 75])
+    rng = np.random.default_rng(42)
+    medians = np.median(
+        rng.choice(values, size=(resamples, len(values)), replace=True), axis=1
+    )
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(medians, [alpha, 1 - alpha])
+    return {
+        "n": len(values),
+        "median": float(median),
+        "p25": float(p25),
+        "p75": float(p75),
+        "iqr": float(p75 - p25),
+        "ci_low": float(ci_low),
+        "ci_high": float(ci_high),
+    }
+
+
+def _results_rows(results: List[dict]) -> pd.DataFrame:
+    """Flattens the results into one row per cell"""
+    rows = []
+    for result in results:
+        row = {key: value for key, value in result.items() if key != "samples"}
+        for metric in ("img_s", "latency_s"):
+            for stat, value in row.pop(metric).items():
+                row[f"{metric}_{stat}"] = value
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+@click.command()
+@click.argument("input_image", type=click.Path(path_type=str))
+@click.argument("crops", type=click.Path(path_type=str))
+@click.option(
+    "--target",
+    "-t",
+    "targets",
+    multiple=True,
+    required=True,
+    type=click.Path(path_type=str),
+    help="Output dir every cell is run against, local or gs://, can be repeated",
+)
+@click.option(
+    "--strategy",
+    "strategies",
+    multiple=True,
+    type=click.Choice(list(STRATEGIES)),
+    default=("serial", "multi", "pipeline", "asynchronous"),
+    show_default=True,
+    help="Benchmark commands of the matrix",
+)
+@click.option(
+    "--executor",
+    "executors",
+    multiple=True,
+    type=click.Choice(["inline", "thread", "process"]),
+    default=("thread", "process"),
+    show_default=True,
+    help="Executors of multi, the crop stage of pipeline and CPU work of asynchronous, "
+    "inline only runs asynchronous",
+)
+@click.option(
+    "--workers",
+    "worker_counts",
+    multiple=True,
+    type=int,
+    default=(0,),
+    show_default=True,
+    help="Worker counts of the executors, 0 keeps the default of the strategy",
+)
+@click.option(
+    "--batch-size",
+    "batch_sizes",
+    multiple=True,
+    type=int,
+    default=(0,),
+    show_default=True,
+    help="Batch sizes of asynchronous and queue sizes of pipeline, 0 keeps the default",
+)
+@click.option("--num-repeats", "-r", default=20, help="Images of every run")
+@click.option("--warmup", default=1, help="Discarded runs of every cell")
+@click.option("--trials", default=5, help="Measured runs of every cell")
+@click.option(
+    "--results-file",
+    default="bench-results.json",
+    type=click.Path(path_type=pathlib.Path),
+    help="JSON file with statistics and samples of every cell, or a CSV file with "
+    "one row of statistics per cell",
+)
+def bench(
+    input_image: str,
+    crops: str,
+    targets: tuple,
+    strategies: tuple,
+    executors: tuple,
+    worker_counts: tuple,
+    batch_sizes: tuple,
+    num_repeats: int,
+    warmup: int,
+    trials: int,
+    results_file: pathlib.Path,
+):
+    """Runs a matrix of strategies, executors, worker counts, batch sizes and targets
+    and reports median, IQR and 95% confidence interval of img/s and per-image latency
+    of every cell.
+
+    Every run is a new process writing into the freshly removed output dir of its cell.
+    Warmup runs of all cells go first, then trials of the cells are interleaved, so
+    drift of the machine or the network hits all cells alike. Per-image latency spans
+    from the start of the download to the end of the upload of an image.
+    """
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    configure_logger(logger, "bench")
+    own_log = pathlib.Path("bench.log")
+    logger.info(f"input image {input_image}, input crops {crops}, targets {targets}")
+
+    cells = []
+    for combination in itertools.product(
+        strategies, executors, worker_counts, batch_sizes
+    ):
+        for target in targets:
+            cell = BenchCell(*combination, target).normalized()
+            if cell.supported and cell not in cells:
+                cells.append(cell)
+    logger.info(
+        f"{len(cells)} cells, {warmup} warmup and {trials} trials of {num_repeats} "
+        f"images each"
+    )
+
+    speeds: Dict[BenchCell, List[float]] = {cell: [] for cell in cells}
+    latencies: Dict[BenchCell, List[np.ndarray]] = {cell: [] for cell in cells}
+    for run in range(warmup + trials):
+        for cell in cells:
+            args = cell.args(input_image, crops, num_repeats)
+            df, throughput = read_log(run_benchmark(args, own_log))
+            match = THROUGHPUT_PATTERN.search(throughput)
+            if not match:
+                raise click.ClickException(f"{cell.name} logged no elapsed record")
+            speed = float(match.group(1))
+            if run < warmup:
+                logger.info(
+                    f"Warmup {run}, {cell.name} {cell.target}: {speed:.2f} img/s"
+                )
+                continue
+            speeds[cell].append(speed)
+            latencies[cell].append(image_latencies(df))
+            logger.info(
+                f"Trial {run - warmup}, {cell.name} {cell.target}: {speed:.2f} img/s"
+            )
+
+    results = []
+    for cell in cells:
+        cell_latencies = np.concatenate(latencies[cell]) if latencies[cell] else []
+        results.append(
+            {
+                "name": cell.name,
+                **cell._asdict(),
+                "img_s": describe_samples(speeds[cell]),
+                "latency_s": describe_samples(cell_latencies),
+                "samples": {
+                    "img_s": speeds[cell],
+                    "latency_s": [float(value) for value in cell_latencies],
+                },
+            }
+        )
+
+    if results_file.suffix == ".csv":
+        _results_rows(results).to_csv(results_file, index=False)
+    else:
+        report = {
+            "started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "input_image": input_image,
+            "crops": crops,
+            "num_repeats": num_repeats,
+            "warmup": warmup,
+            "trials": trials,
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "results": results,
+        }
+        results_file.write_text(json.dumps(report, indent=2))
+
+    # fastest cell of every target first
+    results.sort(
+        key=lambda result: (
+            targets.index(result["target"]),
+            -result["img_s"].get("median", 0),
+        )
+    )
+    lines = [
+        f"{'target':<30} {'cell':<28} {'img/s':>8} {'IQR':>7} {'95% CI':>15} "
+        f"{'latency s':>10} {'IQR':>7}"
+    ]
+    for result in results:
+        img_s, latency = result["img_s"], result["latency_s"]
+        lines.append(
+            f"{result['target']:<30} {result['name']:<28} "
+            f"{img_s.get('median', np.nan):>8.2f} {img_s.get('iqr', np.nan):>7.2f} "
+            f"{img_s.get('ci_low', np.nan):>7.2f}-{img_s.get('ci_high', np.nan):<7.2f} "
+            f"{latency.get('median', np.nan):>10.3f} {latency.get('iqr', np.nan):>7.3f}"
+        )
+    logger.info(f"Results saved to {results_file}")
+    logger.info("Benchmark matrix results:\n" + "\n".join(lines))
@@ -0,0 +1,312 @@
+from typing import NamedTuple, Optional
+
+import click
+
+from mixed_io_cpu_task.cropping import (
+    LOSSLESS_MODES,
+    configure_crop_engine,
+    configure_decoded_image_cache,
+    configure_encode_pool,
+    configure_lossless_crops,
+    configure_output_encoding,
+)
+from mixed_io_cpu_task.engines import (
+    ENGINES,
+    OUTPUT_FORMATS,
+    SUBSAMPLINGS,
+    OutputEncoding,
+)
+from mixed_io_cpu_task.io_utils import (
+    configure_download_cache,
+    configure_gcs_retries,
+    configure_mmap_inputs,
+    configure_output_sharding,
+    configure_output_suffix,
+    configure_packed_output,
+    configure_sliced_downloads,
+    configure_upload_pool,
+)
+from mixed_io_cpu_task.logging_utils import LOG_LEVELS, LOG_TRANSPORTS
+
+
+class ProcessOptions(NamedTuple):
+    """Process-wide settings of the serial, multi, pipeline and asynchronous commands,
+    passed to worker initializers so workers are configured like the main process"""
+
+    cache_size_mb: int = 0
+    decode_cache_mb: int = 0
+    encode_workers: int = 1
+    engine: str = "pil"
+    lossless_crops: str = "off"
+    output_format: str = "jpeg"
+    quality: int = 75
+    progressive: bool = False
+    optimize: bool = False
+    subsampling: str = "4:2:0"
+    upload_pool_size: int = 0
+    max_uploads_in_flight: int = 0
+    gcs_attempts: int = 1
+    gcs_deadline: float = 60.0
+    hedge: bool = False
+    slice_threshold_mb: float = 0.0
+    slice_size_mb: float = 8.0
+    mmap_inputs: bool = False
+    shard_depth: int = 0
+    shard_fan_out: int = 256
+    pack_max_mb: float = 0.0
+    pack_max_images: int = 0
+
+    @property
+    def encoding(self) -> OutputEncoding:
+        """Returns the settings crops are encoded with"""
+        return OutputEncoding(
+            self.output_format,
+            self.quality,
+            self.progressive,
+            self.optimize,
+            self.subsampling,
+        )
+
+    @property
+    def packed_output(self) -> bool:
+        """Returns True when crops are packed into tar shards"""
+        return bool(self.pack_max_mb or self.pack_max_images)
+
+
+def configure_from_options(shared_memory: bool = False, **kwargs) -> ProcessOptions:
+    """Configures caches, pools, the crop engine, output and GCS settings of the process
+    from option values of ProcessOptions fields and returns them, with shared_memory
+    decoded images are shared with other worker processes"""
+    options = ProcessOptions(**kwargs)
+    encoding = options.encoding
+    configure_download_cache(options.cache_size_mb * 2**20)
+    configure_decoded_image_cache(
+        options.decode_cache_mb * 2**20, shared_memory=shared_memory
+    )
+    configure_encode_pool(options.encode_workers)
+    configure_crop_engine(options.engine)
+    configure_output_encoding(encoding)
+    configure_output_suffix(encoding.suffix)
+    configure_lossless_crops(options.lossless_crops)
+    configure_upload_pool(options.upload_pool_size, options.max_uploads_in_flight)
+    configure_gcs_retries(options.gcs_attempts, options.gcs_deadline, options.hedge)
+    configure_sliced_downloads(
+        int(options.slice_threshold_mb * 2**20), int(options.slice_size_mb * 2**20)
+    )
+    configure_mmap_inputs(options.mmap_inputs)
+    configure_output_sharding(options.shard_depth, options.shard_fan_out)
+    configure_packed_output(int(options.pack_max_mb * 2**20), options.pack_max_images)
+    return options
+
+
+def log_filename(command: str, options: ProcessOptions, output_dir: str) -> str:
+    """Returns the log file name of a run, without .log, plot-logs groups runs by it"""
+    name = command
+    if options.engine != "pil":
+        name += f"-{options.engine}"
+    if options.output_format != "jpeg":
+        name += f"-{options.output_format}"
+    return name + ("-remote" if "gs://" in output_dir else "-local")
+
+
+def _compose(*decorators):
+    """Applies decorators in order of the list, so options show in --help in order"""
+
+    def decorate(f):
+        for decorator in reversed(decorators):
+            f = decorator(f)
+        return f
+
+    return decorate
+
+
+task_options = _compose(
+    click.argument("input_image", type=click.Path(path_type=str)),
+    click.argument("crops", type=click.Path(path_type=str)),
+    click.argument("output_dir", type=click.Path(path_type=str)),
+    click.option("--num-repeats", "-r", default=1, help="Number of repeats"),
+    click.option(
+        "--remove", "-rm", is_flag=True, help="Remove output dir before running"
+    ),
+    click.option(
+        "--manifest",
+        "-m",
+        type=click.Path(path_type=str),
+        default=None,
+        help="CSV/JSONL manifest with image_path, crops_path, output_prefix columns, "
+        "blank columns fall back to INPUT_IMAGE and CROPS",
+    ),
+)
+
+io_options = _compose(
+    click.option(
+        "--cache-size-mb",
+        default=0,
+        help="Byte budget of the download cache for images and crops in MB, "
+        "0 disables it",
+    ),
+    click.option(
+        "--gcs-attempts",
+        default=1,
+        help="Attempts of every GCS read and write, transient errors are retried "
+        "with jittered exponential backoff, 1 keeps the storage client defaults",
+    ),
+    click.option(
+        "--gcs-deadline",
+        default=60.0,
+        help="Seconds all attempts of a GCS read or write may take",
+    ),
+    click.option(
+        "--hedge",
+        is_flag=True,
+        help="Send a duplicate GCS request when one runs past p95 latency of its "
+        "operation",
+    ),
+    click.option(
+        "--slice-threshold-mb",
+        default=0.0,
+        help="Download GCS objects of at least this size in MB as parallel byte "
+        "ranges, 0 uses a single stream",
+    ),
+    click.option(
+        "--slice-size-mb",
+        default=8.0,
+        help="Size of a byte range of sliced downloads in MB",
+    ),
+    click.option(
+        "--mmap-inputs",
+        is_flag=True,
+        help="Read local images and crops from read-only memory mappings shared by "
+        "all tasks instead of a copy per task",
+    ),
+)
+
+crop_options = _compose(
+    click.option(
+        "--decode-cache-mb",
+        default=0,
+        help="Pixel memory budget of the decoded image cache in MB, 0 disables it",
+    ),
+    click.option(
+        "--roi-decode",
+        is_flag=True,
+        help="Decode JPEG sources only down to the MCU row holding the lowest crop",
+    ),
+    click.option(
+        "--encode-workers",
+        "-w",
+        default=1,
+        help="Threads encoding crops of an image in parallel, 1 encodes them one by "
+        "one",
+    ),
+    click.option(
+        "--engine",
+        type=click.Choice(list(ENGINES)),
+        default="pil",
+        help="Engine cropping and encoding images, turbojpeg and opencv need "
+        "PyTurboJPEG and opencv-python-headless",
+    ),
+    click.option(
+        "--lossless-crops",
+        type=click.Choice(LOSSLESS_MODES),
+        default="off",
+        help="Cut crops of JPEG sources in the DCT domain with PyTurboJPEG, aligned "
+        "cuts crops starting on the MCU grid, snap moves every crop onto the grid",
+    ),
+)
+
+output_options = _compose(
+    click.option(
+        "--output-format",
+        type=click.Choice(list(OUTPUT_FORMATS)),
+        default="jpeg",
+        help="Format crops are encoded to",
+    ),
+    click.option(
+        "--quality",
+        type=click.IntRange(1, 100),
+        default=75,
+        help="Quality of JPEG and WebP crops",
+    ),
+    click.option("--progressive", is_flag=True, help="Encode progressive JPEG crops"),
+    click.option(
+        "--optimize",
+        is_flag=True,
+        help="Spend encode time on smaller crops: optimal JPEG Huffman tables, the "
+        "slowest WebP method, the highest PNG compression",
+    ),
+    click.option(
+        "--subsampling",
+        type=click.Choice(SUBSAMPLINGS),
+        default="4:2:0",
+        help="Chroma subsampling of JPEG crops",
+    ),
+    click.option(
+        "--shard-depth",
+        default=0,
+        help="Levels of hash prefixed subdirectories / object name prefixes crops "
+        "are spread over, 0 saves all crops of an image into one flat dir",
+    ),
+    click.option(
+        "--shard-fan-out",
+        default=256,
+        help="Shards per level of the sharded output layout",
+    ),
+    click.option(
+        "--pack-max-mb",
+        default=0.0,
+        help="Pack crops into tar shards with an index, one file or GCS object per "
+        "shard of at most this size in MB, 0 with --pack-max-images 0 saves a file "
+        "per crop",
+    ),
+    click.option(
+        "--pack-max-images",
+        default=0,
+        help="Images whose crops are packed into one tar shard, 0 leaves only the "
+        "size bound",
+    ),
+)
+
+upload_pool_options = _compose(
+    click.option(
+        "--upload-pool-size",
+        default=0,
+        help="Threads of a process-wide pool saving crops of all tasks, "
+        "0 creates a new pool for every image",
+    ),
+    click.option(
+        "--max-uploads-in-flight",
+        default=0,
+        help="Limit of crops submitted to the upload pool of a process and not saved "
+        "yet, 0 means no limit",
+    ),
+)
+
+
+def logging_options(transport_help: Optional[str] = None):
+    """Returns a decorator adding --log-level and --log-sample, and --log-transport
+    with transport_help for commands with worker processes"""
+    options = [
+        click.option(
+            "--log-level",
+            type=click.Choice(list(LOG_LEVELS)),
+            default="debug",
+            help="info skips per-image debug records like timing spans before they "
+            "are built",
+        ),
+        click.option(
+            "--log-sample",
+            default=1,
+            help="Keep debug records of 1 in N trace ids, sampled by a hash of the id",
+        ),
+    ]
+    if transport_help:
+        options.append(
+            click.option(
+                "--log-transport",
+                type=click.Choice(LOG_TRANSPORTS),
+                default="queue",
+                help=transport_help,
+            )
+        )
+    return _compose(*options)
@@ -1,9 +1,11 @@
+import functools
 import logging
 import logging.handlers
 import os
 import pathlib
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing.util
 from multiprocessing import Queue, Process
 
 import PIL
@@ -11,55 +13,203 @@ import click
 import numpy as np
 from tqdm import tqdm
 
-from mixed_io_cpu_task.cropping import crop_with_pil
+from mixed_io_cpu_task.cache import merge_stats
+from mixed_io_cpu_task.commands.common_options import (
+    ProcessOptions,
+    configure_from_options,
+    crop_options,
+    io_options,
+    log_filename,
+    logging_options,
+    output_options,
+    task_options,
+    upload_pool_options,
+)
+from mixed_io_cpu_task.cropping import (
+    crop_with_pil,
+    crop_path_stats,
+    encode_stats,
+    describe_encode_stats,
+    decoded_images,
+)
+from mixed_io_cpu_task.executor_utils import submit_with_limit
 from mixed_io_cpu_task.io_utils import (
     download_crops_and_image,
     save_image_buffers_with_threadpool,
     remove_dir,
+    download_cache,
+    upload_pool_stats,
+    describe_upload_stats,
+    download_throughput_stats,
+    describe_download_throughput,
+    close_packed_output,
+    packed_output_stats,
+    describe_packed_output,
+)
+from mixed_io_cpu_task.manifest import iter_tasks
+from mixed_io_cpu_task.memory_utils import peak_rss
+from mixed_io_cpu_task.retry import retry_stats
+from mixed_io_cpu_task.shared_images import unlink_created_segments
+from mixed_io_cpu_task.spans import (
+    describe_span_summary,
+    merge_span_samples,
+    pop_span_samples,
+    span_summary,
 )
 
-from mixed_io_cpu_task.logging_utils import configure_logger
+from mixed_io_cpu_task.logging_utils import (
+    configure_logger,
+    LOG_LEVELS,
+    LogOptions,
+    BatchQueueHandler,
+    configure_log_sampling,
+    configure_process_log_file,
+    flush_batches,
+    handle_queued,
+    merge_process_logs,
+    process_log_filename,
+    remove_process_logs,
+)
 
 
 def logger_thread(q, log_filename: str):
     """logger thread consumes logging records from the queue and logs them."""
     logging.basicConfig()
     logger = logging.getLogger("default")
+    # drop queue handler inherited from the parent, otherwise every record is put back
+    # on the queue and the process blocks on exit flushing them
+    logger.handlers.clear()
     configure_logger(logger, log_filename)
-    while record := q.get():
-        if record is None:
+    while item := q.get():
+        if item is None:
             break
-        logger = logging.getLogger(record.name)
-        logger.handle(record)
+        # a single record or a list of records of the batched transport
+        handle_queued(item)
 
 
-def logger_queue_handler_initializer(logging_queue: Queue):
+def logger_queue_handler_initializer(
+    logging_queue: Queue, log_options: LogOptions = LogOptions()
+):
     """worker initializer creates a new logger for every worker process and uses shared logging queue
-    to log to the main process
+    to log to the main process, with the files transport worker processes log to their own file
     """
-    queue_handler = logging.handlers.QueueHandler(logging_queue)
     root = logging.getLogger("default")
-    root.addHandler(queue_handler)
-    root.setLevel(logging.DEBUG)
+    configure_log_sampling(log_options.sample_every)
+    if log_options.transport == "files":
+        # thread workers share the log file of the main process, forked workers drop
+        # its handler and open a file of their own
+        if multiprocessing.parent_process() is not None:
+            own_file = os.path.abspath(process_log_filename(log_options.filename))
+            for handler in list(root.handlers):
+                if getattr(handler, "baseFilename", None) != own_file:
+                    root.removeHandler(handler)
+            if not root.handlers:
+                configure_process_log_file(root, log_options.filename)
+    else:
+        # forked workers drop handlers writing the log file of the main process,
+        # their records only reach it through the queue
+        if multiprocessing.parent_process() is not None:
+            for handler in list(root.handlers):
+                if not isinstance(handler, logging.handlers.QueueHandler):
+                    root.removeHandler(handler)
+        # thread workers share the logger of the main process, add the handler once
+        if not any(
+            isinstance(handler, logging.handlers.QueueHandler)
+            for handler in root.handlers
+        ):
+            if log_options.transport == "batched":
+                root.addHandler(BatchQueueHandler(logging_queue))
+            else:
+                root.addHandler(logging.handlers.QueueHandler(logging_queue))
+    if log_options.transport == "batched" and multiprocessing.parent_process():
+        # send the last batch when a worker process exits, after records of other
+        # finalizers and before the queue closes its feeder thread at priority 10
+        multiprocessing.util.Finalize(
+            root, functools.partial(flush_batches, root), exitpriority=15
+        )
+    root.setLevel(log_options.level)
     root.debug("worker initialized")
 
 
-def run(i, crops, input_image, output_dir, max_save_threads):
+def start_logging(logger, log_options: LogOptions):
+    """Sets up logging of the main process and returns the queue of worker records and
+    the process writing them to the log file, None with the files transport"""
+    logging_queue = Queue()
+    if log_options.transport == "files":
+        remove_process_logs(log_options.filename)
+        configure_logger(logger, log_options.filename, log_options.level)
+        configure_log_sampling(log_options.sample_every)
+        return logging_queue, None
+    logger_queue_handler_initializer(logging_queue, log_options)
+    # initialize a thread to consume the logging messages
+    logging_process = Process(
+        target=logger_thread,
+        args=(logging_queue, log_options.filename),
+    )
+    logging_process.start()
+    return logging_queue, logging_process
+
+
+def stop_logging(logger, log_options: LogOptions, logging_queue, logging_process):
+    """Waits for all records to reach the log file, process log files of the files
+    transport are merged into it"""
+    if logging_process is None:
+        merge_process_logs(logger, log_options.filename)
+        return
+    flush_batches(logger)
+    logging_queue.put(None)
+    logging_process.join()
+
+
+def worker_process_initializer(
+    logging_queue: Queue,
+    options: ProcessOptions = ProcessOptions(),
+    log_options: LogOptions = LogOptions(),
+):
+    """worker initializer sets up logging and configures the worker process like the main
+    process from options, decoded images are shared with other workers through shared
+    memory, open tar shards are finished when the worker exits
+    """
+    logger_queue_handler_initializer(logging_queue, log_options)
+    configure_from_options(shared_memory=True, **options._asdict())
+    if options.packed_output:
+        multiprocessing.util.Finalize(None, close_packed_output, exitpriority=20)
+    # segments still in the decoded image cache are unlinked when the worker exits,
+    # evicted ones are unlinked on eviction
+    multiprocessing.util.Finalize(None, unlink_created_segments, exitpriority=5)
+
+
+def run(trace_id, crops, input_image, output_dir, max_save_threads, roi_decode=False):
     image_buffer, crops_to_cut = download_crops_and_image(
-        crops, input_image, trace_id=str(i)
+        crops, input_image, trace_id=trace_id
+    )
+    buffers = crop_with_pil(
+        image_buffer, crops_to_cut, trace_id=trace_id, roi_decode=roi_decode
     )
-    buffers = crop_with_pil(image_buffer, crops_to_cut, trace_id=str(i))
     save_image_buffers_with_threadpool(
-        buffers, output_dir, trace_id=str(i), max_threads=max_save_threads
+        buffers, output_dir, trace_id=trace_id, max_threads=max_save_threads
     )
+    return os.getpid(), {**process_stats(), "spans": pop_span_samples()}
+
+
+def process_stats() -> dict:
+    """Returns cumulative cache, encode, upload, retry, download and memory counters of
+    the calling process, the main process merges them across worker processes"""
+    return {
+        "download": download_cache.stats(),
+        "decoded": decoded_images.stats(),
+        "crop_paths": crop_path_stats(),
+        "encode": encode_stats(),
+        "upload": upload_pool_stats(),
+        "retry": retry_stats(),
+        "sliced": download_throughput_stats()["sliced"],
+        "single": download_throughput_stats()["single"],
+        "memory": {"peak_rss": peak_rss()},
+    }
 
 
 @click.command()
-@click.argument("input_image", type=click.Path(path_type=str))
-@click.argument("crops", type=click.Path(path_type=str))
-@click.argument("output_dir", type=click.Path(path_type=str))
-@click.option("--num-repeats", "-r", default=1, help="Number of repeats")
-@click.option("--remove", "-rm", is_flag=True, help="Remove output dir before running")
+@task_options
 @click.option(
     "--executor",
     "-e",
@@ -67,37 +217,58 @@ def run(i, crops, input_image, output_dir, max_save_threads):
     help="Executor to use",
     type=click.Choice(["thread", "process"]),
 )
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Workers of the executor, defaults to CPU count / 2 processes or "
+    "CPU count / 2 + 4 threads",
+)
+@io_options
+@crop_options
+@output_options
+@upload_pool_options
+@logging_options(
+    "How records of workers reach the log file: a queue record by record, "
+    "batched lists of records or a file per process merged after the run"
+)
 def multi(
     input_image: str,
     crops: str,
     output_dir: str,
     num_repeats: int,
     remove: bool,
+    manifest: str,
     executor: str,
+    workers: int,
+    roi_decode: bool,
+    log_level: str,
+    log_sample: int,
+    log_transport: str,
+    **process_options,
 ):
-    # set a queue for the logging messages
-    logging_queue = Queue()
-
+    options = configure_from_options(**process_options)
     # setup the logger
     logging.basicConfig()
     logger = logging.getLogger("default")
-    log_filename = f"multi-{executor}"
-    if "gs://" in output_dir:
-        log_filename += "-remote"
-    else:
-        log_filename += "-local"
-
-    logger_queue_handler_initializer(logging_queue)
-    # initialize a thread to consume the logging messages
-    logging_process = Process(
-        target=logger_thread,
-        args=(logging_queue, log_filename),
+    log_options = LogOptions(
+        log_transport,
+        LOG_LEVELS[log_level],
+        log_sample,
+        log_filename(f"multi-{executor}", options, output_dir),
     )
-    logging_process.start()
+    # set a queue for the logging messages of the workers
+    logging_queue, logging_process = start_logging(logger, log_options)
 
     logger.debug(f"PIL: {PIL.__version__}")
     logger.debug(f"NumPy: {np.__version__}")
-    logger.info(f"input image {input_image}, input crops {crops}")
+    logger.info(f"input image {input_image}, input crops {crops}, manifest {manifest}")
+    logger.info(f"Crop engine: {options.engine}")
+    logger.info(f"Output encoding: {options.encoding.describe()}")
+    logger.info(
+        f"Logging: {log_transport} transport, {log_level} level, "
+        f"1 in {log_sample} traces"
+    )
 
     # cleanup old data
     if remove:
@@ -108,35 +279,101 @@ def multi(
 
     if executor == "process":
         Executor = ProcessPoolExecutor
-        max_workers = os.cpu_count() // 2
+        max_workers = workers or max(1, os.cpu_count() // 2)
     else:
         Executor = ThreadPoolExecutor
-        max_workers = os.cpu_count() // 2 + 4
+        max_workers = workers or os.cpu_count() // 2 + 4
 
     logger.info(
         f"CPU count: {os.cpu_count()}, will use {max_workers} workers with {Executor.__name__}"
     )
 
+    if executor == "process":
+        initializer = worker_process_initializer
+        initargs = (logging_queue, options, log_options)
+    else:
+        # threads share caches, the encode and the upload pool configured above
+        initializer = logger_queue_handler_initializer
+        initargs = (logging_queue, log_options)
+    cache_stats = {}
+    span_samples = {}
     # start benchmark
     start = time.perf_counter()
     # initialize all processes in the executor with the same logging queue
     with Executor(
         max_workers,
-        initializer=logger_queue_handler_initializer,
-        initargs=(logging_queue,),
+        initializer=initializer,
+        initargs=initargs,
     ) as executor:
-        futures = []
-        for i in range(num_repeats):
-            future = executor.submit(
-                run, i, crops, input_image, output_dir, max_workers
+        # submit tasks lazily, keeping every worker busy without holding a future
+        # for every task of a long manifest in memory
+        tasks = (
+            (
+                task.trace_id,
+                task.crops_path,
+                task.image_path,
+                task.output_dir,
+                max_workers,
+                roi_decode,
+            )
+            for task in iter_tasks(
+                input_image, crops, output_dir, num_repeats, manifest
             )
-            futures.append(future)
-        for future in tqdm(as_completed(futures), total=len(futures)):
-            future.result()
+        )
+        num_images = 0
+        for future in tqdm(
+            submit_with_limit(executor, run, tasks, limit=2 * max_workers),
+            total=None if manifest else num_repeats,
+        ):
+            pid, stats = future.result()
+            cache_stats[pid] = stats
+            merge_span_samples([stats["spans"]], span_samples)
+            num_images += 1
+    # worker processes finished their shards on exit when the executor shut down
+    close_packed_output()
+    if Executor is not ProcessPoolExecutor:
+        # threads report the counters of this process as they finish, out of order,
+        # so the last snapshot isn't the newest one
+        cache_stats = {os.getpid(): process_stats()}
 
     elapsed = time.perf_counter() - start
+    # keep the elapsed message last, plot-logs reads the average speed from it
+    download_stats = merge_stats(stats["download"] for stats in cache_stats.values())
+    decoded_stats = merge_stats(stats["decoded"] for stats in cache_stats.values())
+    logger.info(f"Download cache stats: {download_stats}")
+    upload_stats = merge_stats(stats["upload"] for stats in cache_stats.values())
+    logger.info(f"Decoded image cache stats: {decoded_stats}")
+    if options.lossless_crops != "off":
+        crop_paths = merge_stats(stats["crop_paths"] for stats in cache_stats.values())
+        logger.info(f"Crop paths: {crop_paths}")
+    encoded = merge_stats(stats["encode"] for stats in cache_stats.values())
+    logger.info(f"Encode stats: {describe_encode_stats(encoded)}")
+    if options.upload_pool_size:
+        logger.info(f"Upload pool stats: {describe_upload_stats(upload_stats)}")
+    gcs_stats = merge_stats(stats["retry"] for stats in cache_stats.values())
+    logger.info(f"GCS retry stats: {gcs_stats}")
+    throughput = {
+        mode: merge_stats(stats[mode] for stats in cache_stats.values())
+        for mode in ("single", "sliced")
+    }
+    logger.info(f"Download throughput: {describe_download_throughput(throughput)}")
+    if options.packed_output:
+        packed = packed_output_stats(output_dir)
+        logger.info(f"Packed output: {describe_packed_output(packed)}")
+    if Executor is ProcessPoolExecutor:
+        workers_rss = merge_stats(stats["memory"] for stats in cache_stats.values())
+        logger.info(
+            f"Peak RSS: main {peak_rss() / 2**20:.1f} MB, "
+            f"workers {workers_rss['peak_rss'] / 2**20:.1f} MB"
+        )
+    else:
+        logger.info(f"Peak RSS: {peak_rss() / 2**20:.1f} MB")
+    merge_span_samples([pop_span_samples()], span_samples)
+    spans = span_summary(span_samples)
     logger.info(
-        f"Elapsed {elapsed:.2f} seconds, average {num_repeats/elapsed:.2f} img/s"
+        f"Stage latency: {describe_span_summary(spans)}", extra={"spans": spans}
     )
-    logging_queue.put(None)
-    logging_process.join()
+    logger.info(
+        f"Elapsed {elapsed:.2f} seconds, average {num_images/elapsed:.2f} img/s"
+    )
+    stop_logging(logger, log_options, logging_queue, logging_process)
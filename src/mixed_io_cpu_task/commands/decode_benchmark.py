@@ -0,0 +1,97 @@
+import logging
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing import get_context
+from typing import Optional
+
+import PIL
+import click
+import numpy as np
+
+from mixed_io_cpu_task.cropping import (
+    configure_crop_engine,
+    crop_with_pil,
+    decode_image,
+)
+from mixed_io_cpu_task.engines import ENGINES
+from mixed_io_cpu_task.io_utils import download_crops_and_image
+from mixed_io_cpu_task.jpeg_utils import crops_bounding_box
+from mixed_io_cpu_task.logging_utils import configure_logger
+from mixed_io_cpu_task.memory_utils import peak_rss, reset_peak_rss
+
+
+def _measure_decode(image: bytes, rows: Optional[int], num_repeats: int):
+    """Decodes the image num_repeats times in a fresh process and returns decode times,
+    peak RSS growth and decoded size"""
+    image_buffer = BytesIO(image)
+    reset_peak_rss()
+    baseline_rss = peak_rss()
+    times = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        decoded = decode_image(image_buffer, rows)
+        times.append(time.perf_counter() - start)
+        size = decoded.size
+        del decoded
+    return times, peak_rss() - baseline_rss, size
+
+
+@click.command()
+@click.argument("input_image", type=click.Path(path_type=str))
+@click.argument("crops", type=click.Path(path_type=str))
+@click.option("--num-repeats", "-r", default=10, help="Number of decodes per mode")
+@click.option(
+    "--engine",
+    type=click.Choice(list(ENGINES)),
+    default="pil",
+    help="Engine cutting the crops compared between full and ROI decode",
+)
+def decode_benchmark(input_image: str, crops: str, num_repeats: int, engine: str):
+    """Compares full and region-of-interest decode time and peak RSS per image"""
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    log_filename = "decode-benchmark"
+    if "gs://" in input_image:
+        log_filename += "-remote"
+    else:
+        log_filename += "-local"
+    configure_logger(logger, log_filename)
+    logger.debug(f"PIL: {PIL.__version__}")
+    logger.debug(f"NumPy: {np.__version__}")
+    logger.info(f"input image {input_image}, input crops {crops}")
+    logger.info(f"Crop engine: {engine}")
+    configure_crop_engine(engine)
+
+    image_buffer, crops_to_cut = download_crops_and_image(
+        crops, input_image, trace_id="0"
+    )
+    rows = crops_bounding_box(crops_to_cut)[3]
+
+    # ROI decode must not change a single byte of the output
+    full_crops = crop_with_pil(image_buffer, crops_to_cut, trace_id="0")
+    roi_crops = crop_with_pil(image_buffer, crops_to_cut, trace_id="0", roi_decode=True)
+    identical = [a.getvalue() for a in full_crops] == [b.getvalue() for b in roi_crops]
+    logger.info(f"ROI crops identical to full decode crops: {identical}")
+
+    results = {}
+    for mode, mode_rows in (("full", None), ("roi", rows)):
+        # every mode runs in a fresh process with its own peak RSS
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            times, rss_growth, size = executor.submit(
+                _measure_decode, image_buffer.getvalue(), mode_rows, num_repeats
+            ).result()
+        results[mode] = statistics.median(times), rss_growth
+        logger.info(
+            f"{mode} decode of {size[0]}x{size[1]} pixels: "
+            f"median {statistics.median(times) * 1000:.1f} ms, "
+            f"peak RSS +{rss_growth / 2**20:.1f} MB"
+        )
+
+    (full_time, full_rss), (roi_time, roi_rss) = results["full"], results["roi"]
+    logger.info(
+        f"ROI decode of {rows} rows saves {(full_time - roi_time) * 1000:.1f} ms "
+        f"({(1 - roi_time / full_time) * 100:.0f}%) and "
+        f"{(full_rss - roi_rss) / 2**20:.1f} MB peak RSS per image"
+    )
@@ -0,0 +1,90 @@
+import logging
+import statistics
+import time
+
+import PIL
+import click
+import numpy as np
+
+from mixed_io_cpu_task.cropping import (
+    crop_with_pil,
+    configure_crop_engine,
+    configure_decoded_image_cache,
+    configure_encode_pool,
+)
+from mixed_io_cpu_task.engines import ENGINES, available_engines
+from mixed_io_cpu_task.io_utils import download_crops_and_image
+from mixed_io_cpu_task.logging_utils import configure_logger
+
+
+@click.command()
+@click.argument("input_image", type=click.Path(path_type=str))
+@click.argument("crops", type=click.Path(path_type=str))
+@click.option("--num-repeats", "-r", default=10, help="Number of images per setting")
+@click.option(
+    "--encode-workers",
+    "-w",
+    multiple=True,
+    type=int,
+    default=(1, 2, 4, 8),
+    show_default=True,
+    help="Encode pool sizes to compare, 1 is the sequential loop",
+)
+@click.option(
+    "--engine",
+    multiple=True,
+    type=click.Choice(list(ENGINES)),
+    default=available_engines(),
+    show_default=True,
+    help="Crop engines to compare, defaults to all installed engines",
+)
+def encode_benchmark(
+    input_image: str,
+    crops: str,
+    num_repeats: int,
+    encode_workers: tuple,
+    engine: tuple,
+):
+    """Compares crop engines and sequential and parallel crop encoding of a single
+    image"""
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    log_filename = "encode-benchmark"
+    if "gs://" in input_image:
+        log_filename += "-remote"
+    else:
+        log_filename += "-local"
+    configure_logger(logger, log_filename)
+    logger.debug(f"PIL: {PIL.__version__}")
+    logger.debug(f"NumPy: {np.__version__}")
+    logger.info(f"input image {input_image}, input crops {crops}")
+
+    image_buffer, crops_to_cut = download_crops_and_image(
+        crops, input_image, trace_id="0"
+    )
+    # decode the image once, only cropping and encoding is measured
+    configure_decoded_image_cache(2**62)
+    reference = None
+    first_time = None
+    for name in engine:
+        configure_crop_engine(name)
+        for workers in encode_workers:
+            configure_encode_pool(workers)
+            times = []
+            for i in range(num_repeats):
+                start = time.perf_counter()
+                buffers = crop_with_pil(image_buffer, crops_to_cut, trace_id=str(i))
+                times.append(time.perf_counter() - start)
+            encoded = [buffer.getvalue() for buffer in buffers]
+            reference = reference or encoded
+            median = statistics.median(times)
+            first_time = first_time or median
+            logger.info(
+                f"{name} engine, {workers} encode workers, {len(crops_to_cut)} crops: "
+                f"median {median * 1000:.1f} ms per image, {1 / median:.2f} img/s, "
+                f"{sum(map(len, encoded)) / 2**10:.0f} KB, "
+                f"speedup {first_time / median:.2f}x vs {engine[0]} engine with "
+                f"{encode_workers[0]} workers, output identical: {encoded == reference}"
+            )
+    configure_encode_pool(1)
+    configure_crop_engine("pil")
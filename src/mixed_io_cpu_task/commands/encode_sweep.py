@@ -0,0 +1,190 @@
+import itertools
+import logging
+import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import PIL
+import click
+import numpy as np
+
+from mixed_io_cpu_task.commands.concurrency import run
+from mixed_io_cpu_task.cropping import (
+    configure_crop_engine,
+    configure_output_encoding,
+    describe_encode_stats,
+    encode_stats,
+)
+from mixed_io_cpu_task.engines import (
+    ENGINES,
+    OUTPUT_FORMATS,
+    SUBSAMPLINGS,
+    OutputEncoding,
+)
+from mixed_io_cpu_task.io_utils import configure_output_suffix, remove_dir
+from mixed_io_cpu_task.logging_utils import configure_logger
+
+
+def _sweep_settings(
+    formats: tuple,
+    qualities: tuple,
+    progressive: tuple,
+    optimize: tuple,
+    subsampling: tuple,
+) -> List[OutputEncoding]:
+    """Returns every combination of the settings, combinations differing only in
+    settings their format ignores are swept once"""
+    settings = []
+    for combination in itertools.product(
+        formats, qualities, progressive, optimize, subsampling
+    ):
+        encoding = OutputEncoding(*combination).normalized()
+        if encoding not in settings:
+            settings.append(encoding)
+    return settings
+
+
+@click.command()
+@click.argument("input_image", type=click.Path(path_type=str))
+@click.argument("crops", type=click.Path(path_type=str))
+@click.option(
+    "--target",
+    "-t",
+    "targets",
+    multiple=True,
+    required=True,
+    type=click.Path(path_type=str),
+    help="Output dir every setting is run against, local or gs://, can be repeated",
+)
+@click.option("--num-repeats", "-r", default=10, help="Number of images per setting")
+@click.option(
+    "--workers",
+    default=4,
+    help="Images processed at the same time by a thread pool, like multi -e thread",
+)
+@click.option(
+    "--max-save-threads",
+    default=10,
+    help="Threads saving the crops of an image",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(list(ENGINES)),
+    default="pil",
+    help="Engine cropping and encoding images",
+)
+@click.option(
+    "--output-format",
+    "formats",
+    multiple=True,
+    type=click.Choice(list(OUTPUT_FORMATS)),
+    default=("jpeg", "webp", "png"),
+    show_default=True,
+    help="Formats to sweep",
+)
+@click.option(
+    "--quality",
+    "qualities",
+    multiple=True,
+    type=click.IntRange(1, 100),
+    default=(50, 75, 90),
+    show_default=True,
+    help="JPEG and WebP qualities to sweep",
+)
+@click.option(
+    "--progressive",
+    multiple=True,
+    type=bool,
+    default=(False,),
+    show_default=True,
+    help="Progressive JPEG settings to sweep, e.g. --progressive false --progressive true",
+)
+@click.option(
+    "--optimize",
+    multiple=True,
+    type=bool,
+    default=(False, True),
+    show_default=True,
+    help="Optimize settings to sweep",
+)
+@click.option(
+    "--subsampling",
+    multiple=True,
+    type=click.Choice(SUBSAMPLINGS),
+    default=("4:2:0",),
+    show_default=True,
+    help="JPEG chroma subsamplings to sweep",
+)
+def encode_sweep(
+    input_image: str,
+    crops: str,
+    targets: tuple,
+    num_repeats: int,
+    workers: int,
+    max_save_threads: int,
+    engine: str,
+    formats: tuple,
+    qualities: tuple,
+    progressive: tuple,
+    optimize: tuple,
+    subsampling: tuple,
+):
+    """Sweeps output encoding settings and reports end-to-end img/s, encode time and
+    bytes per crop of every setting against every target.
+
+    Every setting downloads, crops, encodes and saves num_repeats images into a freshly
+    removed target, so the encode time a setting costs is weighed against the upload
+    bytes it saves.
+    """
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    configure_logger(logger, "encode-sweep")
+    logger.debug(f"PIL: {PIL.__version__}")
+    logger.debug(f"NumPy: {np.__version__}")
+    logger.info(f"input image {input_image}, input crops {crops}, targets {targets}")
+    configure_crop_engine(engine)
+    logger.info(f"Crop engine: {engine}")
+
+    settings = _sweep_settings(formats, qualities, progressive, optimize, subsampling)
+    results = []
+    for target in targets:
+        for encoding in settings:
+            remove_dir(target)
+            if not target.startswith("gs://"):
+                pathlib.Path(target).mkdir(exist_ok=True, parents=True)
+            configure_output_encoding(encoding)
+            configure_output_suffix(encoding.suffix)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [
+                    executor.submit(
+                        run, str(i), crops, input_image, target, max_save_threads
+                    )
+                    for i in range(num_repeats)
+                ]
+                for future in futures:
+                    future.result()
+            elapsed = time.perf_counter() - start
+            stats = encode_stats()
+            results.append((target, encoding, num_repeats / elapsed, stats))
+            logger.info(
+                f"{target}, {encoding.describe()}: {num_repeats / elapsed:.2f} img/s, "
+                f"{describe_encode_stats(stats)}"
+            )
+    configure_output_encoding(OutputEncoding())
+    configure_output_suffix(OutputEncoding().suffix)
+
+    # fastest setting of every target first
+    results.sort(key=lambda result: (targets.index(result[0]), -result[2]))
+    lines = [
+        f"{'target':<30} {'setting':<48} {'img/s':>8} {'ms/crop':>8} {'KB/crop':>8}"
+    ]
+    for target, encoding, speed, stats in results:
+        crops_encoded = max(stats["crops"], 1)
+        lines.append(
+            f"{target:<30} {encoding.describe():<48} {speed:>8.2f} "
+            f"{stats['encode_ns'] / crops_encoded / 1e6:>8.2f} "
+            f"{stats['bytes'] / crops_encoded / 2**10:>8.1f}"
+        )
+    logger.info("Encode sweep results:\n" + "\n".join(lines))
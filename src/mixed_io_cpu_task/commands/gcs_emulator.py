@@ -0,0 +1,128 @@
+import logging
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+
+import click
+
+from mixed_io_cpu_task.gcs_emulator import (
+    OVER_LIMIT_MODES,
+    GcsEmulator,
+    NetworkConditions,
+)
+from mixed_io_cpu_task.logging_utils import configure_logger
+
+
+def _parse_object(value: str):
+    """Splits gs://bucket/name=PATH into bucket, name and the local path"""
+    uri, _, path = value.partition("=")
+    if not uri.startswith("gs://") or "/" not in uri[5:] or not path:
+        raise click.BadParameter(f"expected gs://bucket/name=PATH, got {value}")
+    bucket, name = uri[5:].split("/", 1)
+    return bucket, name, pathlib.Path(path)
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=9023, show_default=True, help="0 picks a free port")
+@click.option("--latency-ms", default=0.0, help="Delay before every response")
+@click.option("--jitter-ms", default=0.0, help="Latency varies uniformly by this much")
+@click.option(
+    "--bandwidth-mbps", default=0.0, help="MB/s shared by all transfers, 0 is unlimited"
+)
+@click.option(
+    "--stream-mbps", default=0.0, help="MB/s of a single transfer, 0 is unlimited"
+)
+@click.option(
+    "--max-concurrency", default=0, help="Requests served at once, 0 is unlimited"
+)
+@click.option(
+    "--over-limit",
+    type=click.Choice(OVER_LIMIT_MODES),
+    default="queue",
+    show_default=True,
+    help="Requests above the concurrency limit wait for a slot or get a 429",
+)
+@click.option("--rate-429", default=0.0, help="Share of requests answered with 429")
+@click.option("--rate-503", default=0.0, help="Share of requests answered with 503")
+@click.option("--seed", default=None, type=int, help="Seed of jitter and error draws")
+@click.option(
+    "--object",
+    "objects",
+    multiple=True,
+    help="Object stored before serving as gs://bucket/name=PATH, can be repeated",
+)
+@click.argument("benchmark_args", nargs=-1, type=click.UNPROCESSED)
+def gcs_emulator(
+    host: str,
+    port: int,
+    latency_ms: float,
+    jitter_ms: float,
+    bandwidth_mbps: float,
+    stream_mbps: float,
+    max_concurrency: int,
+    over_limit: str,
+    rate_429: float,
+    rate_503: float,
+    seed: int,
+    objects: tuple,
+    benchmark_args: tuple,
+):
+    """Serves an in-memory GCS with the given latency, bandwidth, concurrency limit
+    and error rates, so gs:// runs are reproducible without a real bucket.
+
+    Without a benchmark command it serves until interrupted, point clients at it
+    with STORAGE_EMULATOR_HOST. With one it runs the command against it and stops,
+    e.g.
+
+    benchmarks gcs-emulator --latency-ms 30 --bandwidth-mbps 50
+    --object gs://bench/IMG_3134.jpeg=IMG_3134.jpeg
+    -- multi gs://bench/IMG_3134.jpeg crops.csv gs://bench/results -r 50 -rm
+    """
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    configure_logger(logger, "gcs-emulator")
+    conditions = NetworkConditions(
+        latency_ms=latency_ms,
+        jitter_ms=jitter_ms,
+        bandwidth_mbps=bandwidth_mbps,
+        stream_mbps=stream_mbps,
+        max_concurrency=max_concurrency,
+        over_limit=over_limit,
+        rate_429=rate_429,
+        rate_503=rate_503,
+        seed=seed,
+    )
+    emulator = GcsEmulator(conditions, host=host, port=port)
+    for value in objects:
+        bucket, name, path = _parse_object(value)
+        emulator.put_object(bucket, name, path.read_bytes())
+        logger.info(f"Stored {path} as gs://{bucket}/{name}")
+
+    returncode = 0
+    with emulator:
+        if benchmark_args:
+            logger.info(f"benchmark {' '.join(benchmark_args)}")
+            returncode = subprocess.run(
+                [sys.executable, "-m", "mixed_io_cpu_task.commands", *benchmark_args],
+                env={**os.environ, "STORAGE_EMULATOR_HOST": emulator.endpoint},
+            ).returncode
+        else:
+            click.echo(f"export STORAGE_EMULATOR_HOST={emulator.endpoint}")
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+    stats = emulator.stats()
+    logger.info(
+        f"Requests {stats['requests']}, injected 429 {stats['injected_429']}, "
+        f"injected 503 {stats['injected_503']}, rejected {stats['rejected']}, "
+        f"aborted {stats['aborted']}, "
+        f"queued {stats['queued']}, max in flight {stats['max_in_flight']}, "
+        f"received {stats['bytes_in'] / 2**20:.1f} MB, "
+        f"sent {stats['bytes_out'] / 2**20:.1f} MB, objects {stats['objects']}"
+    )
+    if returncode:
+        raise click.ClickException(f"{benchmark_args[0]} exited with {returncode}")
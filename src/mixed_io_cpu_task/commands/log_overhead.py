@@ -0,0 +1,81 @@
+import logging
+import pathlib
+import statistics
+from typing import Dict, List
+
+import click
+
+from mixed_io_cpu_task.commands.bench import run_benchmark
+from mixed_io_cpu_task.commands.plot_logs import THROUGHPUT_PATTERN
+from mixed_io_cpu_task.logging_utils import configure_logger
+
+# benchmark options of every logging mode, on is the default queue transport
+LOG_MODES = {
+    "off": ["--log-level", "info"],
+    "on": [],
+    "batched": ["--log-transport", "batched"],
+    "files": ["--log-transport", "files"],
+    "sampled": ["--log-transport", "batched", "--log-sample", "10"],
+}
+
+
+def _run_benchmark(benchmark_args: List[str], own_log: pathlib.Path) -> float:
+    """Runs a benchmark command in a new process and returns img/s read from the
+    elapsed record of the log file it wrote"""
+    log_file = run_benchmark(benchmark_args, own_log)
+    with log_file.open() as f:
+        for line in reversed(f.readlines()):
+            if match := THROUGHPUT_PATTERN.search(line):
+                return float(match.group(1))
+    raise click.ClickException(f"no elapsed record in {log_file}")
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "--mode",
+    "modes",
+    multiple=True,
+    type=click.Choice(list(LOG_MODES)),
+    default=("off", "on", "batched", "files"),
+    show_default=True,
+    help="Logging modes to compare, serial only takes off and on",
+)
+@click.option("--trials", default=3, help="Runs of every mode, the median is reported")
+@click.argument("benchmark_args", nargs=-1, required=True, type=click.UNPROCESSED)
+def log_overhead(modes: tuple, trials: int, benchmark_args: tuple):
+    """Runs a benchmark command with every logging mode and reports its throughput and
+    the share of it logging costs compared to logging off, e.g.
+
+    benchmarks log-overhead -- multi IMG_3134.jpeg crops.csv results/ -r 50 -rm -e process
+
+    Trials of the modes are interleaved, so drift of the machine or the network hits
+    all modes alike.
+    """
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    configure_logger(logger, "log-overhead")
+    own_log = pathlib.Path("log-overhead.log")
+    logger.info(f"benchmark {' '.join(benchmark_args)}, modes {modes}")
+
+    speeds: Dict[str, List[float]] = {mode: [] for mode in modes}
+    for trial in range(trials):
+        for mode in modes:
+            speed = _run_benchmark([*benchmark_args, *LOG_MODES[mode]], own_log)
+            speeds[mode].append(speed)
+            logger.info(f"Trial {trial}, logging {mode}: {speed:.2f} img/s")
+
+    medians = {mode: statistics.median(values) for mode, values in speeds.items()}
+    baseline = medians.get("off")
+    lines = [f"{'logging':<10} {'img/s':>8} {'min':>8} {'max':>8} {'cost':>8}"]
+    for mode in modes:
+        cost = (
+            f"{100 * (1 - medians[mode] / baseline):>7.1f}%"
+            if baseline
+            else f"{'-':>8}"
+        )
+        lines.append(
+            f"{mode:<10} {medians[mode]:>8.2f} {min(speeds[mode]):>8.2f} "
+            f"{max(speeds[mode]):>8.2f} {cost}"
+        )
+    logger.info("Logging overhead:\n" + "\n".join(lines))
+    click.echo("\n".join(lines))
@@ -0,0 +1,69 @@
+import logging
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+
+import click
+
+from mixed_io_cpu_task.cropping import crop_with_pil
+from mixed_io_cpu_task.io_utils import configure_mmap_inputs, download_crops_and_image
+from mixed_io_cpu_task.logging_utils import configure_logger
+from mixed_io_cpu_task.memory_utils import peak_rss, reset_peak_rss
+
+
+def _measure_tasks(
+    input_image: str, crops: str, mmap_inputs: bool, num_repeats: int, threads: int
+):
+    """Loads and crops the image num_repeats times on threads in a fresh process and
+    returns task times and peak RSS growth"""
+    configure_mmap_inputs(mmap_inputs)
+    reset_peak_rss()
+    baseline_rss = peak_rss()
+
+    def task(trace_id: int) -> float:
+        start = time.perf_counter()
+        image_buffer, crops_to_cut = download_crops_and_image(
+            crops, input_image, trace_id=str(trace_id)
+        )
+        crop_with_pil(image_buffer, crops_to_cut, trace_id=str(trace_id))
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(threads) as executor:
+        times = list(executor.map(task, range(num_repeats)))
+    return times, peak_rss() - baseline_rss
+
+
+@click.command()
+@click.argument("input_image", type=click.Path(exists=True, path_type=str))
+@click.argument("crops", type=click.Path(exists=True, path_type=str))
+@click.option("--num-repeats", "-r", default=32, help="Number of tasks per mode")
+@click.option("--threads", default=8, help="Tasks loading and cropping at once")
+def mmap_benchmark(input_image: str, crops: str, num_repeats: int, threads: int):
+    """Compares peak RSS and task time of local inputs copied into every task and
+    served from shared read-only mappings (--mmap-inputs)"""
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    configure_logger(logger, "mmap-benchmark")
+    logger.info(f"input image {input_image}, input crops {crops}")
+    logger.info(f"{num_repeats} tasks on {threads} threads per mode")
+
+    results = {}
+    for mode, mmap_inputs in (("copy", False), ("mmap", True)):
+        # every mode runs in a fresh process with its own peak RSS
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            times, rss_growth = executor.submit(
+                _measure_tasks, input_image, crops, mmap_inputs, num_repeats, threads
+            ).result()
+        results[mode] = statistics.median(times), rss_growth
+        logger.info(
+            f"{mode} inputs: median task {statistics.median(times) * 1000:.1f} ms, "
+            f"peak RSS +{rss_growth / 2**20:.1f} MB"
+        )
+
+    (copy_time, copy_rss), (mmap_time, mmap_rss) = results["copy"], results["mmap"]
+    logger.info(
+        f"mmap inputs save {(copy_rss - mmap_rss) / 2**20:.1f} MB peak RSS "
+        f"({(1 - mmap_rss / copy_rss) * 100 if copy_rss else 0:.0f}%) and "
+        f"{(copy_time - mmap_time) * 1000:.1f} ms per task with {threads} threads"
+    )
@@ -0,0 +1,302 @@
+import logging
+import os
+import pathlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+
+import PIL
+import click
+import numpy as np
+from tqdm import tqdm
+
+from mixed_io_cpu_task.cache import merge_stats
+from mixed_io_cpu_task.commands.common_options import (
+    configure_from_options,
+    crop_options,
+    io_options,
+    log_filename,
+    logging_options,
+    output_options,
+    task_options,
+    upload_pool_options,
+)
+from mixed_io_cpu_task.commands.concurrency import (
+    start_logging,
+    stop_logging,
+    worker_process_initializer,
+)
+from mixed_io_cpu_task.cropping import (
+    crop_with_pil,
+    crop_path_stats,
+    encode_stats,
+    describe_encode_stats,
+    decoded_images,
+)
+from mixed_io_cpu_task.io_utils import (
+    download_crops_and_image,
+    save_image_buffers_with_threadpool,
+    remove_dir,
+    download_cache,
+    upload_pool_stats,
+    describe_upload_stats,
+    download_throughput_stats,
+    describe_download_throughput,
+    close_packed_output,
+    packed_output_stats,
+    describe_packed_output,
+)
+from mixed_io_cpu_task.logging_utils import LOG_LEVELS, LogOptions
+from mixed_io_cpu_task.manifest import Task, iter_tasks
+from mixed_io_cpu_task.memory_utils import peak_rss
+from mixed_io_cpu_task.retry import retry_stats
+from mixed_io_cpu_task.spans import (
+    describe_span_summary,
+    merge_span_samples,
+    pop_span_samples,
+    span_summary,
+)
+from mixed_io_cpu_task.stages import DONE, QueueMonitor, Stage
+
+
+def crop_task(image: bytes, crops_to_cut: np.ndarray, trace_id, roi_decode):
+    """Crops and encodes an image in a crop worker, encoded crops are sent back as bytes
+    together with decoded cache, crop path and encode stats of the worker"""
+    buffers = crop_with_pil(
+        BytesIO(image), crops_to_cut, trace_id=trace_id, roi_decode=roi_decode
+    )
+    encoded = [buffer.getvalue() for buffer in buffers]
+    stats = {
+        "decoded": decoded_images.stats(),
+        "crop_paths": crop_path_stats(),
+        "encode": encode_stats(),
+        "spans": pop_span_samples(),
+    }
+    return encoded, os.getpid(), stats
+
+
+@click.command()
+@task_options
+@click.option(
+    "--download-workers",
+    type=int,
+    default=None,
+    help="Threads downloading images and crops, defaults to CPU count / 2 + 4",
+)
+@click.option(
+    "--crop-workers",
+    type=int,
+    default=None,
+    help="Workers cropping and encoding images, defaults to CPU count / 2",
+)
+@click.option(
+    "--upload-workers",
+    type=int,
+    default=None,
+    help="Threads saving encoded crops, defaults to CPU count / 2 + 4",
+)
+@click.option(
+    "--crop-executor",
+    default="process",
+    help="Executor of the crop stage",
+    type=click.Choice(["thread", "process"]),
+)
+@click.option(
+    "--queue-size",
+    type=int,
+    default=None,
+    help="Capacity of every queue between stages in images, "
+    "defaults to twice the crop workers",
+)
+@io_options
+@crop_options
+@output_options
+@upload_pool_options
+@logging_options(
+    "How records of workers reach the log file: a queue record by record, "
+    "batched lists of records or a file per process merged after the run"
+)
+def pipeline(
+    input_image: str,
+    crops: str,
+    output_dir: str,
+    num_repeats: int,
+    remove: bool,
+    manifest: str,
+    download_workers: int,
+    crop_workers: int,
+    upload_workers: int,
+    crop_executor: str,
+    queue_size: int,
+    roi_decode: bool,
+    log_level: str,
+    log_sample: int,
+    log_transport: str,
+    **process_options,
+):
+    """Runs download, crop and upload as separate stages connected by bounded queues"""
+    options = configure_from_options(**process_options)
+    logging.basicConfig()
+    logger = logging.getLogger("default")
+    log_options = LogOptions(
+        log_transport,
+        LOG_LEVELS[log_level],
+        log_sample,
+        log_filename(f"pipeline-{crop_executor}", options, output_dir),
+    )
+    logging_queue, logging_process = start_logging(logger, log_options)
+
+    logger.debug(f"PIL: {PIL.__version__}")
+    logger.debug(f"NumPy: {np.__version__}")
+    logger.info(f"input image {input_image}, input crops {crops}, manifest {manifest}")
+    logger.info(f"Crop engine: {options.engine}")
+    logger.info(f"Output encoding: {options.encoding.describe()}")
+    logger.info(
+        f"Logging: {log_transport} transport, {log_level} level, "
+        f"1 in {log_sample} traces"
+    )
+
+    # cleanup old data
+    if remove:
+        logger.debug(f"Removing output dir {output_dir}")
+        remove_dir(output_dir)
+    if not output_dir.startswith("gs://"):
+        pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
+
+    download_workers = download_workers or os.cpu_count() // 2 + 4
+    crop_workers = crop_workers or max(1, os.cpu_count() // 2)
+    upload_workers = upload_workers or os.cpu_count() // 2 + 4
+    queue_size = queue_size or 2 * crop_workers
+    logger.info(
+        f"CPU count: {os.cpu_count()}, will use {download_workers} download threads, "
+        f"{crop_workers} crop workers with {crop_executor} executor, "
+        f"{upload_workers} upload threads and queues of {queue_size} images"
+    )
+
+    if crop_executor == "process":
+        # crop workers neither download nor upload, the download cache stays off
+        crop_pool = ProcessPoolExecutor(
+            crop_workers,
+            initializer=worker_process_initializer,
+            initargs=(logging_queue, options._replace(cache_size_mb=0), log_options),
+        )
+    else:
+        # threads share the decoded image cache and the encode pool configured above
+        crop_pool = ThreadPoolExecutor(crop_workers)
+
+    worker_stats = {}
+    span_samples = {}
+    lock = threading.Lock()
+    progress = tqdm(total=None if manifest else num_repeats)
+
+    def download(task: Task):
+        image_buffer, crops_to_cut = download_crops_and_image(
+            task.crops_path, task.image_path, trace_id=task.trace_id
+        )
+        return task, image_buffer, crops_to_cut
+
+    def crop(item):
+        task, image_buffer, crops_to_cut = item
+        # every crop thread keeps a single crop worker busy
+        encoded, pid, stats = crop_pool.submit(
+            crop_task,
+            image_buffer.getvalue(),
+            crops_to_cut,
+            task.trace_id,
+            roi_decode,
+        ).result()
+        with lock:
+            worker_stats[pid] = stats
+            merge_span_samples([stats["spans"]], span_samples)
+        return task, [BytesIO(data) for data in encoded]
+
+    def upload(item):
+        task, buffers = item
+        save_image_buffers_with_threadpool(
+            buffers, task.output_dir, trace_id=task.trace_id, max_threads=1
+        )
+        progress.update(1)
+
+    tasks = queue.Queue(maxsize=queue_size)
+    downloaded = queue.Queue(maxsize=queue_size)
+    cropped = queue.Queue(maxsize=queue_size)
+    stages = [
+        Stage("download", download, download_workers, tasks, downloaded),
+        Stage("crop", crop, crop_workers, downloaded, cropped),
+        Stage("upload", upload, upload_workers, cropped),
+    ]
+    monitor = QueueMonitor(
+        {"tasks": tasks, "downloaded": downloaded, "cropped": cropped}
+    )
+
+    # start benchmark
+    start = time.perf_counter()
+    monitor.start()
+    for stage in stages:
+        stage.start()
+    # blocks while the download stage is behind, a long manifest is never read ahead
+    for task in iter_tasks(input_image, crops, output_dir, num_repeats, manifest):
+        tasks.put(task)
+    tasks.put(DONE)
+    for stage in stages:
+        stage.join()
+    close_packed_output()
+    elapsed = time.perf_counter() - start
+    monitor.stop()
+    crop_pool.shutdown()
+    progress.close()
+    if crop_executor != "process":
+        # crop threads report the counters of this process out of order
+        worker_stats = {
+            os.getpid(): {
+                "decoded": decoded_images.stats(),
+                "crop_paths": crop_path_stats(),
+                "encode": encode_stats(),
+            }
+        }
+
+    # keep the elapsed message last, plot-logs reads the average speed from it
+    for stage in stages:
+        stats = stage.stats(elapsed)
+        logger.info(
+            f"Stage {stage.name}: {stats['workers']} workers, {stats['items']} images, "
+            f"{stats['errors']} errors, utilization {stats['utilization']:.0%}"
+        )
+    for name, stats in monitor.stats().items():
+        logger.info(
+            f"Queue {name}: mean depth {stats['mean_depth']:.1f}, "
+            f"max depth {stats['max_depth']} of {stats['capacity']}"
+        )
+    logger.info(f"Download cache stats: {download_cache.stats()}")
+    decoded_stats = merge_stats(stats["decoded"] for stats in worker_stats.values())
+    logger.info(f"Decoded image cache stats: {decoded_stats}")
+    if options.lossless_crops != "off":
+        crop_paths = merge_stats(s["crop_paths"] for s in worker_stats.values())
+        logger.info(f"Crop paths: {crop_paths}")
+    encoded = merge_stats(stats["encode"] for stats in worker_stats.values())
+    logger.info(f"Encode stats: {describe_encode_stats(encoded)}")
+    if options.upload_pool_size:
+        logger.info(f"Upload pool stats: {describe_upload_stats(upload_pool_stats())}")
+    logger.info(f"GCS retry stats: {retry_stats()}")
+    logger.info(
+        f"Download throughput: {describe_download_throughput(download_throughput_stats())}"
+    )
+    if options.packed_output:
+        packed = packed_output_stats(output_dir)
+        logger.info(f"Packed output: {describe_packed_output(packed)}")
+    logger.info(f"Peak RSS: {peak_rss() / 2**20:.1f} MB")
+    merge_span_samples([pop_span_samples()], span_samples)
+    spans = span_summary(span_samples)
+    logger.info(
+        f"Stage latency: {describe_span_summary(spans)}", extra={"spans": spans}
+    )
+    num_images = stages[-1].items
+    logger.info(
+        f"Elapsed {elapsed:.2f} seconds, average {num_images/elapsed:.2f} img/s"
+    )
+    stop_logging(logger, log_options, logging_queue, logging_process)
+    errors = [error for stage in stages for error in stage.errors]
+    if errors:
+        raise errors[0]
@@ -1,29 +1,87 @@
+import json
+import math
 import pathlib
+import re
+from typing import List, Optional, Tuple
 
 import click
+import distinctipy
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import json
-import distinctipy
+from pandas.api.types import union_categoricals
+
+from mixed_io_cpu_task.spans import span_summary
+
+# bytes of log read and parsed at once
+CHUNK_BYTES = 64 * 2**20
+# plotted messages are cut to this many characters
+MESSAGE_LENGTH = 100
+# fields of a log record written by configure_logger, in the order the json formatter
+# writes them, span fields follow trace_id in span records
+LINE_PATTERN = re.compile(
+    rb'^\{"asctime": "([^"]+)", "levelname": "[^"]*", "name": "[^"]*", '
+    rb'"message": "([^"\\]*(?:\\.[^"\\]*)*)"'
+    rb'(?:, "trace_id": "?([^",}]*)"?)?'
+    rb'(?:, "span": "([^"]*)", "start": ([^,]+), "end": ([^,]+))?',
+    re.MULTILINE,
+)
+THROUGHPUT_PATTERN = re.compile(r"average ([0-9.]+) img/s")
 
 
 @click.command()
 @click.argument("input_log_file", type=click.Path(path_type=pathlib.Path))
 @click.option("--plot-file-name", "-p", type=str, default=None)
-def plot_logs(input_log_file: pathlib.Path, plot_file_name: str = None):
+@click.option(
+    "--kind",
+    type=click.Choice(["scatter", "gantt"]),
+    default="scatter",
+    help="scatter plots every log record of a trace colored by message, gantt draws "
+    "a bar from start to end of every timing span",
+)
+@click.option(
+    "--max-points",
+    default=200_000,
+    help="Records plotted per log file, whole traces are dropped evenly above it",
+)
+def plot_logs(
+    input_log_file: pathlib.Path,
+    plot_file_name: str = None,
+    kind: str = "scatter",
+    max_points: int = 200_000,
+):
+    """Plots records of every trace of a log file, or of every file matching a glob
+    on vertically stacked subplots, and saves a summary table of throughput and
+    stage latency percentiles next to the image"""
     if "*" in str(input_log_file):
         glob_pattern = str(input_log_file.name)
         input_log_file = pathlib.Path(input_log_file).parent
         log_files = sorted(input_log_file.glob(glob_pattern))
         # filter out empty log files
         log_files = [log_file for log_file in log_files if log_file.stat().st_size != 0]
-        fig, axarr = plt.subplots(len(log_files), sharex=True, figsize=(15, 20))
-        for log_file, ax in zip(log_files, axarr):
-            # plot every file on a separate subplots vertically but keep them in the same figure sharing x-axis
-            # plot labels only on the last subplot
-            _plot_file(log_file, ax=ax, labels=log_file == log_files[0])
-        # set x-axis label
-        axarr[-1].set_xlabel("seconds")
+        filename = plot_file_name or f"{input_log_file.parent.stem}.png"
+    else:
+        log_files = [input_log_file]
+        filename = plot_file_name or f"{input_log_file.stem}.png"
+    if not log_files:
+        raise click.UsageError(f"no log files match {input_log_file}")
+    # plot every file on a separate subplot but keep them in the same figure sharing
+    # x-axis, labels are only added on the first subplot
+    fig, axarr = plt.subplots(
+        len(log_files),
+        sharex=True,
+        squeeze=False,
+        figsize=(15, 20) if len(log_files) > 1 else None,
+    )
+    axarr = axarr[:, 0]
+    summaries = []
+    for log_file, ax in zip(log_files, axarr):
+        df, throughput = read_log(log_file)
+        _plot_records(df, ax, kind, max_points, labels=log_file == log_files[0])
+        ax.set_title(f"{log_file.name} : {throughput}")
+        summaries.append(_summary_table(log_file, df, throughput))
+    axarr[-1].set_xlabel("seconds")
+    if len(log_files) > 1:
         # add legend on the right
         fig.subplots_adjust(right=0.8)
         axarr[0].legend(
@@ -32,79 +90,251 @@ def plot_logs(input_log_file: pathlib.Path, plot_file_name: str = None):
             fancybox=False,
             shadow=False,
         )
-        filename = plot_file_name or f"{input_log_file.parent.stem}.png"
-        plt.savefig(filename)
-    else:
-        _plot_file(input_log_file)
-        filename = plot_file_name or f"{input_log_file.stem}.png"
-        plt.savefig(filename)
+    plt.savefig(filename)
 
+    summary = pd.concat(summaries, ignore_index=True)
+    if "count" in summary:
+        # logs without spans leave the count of their row empty
+        summary["count"] = summary["count"].astype("Int64")
+    summary_filename = (
+        pathlib.Path(filename).with_suffix("").as_posix() + "-summary.csv"
+    )
+    summary.to_csv(summary_filename, index=False)
+    click.echo(summary.to_string(index=False))
 
-def _plot_file(input_log_file: pathlib.Path, ax=None, labels=False):
-    if ax is None:
-        _, ax = plt.subplots()
 
-    with input_log_file.open() as f:
-        records = [json.loads(line) for line in f]
-    if not records:
-        return
-    # df contains columns asctime levelname name message trace_id
-    df = pd.DataFrame.from_records(records)
-    df = df.drop_duplicates()
+def read_log(input_log_file: pathlib.Path) -> Tuple[pd.DataFrame, str]:
+    """Streams a json log file in chunks and returns its records with a trace_id and
+    the message with the average speed of the run.
 
-    # average speed is recorded int the last message
-    average_speed = df["message"].iloc[-1]
+    Records hold time (seconds from asctime), message (categorical, cut to
+    MESSAGE_LENGTH characters), trace_id (categorical) and for timing spans span,
+    start, end and duration, only these fields are ever held in memory.
+    """
+    frames = []
+    throughput = ""
+    with input_log_file.open("rb") as f:
+        rest = b""
+        while True:
+            data = f.read(CHUNK_BYTES)
+            chunk = rest + data
+            if data:
+                end = chunk.rfind(b"\n") + 1
+                chunk, rest = chunk[:end], chunk[end:]
+            if chunk:
+                frame, chunk_throughput = _parse_chunk(chunk)
+                frames.append(frame)
+                throughput = chunk_throughput or throughput
+            if not data:
+                break
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return _records_frame([]), throughput
+    df = pd.DataFrame(
+        {
+            column: (
+                union_categoricals([frame[column] for frame in frames])
+                if isinstance(frames[0][column].dtype, pd.CategoricalDtype)
+                else np.concatenate([frame[column].to_numpy() for frame in frames])
+            )
+            for column in frames[0].columns
+        }
+    )
+    df["time"] -= df["time"].min()
+    return df, throughput
 
-    # drop rows without trace_id
-    if "trace_id" not in df.columns:
-        return
-    df = df.dropna(subset=["trace_id"])
-    # convert timestamp to datetime
-    # asctime example "2023-10-09 08:09:54,867"
-    df["asctime"] = pd.to_datetime(df["asctime"].values, format="%Y-%m-%d %H:%M:%S,%f")
-    df["asctime"] = df["asctime"].map(lambda x: x.timestamp())
-
-    # nomalize time to start from 0
-    df["asctime"] = df["asctime"] - df["asctime"].min()
-    single_trace_id = list(set(df["trace_id"]))[0]
-
-    # cut message to 100 characters
-    df["message"] = df["message"].map(lambda x: x[:100])
-    # assign different color to every message
-    available_colors = distinctipy.get_colors(len(df["message"].unique()), rng=42)
-    message_to_color = dict(zip(df["message"].unique(), available_colors))
-    df["color"] = df["message"].map(message_to_color)
 
+def _parse_chunk(chunk: bytes) -> Tuple[pd.DataFrame, str]:
+    """Parses whole lines of a log into records with a trace_id, lines written by
+    another formatter than configure_logger's are parsed as json"""
+    rows = LINE_PATTERN.findall(chunk)
+    if len(rows) != chunk.count(b"\n") + (not chunk.endswith(b"\n")):
+        rows = [_json_row(line) for line in chunk.splitlines() if line.strip()]
+    throughput = next(
+        (row[1].decode() for row in reversed(rows) if row[1].startswith(b"Elapsed")),
+        "",
+    )
+    return _records_frame([row for row in rows if row[2]]), throughput
+
+
+def _json_row(line: bytes) -> Tuple[bytes, ...]:
+    record = json.loads(line)
+    row = [
+        record.get("asctime", ""),
+        record.get("message", ""),
+        record.get("trace_id", ""),
+        record.get("span", ""),
+        record.get("start", ""),
+        record.get("end", ""),
+    ]
+    return tuple(
+        str("" if value is None else value).encode("ascii", "backslashreplace")
+        for value in row
+    )
+
+
+def _records_frame(rows: List[Tuple[bytes, ...]]) -> pd.DataFrame:
+    """Returns columns of (asctime, message, trace_id, span, start, end) rows"""
+    asctime, message, trace_id, stage, start, end = zip(*rows) if rows else [()] * 6
+    start, end = _to_float(start), _to_float(end)
+    return pd.DataFrame(
+        {
+            "time": _asctime_seconds(np.array(asctime, dtype="S23")),
+            "message": _categorical(message, MESSAGE_LENGTH),
+            "trace_id": _categorical(trace_id),
+            "span": _categorical(stage),
+            "start": start,
+            "end": end,
+            "duration": end - start,
+        }
+    )
+
+
+def _categorical(values: tuple, length: Optional[int] = None) -> pd.Categorical:
+    """Factorizes raw bytes and only decodes the distinct values, cut to length"""
+    codes, uniques = pd.factorize(np.array(values, dtype=object))
+    names = [value[:length].decode("utf-8", "backslashreplace") for value in uniques]
+    # values equal in their first length characters become one category
+    name_codes, names = pd.factorize(np.array(names, dtype=object))
+    return pd.Categorical.from_codes(name_codes[codes], names.astype(str))
+
+
+def _asctime_seconds(asctime: np.ndarray) -> np.ndarray:
+    """Converts asctime strings like "2023-10-09 08:09:54,867" to seconds since the
+    epoch, the digits of every field are combined with array arithmetic"""
+    digits = asctime.view(np.uint8).reshape(-1, 23).astype(np.int64) - ord("0")
+
+    def field(first: int, last: int) -> np.ndarray:
+        value = np.zeros(len(asctime), dtype=np.int64)
+        for i in range(first, last):
+            value = value * 10 + digits[:, i]
+        return value
+
+    months = (field(0, 4) - 1970) * 12 + field(5, 7) - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    days += field(8, 10) - 1
+    return (
+        days * 86400
+        + field(11, 13) * 3600
+        + field(14, 16) * 60
+        + field(17, 19)
+        + field(20, 23) / 1000
+    )
+
+
+def _to_float(values: tuple) -> np.ndarray:
+    values = np.array(values, dtype="S32")
+    values[values == b""] = b"nan"
+    return values.astype(np.float64)
+
+
+def _downsample(df: pd.DataFrame, max_points: int) -> Tuple[pd.DataFrame, int]:
+    """Keeps every n-th trace so at most about max_points records are left"""
+    step = math.ceil(len(df) / max_points) if max_points else 1
+    if step <= 1:
+        return df, 1
+    codes = df["trace_id"].cat.codes.to_numpy()
+    return df[codes % step == 0], step
+
+
+def _plot_records(
+    df: pd.DataFrame, ax, kind: str, max_points: int, labels: bool = False
+):
+    if df.empty:
+        return
+    df, step = _downsample(df, max_points)
     # assign unique category code to every trace id
-    df["y"] = df["trace_id"].astype("category").cat.codes
-
-    # df = df.sort_values(by=["y", "asctime"])
-    # group by trace id and plot
-    for trace_id, group in df.groupby("trace_id"):
-        # sort by asctime
-        for _, point in group.iterrows():
-            message = point["message"]
-            # break message into lines if longer than 50 characters
-            if len(message) > 30:
-                message = "\n".join(
-                    [message[i : i + 50] for i in range(0, len(message), 50)]
-                )
-            ax.scatter(
-                point["asctime"],
-                point["y"],
-                color=point["color"],
-                label=message if labels and trace_id == single_trace_id else None,
-            )
-        # draw dashed line from min to max asctime
-        ax.plot(
-            [group["asctime"].min(), group["asctime"].max()],
-            [point["y"], point["y"]],
-            linestyle=":",
-            color="black",
-            linewidth=0.5,
+    y = df["trace_id"].cat.codes.to_numpy()
+    spans = df[df["span"] != ""]
+    if kind == "gantt" and len(spans):
+        _plot_gantt(spans, ax, labels)
+    else:
+        _plot_scatter(df, y, ax, labels)
+    if step > 1:
+        ax.text(
+            0.99,
+            0.01,
+            f"every {step}th trace shown",
+            transform=ax.transAxes,
+            ha="right",
+            va="bottom",
         )
-    # set plot title to log file name
-    ax.set_title(f"{input_log_file.name} : {average_speed}")
     # add grids and subgrids
     ax.grid()
     ax.set_ylabel("trace id")
+
+
+def _plot_scatter(df: pd.DataFrame, y: np.ndarray, ax, labels: bool):
+    """Draws one scatter per message and a dotted line over the time of every trace"""
+    messages = df["message"].cat.remove_unused_categories()
+    # assign different color to every message
+    colors = distinctipy.get_colors(len(messages.cat.categories), rng=42)
+    codes = messages.cat.codes.to_numpy()
+    time = df["time"].to_numpy()
+    for code, (message, color) in enumerate(zip(messages.cat.categories, colors)):
+        selected = codes == code
+        if len(message) > 30:
+            # break message into lines of 50 characters
+            message = "\n".join(
+                [message[i : i + 50] for i in range(0, len(message), 50)]
+            )
+        ax.scatter(
+            time[selected],
+            y[selected],
+            color=color,
+            s=8,
+            label=message if labels else None,
+        )
+    # draw dashed line from min to max time of every trace
+    bounds = df.groupby(y)["time"].agg(["min", "max"])
+    ax.hlines(
+        bounds.index,
+        bounds["min"],
+        bounds["max"],
+        linestyles=":",
+        colors="black",
+        linewidth=0.5,
+    )
+
+
+def _plot_gantt(spans: pd.DataFrame, ax, labels: bool):
+    """Draws every span as a bar of its trace from its start to its end, one line
+    collection per stage"""
+    stages = spans["span"].cat.remove_unused_categories()
+    colors = distinctipy.get_colors(len(stages.cat.categories), rng=42)
+    codes = stages.cat.codes.to_numpy()
+    y = spans["trace_id"].cat.codes.to_numpy()
+    origin = spans["start"].min()
+    start = spans["start"].to_numpy() - origin
+    end = spans["end"].to_numpy() - origin
+    for code, (stage, color) in enumerate(zip(stages.cat.categories, colors)):
+        selected = codes == code
+        ax.hlines(
+            y[selected],
+            start[selected],
+            end[selected],
+            colors=[color],
+            linewidth=4,
+            label=stage if labels else None,
+        )
+
+
+def _summary_table(
+    log_file: pathlib.Path, df: pd.DataFrame, throughput: str
+) -> pd.DataFrame:
+    """Returns one row per stage with the run throughput and count and p50, p95 and
+    p99 latency of the spans of the stage"""
+    match = THROUGHPUT_PATTERN.search(throughput)
+    img_s = float(match.group(1)) if match else math.nan
+    spans = df[df["span"] != ""]
+    samples = {
+        stage: durations.to_numpy()
+        for stage, durations in spans.groupby("span", observed=True)["duration"]
+    }
+    rows: List[dict] = [
+        {"log": log_file.name, "img_s": img_s, "stage": stage, **stats}
+        for stage, stats in span_summary(samples).items()
+    ]
+    if not rows:
+        rows = [{"log": log_file.name, "img_s": img_s, "stage": None}]
+    return pd.DataFrame(rows)
@@ -5,43 +5,83 @@ import time
 import PIL
 import click
 import numpy as np
-from tqdm import trange
+from tqdm import tqdm
 
-from mixed_io_cpu_task.cropping import crop_with_pil
+from mixed_io_cpu_task.commands.common_options import (
+    configure_from_options,
+    crop_options,
+    io_options,
+    log_filename,
+    logging_options,
+    output_options,
+    task_options,
+)
+from mixed_io_cpu_task.cropping import (
+    crop_with_pil,
+    crop_path_stats,
+    encode_stats,
+    describe_encode_stats,
+    decoded_images,
+)
 from mixed_io_cpu_task.io_utils import (
     download_crops_and_image,
     save_image_buffers_with_threadpool,
     remove_dir,
+    download_cache,
+    download_throughput_stats,
+    describe_download_throughput,
+    close_packed_output,
+    packed_output_stats,
+    describe_packed_output,
+)
+from mixed_io_cpu_task.manifest import iter_tasks
+from mixed_io_cpu_task.memory_utils import peak_rss
+from mixed_io_cpu_task.retry import retry_stats
+from mixed_io_cpu_task.spans import (
+    describe_span_summary,
+    pop_span_samples,
+    span_summary,
 )
 
-from mixed_io_cpu_task.logging_utils import configure_logger
+from mixed_io_cpu_task.logging_utils import (
+    configure_logger,
+    LOG_LEVELS,
+    configure_log_sampling,
+)
 
 
 @click.command()
-@click.argument("input_image", type=click.Path(path_type=str))
-@click.argument("crops", type=click.Path(path_type=str))
-@click.argument("output_dir", type=click.Path(path_type=str))
-@click.option("--num-repeats", "-r", default=1, help="Number of repeats")
-@click.option("--remove", "-rm", is_flag=True, help="Remove output dir before running")
+@task_options
+@io_options
+@crop_options
+@output_options
+@logging_options()
 def serial(
     input_image: str,
     crops: str,
     output_dir: str,
     num_repeats: int,
     remove: bool,
+    manifest: str,
+    roi_decode: bool,
+    log_level: str,
+    log_sample: int,
+    **process_options,
 ):
+    options = configure_from_options(**process_options)
     # setup logging
     logging.basicConfig()
     logger = logging.getLogger("default")
-    log_filename = "serial"
-    if "gs://" in output_dir:
-        log_filename += "-remote"
-    else:
-        log_filename += "-local"
-    configure_logger(logger, log_filename)
+    configure_logger(
+        logger, log_filename("serial", options, output_dir), LOG_LEVELS[log_level]
+    )
+    configure_log_sampling(log_sample)
     logger.debug(f"PIL: {PIL.__version__}")
     logger.debug(f"NumPy: {np.__version__}")
-    logger.info(f"input image {input_image}, input crops {crops}")
+    logger.info(f"input image {input_image}, input crops {crops}, manifest {manifest}")
+    logger.info(f"Crop engine: {options.engine}")
+    logger.info(f"Output encoding: {options.encoding.describe()}")
+    logger.info(f"Logging: {log_level} level, 1 in {log_sample} traces")
 
     # cleanup old data
     if remove:
@@ -51,16 +91,40 @@ def serial(
         pathlib.Path(output_dir).mkdir(exist_ok=True, parents=True)
     # start benchmark
     start = time.perf_counter()
-    for i in trange(num_repeats):
+    tasks = iter_tasks(input_image, crops, output_dir, num_repeats, manifest)
+    num_images = 0
+    for task in tqdm(tasks, total=None if manifest else num_repeats):
         image_buffer, crops_to_cut = download_crops_and_image(
-            crops, input_image, trace_id=str(i)
+            task.crops_path, task.image_path, trace_id=task.trace_id
+        )
+        buffers = crop_with_pil(
+            image_buffer, crops_to_cut, trace_id=task.trace_id, roi_decode=roi_decode
         )
-        buffers = crop_with_pil(image_buffer, crops_to_cut, trace_id=str(i))
         save_image_buffers_with_threadpool(
-            buffers, output_dir, trace_id=str(i), max_threads=1
+            buffers, task.output_dir, trace_id=task.trace_id, max_threads=1
         )
+        num_images += 1
+    close_packed_output()
 
     elapsed = time.perf_counter() - start
+    # keep the elapsed message last, plot-logs reads the average speed from it
+    logger.info(f"Download cache stats: {download_cache.stats()}")
+    logger.info(f"Decoded image cache stats: {decoded_images.stats()}")
+    if options.lossless_crops != "off":
+        logger.info(f"Crop paths: {crop_path_stats()}")
+    logger.info(f"Encode stats: {describe_encode_stats(encode_stats())}")
+    logger.info(f"GCS retry stats: {retry_stats()}")
+    logger.info(
+        f"Download throughput: {describe_download_throughput(download_throughput_stats())}"
+    )
+    if options.packed_output:
+        packed = packed_output_stats(output_dir)
+        logger.info(f"Packed output: {describe_packed_output(packed)}")
+    logger.info(f"Peak RSS: {peak_rss() / 2**20:.1f} MB")
+    spans = span_summary(pop_span_samples())
+    logger.info(
+        f"Stage latency: {describe_span_summary(spans)}", extra={"spans": spans}
+    )
     logger.info(
-        f"Elapsed {elapsed:.2f} seconds, average {num_repeats/elapsed:.2f} img/s"
+        f"Elapsed {elapsed:.2f} seconds, average {num_images/elapsed:.2f} img/s"
     )
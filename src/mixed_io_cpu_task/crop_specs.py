@@ -0,0 +1,129 @@
+import itertools
+import warnings
+from typing import Iterable, Iterator, List, Sequence, Tuple, Union
+
+import numpy as np
+
+# one crop rectangle, 8 bytes per crop instead of a tuple of 4 Python ints, JPEG
+# stores image dimensions as 16 bit integers so every crop of a JPEG fits
+CROP_DTYPE = np.dtype([("x", "<u2"), ("y", "<u2"), ("w", "<u2"), ("h", "<u2")])
+MAX_COORDINATE = np.iinfo(np.uint16).max
+# header names accepted for every field of CROP_DTYPE, other columns are ignored
+COLUMN_ALIASES = {
+    "x": ("x", "left"),
+    "y": ("y", "top"),
+    "w": ("w", "width"),
+    "h": ("h", "height"),
+}
+# rows parsed at once when streaming a crops file
+CHUNK_ROWS = 2**16
+
+CropSpecs = Union[np.ndarray, Sequence[Tuple[int, int, int, int]]]
+
+
+def as_crop_array(crops: CropSpecs) -> np.ndarray:
+    """Returns crops as a CROP_DTYPE structured array without copying arrays"""
+    if isinstance(crops, np.ndarray) and crops.dtype == CROP_DTYPE:
+        return crops
+    array = np.asarray(crops, dtype=np.int64).reshape(-1, 4)
+    return _to_structured(array)
+
+
+def _to_structured(array: np.ndarray, offset: int = 0) -> np.ndarray:
+    """Checks (n, 4) x, y, w, h rows and converts them into a CROP_DTYPE array, offset
+    is the index of the first row in the whole file"""
+    x, y, w, h = array.T
+    invalid = (x < 0) | (y < 0) | (w <= 0) | (h <= 0)
+    if invalid.any():
+        _raise_invalid(array, invalid, offset, "have negative offsets or empty size")
+    too_large = (x + w > MAX_COORDINATE) | (y + h > MAX_COORDINATE)
+    if too_large.any():
+        _raise_invalid(
+            array, too_large, offset, f"reach beyond {MAX_COORDINATE} pixels"
+        )
+    specs = np.empty(len(array), dtype=CROP_DTYPE)
+    for i, name in enumerate(CROP_DTYPE.names):
+        specs[name] = array[:, i]
+    return specs
+
+
+def _header_columns(line: str) -> List[int]:
+    """Returns column index of x, y, w and h named in the header line"""
+    names = [name.strip().lower() for name in line.split(",")]
+    columns = []
+    for field, aliases in COLUMN_ALIASES.items():
+        matches = [i for i, name in enumerate(names) if name in aliases]
+        if not matches:
+            raise ValueError(
+                f"crops header {line.strip()!r} has no {field} column, "
+                f"expected one of {aliases}"
+            )
+        columns.append(matches[0])
+    return columns
+
+
+def iter_crop_spec_chunks(
+    lines: Iterable[str], chunk_rows: int = CHUNK_ROWS
+) -> Iterator[np.ndarray]:
+    """Parses crops csv lines into CROP_DTYPE arrays of at most chunk_rows crops.
+
+    The first line is a header mapping x / left, y / top, w / width and h / height to
+    columns in any order, a file starting with a numeric row is read as x,y,w,h.
+    Blank lines are skipped and every chunk is checked for negative coordinates,
+    empty crops and crops beyond the largest JPEG, so a file of millions of crops is
+    never held as a list of lines or tuples.
+    """
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    if first.split(",")[0].strip().lstrip("-").isdigit():
+        columns = [0, 1, 2, 3]
+        lines = itertools.chain([first], lines)
+    else:
+        columns = _header_columns(first)
+    parsed_rows = 0
+    while True:
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if not chunk:
+            return
+        with warnings.catch_warnings():
+            # a chunk of blank lines only
+            warnings.simplefilter("ignore", UserWarning)
+            array = np.loadtxt(
+                chunk, delimiter=",", dtype=np.int64, usecols=columns, ndmin=2
+            )
+        if array.size == 0:
+            continue
+        specs = _to_structured(array, parsed_rows)
+        parsed_rows += len(specs)
+        yield specs
+
+
+def parse_crop_specs(lines: Iterable[str], chunk_rows: int = CHUNK_ROWS) -> np.ndarray:
+    """Parses crops csv lines into one CROP_DTYPE array, see iter_crop_spec_chunks"""
+    chunks = list(iter_crop_spec_chunks(lines, chunk_rows))
+    if not chunks:
+        return np.empty(0, dtype=CROP_DTYPE)
+    return np.concatenate(chunks)
+
+
+def check_crop_bounds(crops: CropSpecs, width: int, height: int):
+    """Raises ValueError when any crop is empty or doesn't fit into a width x height
+    image"""
+    specs = as_crop_array(crops)
+    x, y = specs["x"].astype(np.int64), specs["y"].astype(np.int64)
+    invalid = (specs["w"] == 0) | (specs["h"] == 0)
+    invalid |= (x + specs["w"] > width) | (y + specs["h"] > height)
+    if invalid.any():
+        _raise_invalid(
+            specs, invalid, 0, f"are empty or fall outside the {width}x{height} image"
+        )
+
+
+def _raise_invalid(crops: np.ndarray, invalid: np.ndarray, offset: int, reason: str):
+    first = int(np.flatnonzero(invalid)[0])
+    raise ValueError(
+        f"{int(invalid.sum())} of {len(crops)} crops {reason}, first is crop "
+        f"{offset + first} {tuple(int(v) for v in crops[first])} (x, y, w, h)"
+    )
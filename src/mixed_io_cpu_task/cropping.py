@@ -1,58 +1,374 @@
 import asyncio
-import logging
+import functools
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 from PIL import Image
 
+from mixed_io_cpu_task.cache import ByteBudgetCache
+from mixed_io_cpu_task.crop_specs import CropSpecs, as_crop_array, check_crop_bounds
+from mixed_io_cpu_task.engines import (
+    CropEngine,
+    OutputEncoding,
+    PilEngine,
+    create_engine,
+)
+from mixed_io_cpu_task.jpeg_utils import (
+    crop_jpeg_lossless,
+    crops_bounding_box,
+    decode_jpeg_rows,
+    load_turbojpeg,
+    mcu_aligned,
+    read_jpeg_layout,
+    snap_to_mcu,
+)
+from mixed_io_cpu_task.shared_images import (
+    DecodedImage,
+    load_shared_image,
+    release_shared_image,
+)
+from mixed_io_cpu_task.spans import span
 
-logger = logging.getLogger("default")
 
+def _release_decoded_image(key: str, decoded: DecodedImage):
+    release_shared_image(decoded)
 
-def crop_with_pil(
-    image_buffer: BytesIO, crops_to_cut: List[Tuple[int, int, int, int]], trace_id: str
+
+# process-wide cache of decoded images keyed by content digest, disabled until configured
+decoded_images = ByteBudgetCache(on_evict=_release_decoded_image)
+_use_shared_memory = False
+
+
+def configure_decoded_image_cache(max_bytes: int, shared_memory: bool = False):
+    """Sets pixel memory budget of the decoded image cache, 0 disables it.
+
+    With shared_memory decoded pixels are published in multiprocessing.shared_memory
+    so worker processes map an image decoded by any other worker instead of decoding it.
+    """
+    global _use_shared_memory
+    _use_shared_memory = shared_memory
+    decoded_images.resize(max_bytes)
+
+
+# process-wide pool encoding crops in parallel, crops are encoded inline until configured
+_encode_pool: Optional[ThreadPoolExecutor] = None
+
+
+def configure_encode_pool(max_workers: int):
+    """Sets number of threads shared by all tasks of the process to encode crops,
+    1 encodes crops one by one in the calling thread.
+
+    PIL releases the GIL while encoding JPEGs, so images with many crops use many cores.
+    """
+    global _encode_pool
+    if _encode_pool is not None:
+        _encode_pool.shutdown()
+    _encode_pool = None
+    if max_workers > 1:
+        _encode_pool = ThreadPoolExecutor(max_workers, thread_name_prefix="encode")
+
+
+# process-wide engine cropping and encoding images, PIL until configured
+_engine: CropEngine = PilEngine()
+_encoding = OutputEncoding()
+_encode_stats_lock = threading.Lock()
+_encode_stats = {"crops": 0, "encode_ns": 0, "bytes": 0}
+
+
+def configure_crop_engine(name: str):
+    """Sets the engine crop_with_pil cuts and encodes crops with, one of ENGINES.
+
+    Raises ImportError when the optional package of the engine is not installed.
+    """
+    global _engine
+    _engine = create_engine(name, _encoding)
+
+
+def configure_output_encoding(encoding: OutputEncoding):
+    """Sets format, quality and JPEG options every engine encodes crops with and
+    resets the encode time and output size counters"""
+    global _encoding
+    _encoding = encoding
+    _engine.encoding = encoding
+    with _encode_stats_lock:
+        for key in _encode_stats:
+            _encode_stats[key] = 0
+
+
+def encode_stats() -> dict:
+    """Returns number of crops encoded by the process, their total encode time in
+    nanoseconds and total size in bytes"""
+    with _encode_stats_lock:
+        return dict(_encode_stats)
+
+
+def describe_encode_stats(stats: dict) -> str:
+    """Formats encode stats, summed over processes, with means per crop"""
+    if not stats.get("crops"):
+        return "no crops encoded"
+    crops = stats["crops"]
+    return (
+        f"{crops} crops, mean {stats['encode_ns'] / crops / 1e6:.2f} ms and "
+        f"{stats['bytes'] / crops / 2**10:.1f} KB per crop, "
+        f"{stats['bytes'] / 2**20:.1f} MB in total"
+    )
+
+
+def _timed_encode(engine: CropEngine, crop) -> BytesIO:
+    """Encodes crop with engine and counts its encode time and size"""
+    start = time.perf_counter_ns()
+    buffer = engine.encode(crop)
+    elapsed = time.perf_counter_ns() - start
+    size = buffer.getbuffer().nbytes
+    with _encode_stats_lock:
+        _encode_stats["crops"] += 1
+        _encode_stats["encode_ns"] += elapsed
+        _encode_stats["bytes"] += size
+    return buffer
+
+
+# crops on the MCU grid of JPEG sources are cut in the DCT domain when set
+LOSSLESS_MODES = ("off", "aligned", "snap")
+_lossless_mode = "off"
+_crop_paths_lock = threading.Lock()
+_crop_paths = {"lossless": 0, "reencoded": 0}
+
+
+def configure_lossless_crops(mode: str):
+    """Sets which crops of JPEG sources are cut losslessly in the DCT domain with
+    libjpeg-turbo instead of decoded and re-encoded, one of LOSSLESS_MODES.
+
+    "aligned" cuts crops whose top left corner lies on the MCU grid losslessly, "snap"
+    moves the corner of every crop up and left onto the grid and grows the crop to
+    still cover the requested rect, "off" re-encodes every crop. Other crops, other
+    source formats and output formats other than JPEG fall back to the crop engine.
+    Raises ImportError without PyTurboJPEG.
+    """
+    global _lossless_mode
+    if mode != "off":
+        load_turbojpeg()
+    _lossless_mode = mode
+    with _crop_paths_lock:
+        for key in _crop_paths:
+            _crop_paths[key] = 0
+
+
+def crop_path_stats() -> dict:
+    """Returns number of crops cut losslessly and re-encoded by the process"""
+    with _crop_paths_lock:
+        return dict(_crop_paths)
+
+
+def _cut_lossless(
+    image_buffer: BytesIO, crops_to_cut: np.ndarray, trace_id: str
+) -> Tuple[Dict[int, BytesIO], np.ndarray]:
+    """Returns crops cut losslessly by index and indexes of crops to re-encode"""
+    lossless = {}
+    rest = np.arange(len(crops_to_cut))
+    if _lossless_mode != "off" and _encoding.format == "jpeg":
+        with span("lossless", trace_id) as timing, image_buffer.getbuffer() as data:
+            layout = read_jpeg_layout(data)
+            if layout is not None:
+                check_crop_bounds(crops_to_cut, layout.width, layout.height)
+                if _lossless_mode == "snap":
+                    crops_to_cut = snap_to_mcu(crops_to_cut, layout)
+                    aligned = np.ones(len(crops_to_cut), dtype=bool)
+                else:
+                    aligned = mcu_aligned(crops_to_cut, layout)
+                indexes = np.flatnonzero(aligned)
+                encoded = []
+                if len(indexes):
+                    encoded = crop_jpeg_lossless(data, crops_to_cut[indexes])
+                lossless = {i: BytesIO(e) for i, e in zip(indexes.tolist(), encoded)}
+                rest = np.flatnonzero(~aligned)
+                timing.bytes = sum(map(len, encoded))
+            timing.items = len(lossless)
+    with _crop_paths_lock:
+        _crop_paths["lossless"] += len(lossless)
+        _crop_paths["reencoded"] += len(rest)
+    return lossless, rest
+
+
+def _merge_paths(
+    lossless: Dict[int, BytesIO], rest: np.ndarray, buffers: List[BytesIO]
 ) -> List[BytesIO]:
-    """Crops image with PIL encode to JPEG"""
-    logger.debug(f"Opening image with PIL", extra={"trace_id": trace_id})
+    """Returns lossless and re-encoded crops in the order of the crops"""
+    if not lossless:
+        return buffers
+    merged = dict(lossless)
+    merged.update(zip(rest.tolist(), buffers))
+    return [merged[i] for i in range(len(merged))]
+
+
+def decode_image(image_buffer: BytesIO, rows: Optional[int] = None) -> Image.Image:
+    """Decodes the whole image or, when possible, only the MCU rows covering top rows"""
+    if rows is not None:
+        with image_buffer.getbuffer() as data:
+            image = decode_jpeg_rows(data, rows)
+        if image is not None:
+            return image
     image_buffer.seek(0)
     image = Image.open(image_buffer)
+    image.load()
+    return image
+
+
+def _open_image(image_buffer: BytesIO, rows: Optional[int] = None) -> DecodedImage:
+    """Opens image lazily or returns decoded image shared through the cache.
+
+    With rows only the top rows of the image are guaranteed to be decoded.
+    """
+    if not decoded_images.enabled:
+        if rows is not None:
+            image = decode_image(image_buffer, rows)
+        else:
+            image_buffer.seek(0)
+            image = Image.open(image_buffer)
+        return DecodedImage(None, image.mode, image)
+    key = hashlib.blake2b(image_buffer.getbuffer(), digest_size=12).hexdigest()
+    if rows is not None:
+        key = f"{key}-{rows}"
+
+    def load() -> DecodedImage:
+        if _use_shared_memory:
+            return load_shared_image(key, lambda: decode_image(image_buffer, rows))
+        image = decode_image(image_buffer, rows)
+        return DecodedImage(None, image.mode, image)
+
+    return decoded_images.get_or_load(key, load, _decoded_nbytes)
+
+
+def _decoded_nbytes(decoded: DecodedImage) -> int:
+    if decoded.shm is not None:
+        return decoded.shm.size
+    image = decoded.image
+    return image.width * image.height * len(image.getbands())
+
+
+def _roi_rows(crops_to_cut: np.ndarray, roi_decode: bool) -> Optional[int]:
+    """Returns number of top rows covering all crops in ROI decode mode"""
+    if not roi_decode or len(crops_to_cut) == 0:
+        return None
+    return crops_bounding_box(crops_to_cut)[3]
+
+
+def _open_checked(
+    image_buffer: BytesIO, crops_to_cut: np.ndarray, roi_decode: bool
+) -> DecodedImage:
+    """Opens image and checks all crops fit into it, a ROI decoded image holds every
+    row the crops need"""
+    decoded = _open_image(image_buffer, _roi_rows(crops_to_cut, roi_decode))
+    check_crop_bounds(crops_to_cut, *decoded.image.size)
+    return decoded
+
+
+def crop_with_pil(
+    image_buffer: BytesIO,
+    crops_to_cut: CropSpecs,
+    trace_id: str,
+    roi_decode: bool = False,
+) -> List[BytesIO]:
+    """Crops image and encodes crops with the configured engine and output encoding,
+    PIL and JPEG by default.
+
+    crops_to_cut is a CROP_DTYPE array or a sequence of (x, y, w, h), crops outside
+    the image raise ValueError.
+    With roi_decode JPEG decoding stops after the MCU row holding the lowest crop.
+    Crops are encoded on the shared encode pool when configure_encode_pool set one up.
+    With configure_lossless_crops crops on the MCU grid of a JPEG are cut losslessly
+    and the image is only decoded for the remaining crops.
+    """
+    crops_to_cut = as_crop_array(crops_to_cut)
+    lossless, rest = _cut_lossless(image_buffer, crops_to_cut, trace_id)
     buffers = []
-    crops = []
-    logger.debug(f"Cropping image with PIL", extra={"trace_id": trace_id})
-    for x, y, w, h in crops_to_cut:
-        crop = image.crop((x, y, x + w, y + h))
-        crops.append(crop)
-    logger.debug(f"Cut {len(crops)} crops", extra={"trace_id": trace_id})
-    for crop in crops:
-        buffer = BytesIO()
-        crop.save(buffer, format="JPEG")
-        buffer.seek(0)
-        buffers.append(buffer)
-    logger.debug(f"Encoded {len(buffers)} jpg images", extra={"trace_id": trace_id})
+    if len(rest):
+        buffers = _reencode(image_buffer, crops_to_cut[rest], trace_id, roi_decode)
+    return _merge_paths(lossless, rest, buffers)
+
+
+def _decode_checked(
+    image_buffer: BytesIO, crops_to_cut: np.ndarray, trace_id: str, roi_decode: bool
+) -> DecodedImage:
+    """Opens and decodes image in a decode span, a cached image costs a lookup"""
+    with span("decode", trace_id) as timing:
+        decoded = _open_checked(image_buffer, crops_to_cut, roi_decode)
+        # a lazily opened image would only be decoded by the first crop
+        decoded.image.load()
+        timing.bytes = _decoded_nbytes(decoded)
+    return decoded
+
+
+def _reencode(
+    image_buffer: BytesIO, crops_to_cut: np.ndarray, trace_id: str, roi_decode: bool
+) -> List[BytesIO]:
+    decoded = _decode_checked(image_buffer, crops_to_cut, trace_id, roi_decode)
+    engine = _engine
+    with span("crop", trace_id, items=len(crops_to_cut)):
+        source = engine.prepare(decoded)
+        crops = []
+        for x, y, w, h in crops_to_cut.tolist():
+            crop = engine.crop(source, x, y, w, h)
+            crops.append(crop)
+    with span("encode", trace_id, items=len(crops)) as timing:
+        if _encode_pool is not None:
+            encode = functools.partial(_timed_encode, engine)
+            buffers = list(_encode_pool.map(encode, crops))
+        else:
+            buffers = [_timed_encode(engine, crop) for crop in crops]
+        timing.bytes = sum(buffer.getbuffer().nbytes for buffer in buffers)
     return buffers
 
 
 async def crop_with_pil_async(
-    image_buffer: BytesIO, crops_to_cut: List[Tuple[int, int, int, int]], trace_id: str
+    image_buffer: BytesIO,
+    crops_to_cut: CropSpecs,
+    trace_id: str,
+    roi_decode: bool = False,
 ) -> List[BytesIO]:
-    """Crops image with PIL encode to JPEG"""
-    logger.debug(f"Cropping image with PIL", extra={"trace_id": trace_id})
-    image_buffer.seek(0)
-    image = Image.open(image_buffer)
+    """Crops image and encodes crops with the configured engine and output encoding,
+    lossless crops are cut first when configured"""
+    crops_to_cut = as_crop_array(crops_to_cut)
+    lossless, rest = _cut_lossless(image_buffer, crops_to_cut, trace_id)
+    buffers = []
+    if len(rest):
+        await asyncio.sleep(0)
+        buffers = await _reencode_async(
+            image_buffer, crops_to_cut[rest], trace_id, roi_decode
+        )
+    return _merge_paths(lossless, rest, buffers)
+
+
+async def _reencode_async(
+    image_buffer: BytesIO, crops_to_cut: np.ndarray, trace_id: str, roi_decode: bool
+) -> List[BytesIO]:
+    engine = _engine
+    decoded = _decode_checked(image_buffer, crops_to_cut, trace_id, roi_decode)
     await asyncio.sleep(0)
-    logger.debug(f"Opened image with PIL", extra={"trace_id": trace_id})
     buffers = []
     crops = []
-    for x, y, w, h in crops_to_cut:
-        crop = image.crop((x, y, x + w, y + h))
-        crops.append(crop)
-        await asyncio.sleep(0)
-    logger.debug(f"Cut {len(crops)} crops", extra={"trace_id": trace_id})
-    for crop in crops:
-        buffer = BytesIO()
-        crop.save(buffer, format="JPEG")
-        buffer.seek(0)
-        buffers.append(buffer)
-        await asyncio.sleep(0)
-    logger.debug(f"Encoded {len(buffers)} jpg images", extra={"trace_id": trace_id})
+    with span("crop", trace_id, items=len(crops_to_cut)):
+        source = engine.prepare(decoded)
+        for x, y, w, h in crops_to_cut.tolist():
+            crop = engine.crop(source, x, y, w, h)
+            crops.append(crop)
+            await asyncio.sleep(0)
+    with span("encode", trace_id, items=len(crops)) as timing:
+        if _encode_pool is not None:
+            loop = asyncio.get_running_loop()
+            buffers = await asyncio.gather(
+                *(
+                    loop.run_in_executor(_encode_pool, _timed_encode, engine, crop)
+                    for crop in crops
+                )
+            )
+        else:
+            for crop in crops:
+                buffers.append(_timed_encode(engine, crop))
+                await asyncio.sleep(0)
+        timing.bytes = sum(buffer.getbuffer().nbytes for buffer in buffers)
     return buffers
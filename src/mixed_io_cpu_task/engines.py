@@ -0,0 +1,268 @@
+import importlib.util
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Dict, List, NamedTuple, Type
+
+import numpy as np
+from PIL import Image
+
+from mixed_io_cpu_task.shared_images import HEADER_SIZE, DecodedImage
+
+# PIL format name and filename suffix of every output format
+OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "png": ("PNG", ".png"),
+}
+SUBSAMPLINGS = ("4:4:4", "4:2:2", "4:2:0")
+
+
+class OutputEncoding(NamedTuple):
+    """Settings crops are encoded with, the defaults are PIL's JPEG defaults.
+
+    quality applies to JPEG and WebP, progressive and subsampling to JPEG only.
+    optimize makes JPEG compute optimal Huffman tables, WebP use its slowest method
+    and PNG its highest compression, trading encode time for smaller crops.
+    """
+
+    format: str = "jpeg"
+    quality: int = 75
+    progressive: bool = False
+    optimize: bool = False
+    subsampling: str = "4:2:0"
+
+    @property
+    def suffix(self) -> str:
+        """Returns the file suffix of the output format"""
+        return OUTPUT_FORMATS[self.format][1]
+
+    def normalized(self) -> "OutputEncoding":
+        """Returns the settings with the ones the format ignores set to defaults, so
+        settings encoding crops the same compare equal"""
+        default = OutputEncoding()
+        if self.format == "jpeg":
+            return self
+        if self.format == "webp":
+            return self._replace(
+                progressive=default.progressive, subsampling=default.subsampling
+            )
+        return default._replace(format=self.format, optimize=self.optimize)
+
+    def describe(self) -> str:
+        """Formats the format and the settings it uses"""
+        settings = [self.format]
+        if self.format != "png":
+            settings.append(f"quality {self.quality}")
+        if self.format == "jpeg":
+            settings.append(f"subsampling {self.subsampling}")
+            if self.progressive:
+                settings.append("progressive")
+        if self.optimize:
+            settings.append("optimize")
+        return ", ".join(settings)
+
+
+def pil_save_options(encoding: OutputEncoding) -> dict:
+    """Returns Image.save keyword arguments encoding a crop with encoding"""
+    pil_format = OUTPUT_FORMATS[encoding.format][0]
+    if encoding.format == "jpeg":
+        return dict(
+            format=pil_format,
+            quality=encoding.quality,
+            progressive=encoding.progressive,
+            optimize=encoding.optimize,
+            subsampling=encoding.subsampling,
+        )
+    if encoding.format == "webp":
+        # method 4 is the default speed / size tradeoff, 6 the slowest and smallest
+        method = 6 if encoding.optimize else 4
+        return dict(format=pil_format, quality=encoding.quality, method=method)
+    return dict(format=pil_format, optimize=encoding.optimize)
+
+
+class CropEngine(ABC):
+    """Cuts crops out of one decoded image and encodes them with encoding.
+
+    prepare runs once per image and returns the source crop reads from, encode may run
+    on the shared encode pool so it must be thread safe.
+    """
+
+    name = ""
+    # module an engine needs on top of the project dependencies and its pip package
+    requires = None
+    encoding = OutputEncoding()
+
+    def prepare(self, decoded: DecodedImage):
+        """Returns the source crops of the image are read from"""
+        return decoded
+
+    @abstractmethod
+    def crop(self, source, x: int, y: int, w: int, h: int):
+        """Returns the w x h crop at x, y of source"""
+        pass
+
+    @abstractmethod
+    def encode(self, crop) -> BytesIO:
+        """Returns crop encoded with encoding, rewound to the start"""
+        pass
+
+
+class PilEngine(CropEngine):
+    """Crops and encodes PIL images, every crop copies its pixels out of the image"""
+
+    name = "pil"
+
+    def crop(self, decoded: DecodedImage, x: int, y: int, w: int, h: int):
+        crop = decoded.image.crop((x, y, x + w, y + h))
+        if crop.mode != decoded.mode:
+            # pixels mapped from shared memory are stored in a padded mode
+            crop = crop.convert(decoded.mode)
+        return crop
+
+    def encode(self, crop: Image.Image) -> BytesIO:
+        buffer = BytesIO()
+        crop.save(buffer, **pil_save_options(self.encoding))
+        buffer.seek(0)
+        return buffer
+
+
+class NumpyEngine(PilEngine):
+    """Turns the decoded image into one array and crops views of it, only the encoder
+    copies pixels of a crop. Images in shared memory are viewed without a copy."""
+
+    name = "numpy"
+
+    def prepare(self, decoded: DecodedImage) -> np.ndarray:
+        image = decoded.image
+        if decoded.shm is not None and image.mode == "RGBX" and decoded.mode == "RGB":
+            pixels = np.ndarray(
+                (image.height, image.width, 4),
+                dtype=np.uint8,
+                buffer=decoded.shm.buf,
+                offset=HEADER_SIZE,
+            )
+            return pixels[..., :3]
+        if image.mode != decoded.mode:
+            image = image.convert(decoded.mode)
+        return np.asarray(image)
+
+    def crop(self, pixels: np.ndarray, x: int, y: int, w: int, h: int) -> np.ndarray:
+        return pixels[y : y + h, x : x + w]
+
+    def encode(self, crop: np.ndarray) -> BytesIO:
+        return super().encode(Image.fromarray(np.ascontiguousarray(crop)))
+
+
+class TurboJpegEngine(NumpyEngine):
+    """Encodes array views to JPEG with libjpeg-turbo through PyTurboJPEG, other
+    formats are encoded with PIL. The optimize setting is not exposed by PyTurboJPEG
+    and is ignored."""
+
+    name = "turbojpeg"
+    requires = ("turbojpeg", "PyTurboJPEG")
+
+    def __init__(self):
+        import turbojpeg
+
+        self._turbojpeg = turbojpeg
+        self._jpeg = turbojpeg.TurboJPEG()
+
+    def encode(self, crop: np.ndarray) -> BytesIO:
+        encoding = self.encoding
+        if encoding.format != "jpeg":
+            return super().encode(crop)
+        if crop.ndim == 2:
+            pixel_format = self._turbojpeg.TJPF_GRAY
+            subsample = self._turbojpeg.TJSAMP_GRAY
+        else:
+            pixel_format = self._turbojpeg.TJPF_RGB
+            subsample = getattr(
+                self._turbojpeg, "TJSAMP_" + encoding.subsampling.replace(":", "")
+            )
+        flags = self._turbojpeg.TJFLAG_PROGRESSIVE if encoding.progressive else 0
+        data = self._jpeg.encode(
+            np.ascontiguousarray(crop),
+            quality=encoding.quality,
+            pixel_format=pixel_format,
+            jpeg_subsample=subsample,
+            flags=flags,
+        )
+        return BytesIO(data)
+
+
+class OpenCvEngine(NumpyEngine):
+    """Encodes array views to JPEG and WebP with OpenCV, which expects BGR pixels, PNG
+    is encoded with PIL"""
+
+    name = "opencv"
+    requires = ("cv2", "opencv-python-headless")
+
+    def __init__(self):
+        import cv2
+
+        self._cv2 = cv2
+
+    def encode(self, crop: np.ndarray) -> BytesIO:
+        encoding = self.encoding
+        if encoding.format == "png":
+            return super().encode(crop)
+        if crop.ndim == 3:
+            crop = self._cv2.cvtColor(crop, self._cv2.COLOR_RGB2BGR)
+        ok, data = self._cv2.imencode(
+            encoding.suffix, crop, self._imencode_params(encoding)
+        )
+        if not ok:
+            raise ValueError(f"OpenCV failed to encode a {crop.shape} crop")
+        return BytesIO(data.tobytes())
+
+    def _imencode_params(self, encoding: OutputEncoding) -> List[int]:
+        cv2 = self._cv2
+        if encoding.format == "webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, encoding.quality]
+        sampling = {
+            "4:4:4": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+            "4:2:2": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+            "4:2:0": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+        }
+        return [
+            cv2.IMWRITE_JPEG_QUALITY,
+            encoding.quality,
+            cv2.IMWRITE_JPEG_PROGRESSIVE,
+            int(encoding.progressive),
+            cv2.IMWRITE_JPEG_OPTIMIZE,
+            int(encoding.optimize),
+            cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+            sampling[encoding.subsampling],
+        ]
+
+
+ENGINES: Dict[str, Type[CropEngine]] = {
+    engine.name: engine
+    for engine in (PilEngine, NumpyEngine, TurboJpegEngine, OpenCvEngine)
+}
+
+
+def available_engines() -> List[str]:
+    """Returns names of engines whose optional dependencies are installed"""
+    return [
+        name
+        for name, engine in ENGINES.items()
+        if engine.requires is None
+        or importlib.util.find_spec(engine.requires[0]) is not None
+    ]
+
+
+def create_engine(name: str, encoding: OutputEncoding = OutputEncoding()) -> CropEngine:
+    """Returns engine called name encoding crops with encoding, raises ImportError
+    naming the package to install when its optional dependency is missing"""
+    engine = ENGINES[name]
+    try:
+        instance = engine()
+        instance.encoding = encoding
+        return instance
+    except ImportError as e:
+        _, package = engine.requires
+        raise ImportError(
+            f"{name} engine needs the {package} package, "
+            f"install it with pip install {package}"
+        ) from e
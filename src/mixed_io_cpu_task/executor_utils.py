@@ -0,0 +1,35 @@
+import concurrent.futures
+from concurrent.futures import Executor, Future
+from typing import Callable, Iterable, Iterator
+
+
+def submit_with_limit(
+    executor: Executor, fn: Callable, args: Iterable[tuple], limit: int
+) -> Iterator[Future]:
+    """Submits fn(*a) for every a in args keeping at most limit futures pending and
+    yields futures as they complete.
+
+    Sync twin of async_utils.limit_concurrency - args are consumed lazily so very long
+    task streams never end up in memory as a list of futures.
+    """
+    args = iter(args)
+    args_ended = False
+    pending = set()
+
+    while pending or not args_ended:
+        while len(pending) < limit and not args_ended:
+            try:
+                a = next(args)
+            except StopIteration:
+                args_ended = True
+            else:
+                pending.add(executor.submit(fn, *a))
+
+        if not pending:
+            return
+
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        while done:
+            yield done.pop()
@@ -0,0 +1,482 @@
+import asyncio
+import base64
+import bisect
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import random
+import re
+import struct
+import threading
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import google_crc32c
+from aiohttp import web
+
+logger = logging.getLogger("default")
+
+# bytes sent or received between two bandwidth checks
+TRANSFER_CHUNK = 64 * 2**10
+OVER_LIMIT_MODES = ("queue", "reject")
+_RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+_CONTENT_RANGE_PATTERN = re.compile(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)")
+_BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?')
+
+
+class NetworkConditions(NamedTuple):
+    """Network and service behaviour the emulator imposes on every request"""
+
+    # added before the response of every request, jitter is drawn uniformly
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    # bandwidth shared by all transfers and the cap of a single transfer in MB/s,
+    # 0 means unlimited
+    bandwidth_mbps: float = 0.0
+    stream_mbps: float = 0.0
+    # requests served at once, queue waits for a slot, reject answers 429
+    max_concurrency: int = 0
+    over_limit: str = "queue"
+    # share of requests answered with the error without being served
+    rate_429: float = 0.0
+    rate_503: float = 0.0
+    seed: Optional[int] = None
+
+    def describe(self) -> str:
+        """Formats the conditions for the log"""
+        return (
+            f"latency {self.latency_ms:.0f} ± {self.jitter_ms:.0f} ms, "
+            f"bandwidth {_mbps(self.bandwidth_mbps)} "
+            f"(per transfer {_mbps(self.stream_mbps)}), "
+            f"concurrency {self.max_concurrency or 'unlimited'} ({self.over_limit}), "
+            f"429 rate {self.rate_429:.1%}, 503 rate {self.rate_503:.1%}"
+        )
+
+
+def _mbps(value: float) -> str:
+    return f"{value} MB/s" if value else "unlimited"
+
+
+class _Link:
+    """Paces transfers to a shared bandwidth and a per-transfer cap, every chunk
+    reserves its time on the shared link so concurrent transfers share it fairly"""
+
+    def __init__(self, bandwidth: float, stream_bandwidth: float):
+        self.bandwidth = bandwidth
+        self.stream_bandwidth = stream_bandwidth
+        self._free_at = 0.0
+
+    async def transfer(self, nbytes: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        done = now
+        if self.bandwidth:
+            self._free_at = max(now, self._free_at) + nbytes / self.bandwidth
+            done = self._free_at
+        if self.stream_bandwidth:
+            done = max(done, now + nbytes / self.stream_bandwidth)
+        if done > now:
+            await asyncio.sleep(done - now)
+
+
+def _error(status: int, reason: str, message: str) -> web.Response:
+    return web.json_response(
+        {
+            "error": {
+                "code": status,
+                "message": message,
+                "errors": [{"reason": reason, "message": message}],
+            }
+        },
+        status=status,
+    )
+
+
+class GcsEmulator:
+    """GCS JSON API subset used by google-cloud-storage and gcloud-aio-storage,
+    served from memory on localhost under controlled network conditions.
+
+    Clients reach it through STORAGE_EMULATOR_HOST set to endpoint. Objects can be
+    uploaded with media, multipart and resumable uploads, downloaded whole or by byte
+    range, listed with prefixes and page tokens and deleted, buckets exist on first
+    use. start() serves from a background thread of the calling process.
+    """
+
+    def __init__(
+        self,
+        conditions: NetworkConditions = NetworkConditions(),
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.conditions = conditions
+        self.host = host
+        self.port = port
+        self._objects: Dict[Tuple[str, str], Tuple[bytes, dict]] = {}
+        self._uploads: Dict[str, dict] = {}
+        self._generation = itertools.count(1)
+        self._random = random.Random(conditions.seed)
+        self._link = _Link(
+            conditions.bandwidth_mbps * 2**20, conditions.stream_mbps * 2**20
+        )
+        self._in_flight = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._stats = {
+            "requests": 0,
+            "injected_429": 0,
+            "injected_503": 0,
+            "rejected": 0,
+            "aborted": 0,
+            "queued": 0,
+            "max_in_flight": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+        }
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        """Returns the URL clients set STORAGE_EMULATOR_HOST to"""
+        return f"http://{self.host}:{self.port}"
+
+    def stats(self) -> dict:
+        """Returns request, injected error, aborted, concurrency and byte counters"""
+        return {**self._stats, "objects": len(self._objects)}
+
+    def put_object(self, bucket: str, name: str, data: bytes, content_type=None):
+        """Stores an object without going through the network conditions"""
+        self._store(bucket, name, bytes(data), content_type)
+
+    def app(self) -> web.Application:
+        """Returns the application serving the JSON and upload APIs"""
+        app = web.Application(client_max_size=2**40, middlewares=[self._conditions])
+        app.router.add_get("/storage/v1/b/{bucket}", self._get_bucket)
+        app.router.add_get("/storage/v1/b/{bucket}/o", self._list_objects)
+        app.router.add_get("/storage/v1/b/{bucket}/o/{name:.+}", self._get_object)
+        app.router.add_get(
+            "/download/storage/v1/b/{bucket}/o/{name:.+}", self._get_object
+        )
+        app.router.add_delete("/storage/v1/b/{bucket}/o/{name:.+}", self._delete)
+        app.router.add_post("/upload/storage/v1/b/{bucket}/o", self._upload)
+        app.router.add_put("/upload/storage/v1/b/{bucket}/o", self._resumable_upload)
+        return app
+
+    def start(self) -> "GcsEmulator":
+        """Serves from a daemon thread until stop(), port 0 picks a free port"""
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start_site())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name="gcs-emulator", daemon=True)
+        self._thread.start()
+        started.wait()
+        logger.info(f"GCS emulator on {self.endpoint}, {self.conditions.describe()}")
+        return self
+
+    def stop(self):
+        """Stops serving and joins the serving thread"""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self) -> "GcsEmulator":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _start_site(self):
+        self._slots = (
+            asyncio.Semaphore(self.conditions.max_concurrency)
+            if self.conditions.max_concurrency
+            else None
+        )
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    @web.middleware
+    async def _conditions(self, request: web.Request, handler):
+        """Applies concurrency limit, latency and injected errors to a request"""
+        conditions = self.conditions
+        self._stats["requests"] += 1
+        if self._slots is not None and self._slots.locked():
+            if conditions.over_limit == "reject":
+                self._stats["rejected"] += 1
+                return _error(429, "rateLimitExceeded", "too many concurrent requests")
+            self._stats["queued"] += 1
+        async with self._slots or _no_limit():
+            self._in_flight += 1
+            self._stats["max_in_flight"] = max(
+                self._stats["max_in_flight"], self._in_flight
+            )
+            try:
+                delay = conditions.latency_ms + self._random.uniform(
+                    -conditions.jitter_ms, conditions.jitter_ms
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay / 1000)
+                draw = self._random.random()
+                if draw < conditions.rate_429:
+                    self._stats["injected_429"] += 1
+                    return _error(429, "rateLimitExceeded", "injected rate limit")
+                if draw < conditions.rate_429 + conditions.rate_503:
+                    self._stats["injected_503"] += 1
+                    return _error(503, "backendError", "injected backend error")
+                return await handler(request)
+            except (ConnectionError, asyncio.CancelledError):
+                # the client dropped the connection mid-body, nobody reads an answer
+                self._stats["aborted"] += 1
+                return web.Response(status=499)
+            finally:
+                self._in_flight -= 1
+
+    def _store(self, bucket: str, name: str, data: bytes, content_type=None) -> dict:
+        generation = next(self._generation)
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat(
+            timespec="milliseconds"
+        )
+        metadata = {
+            "kind": "storage#object",
+            "id": f"{bucket}/{name}/{generation}",
+            "name": name,
+            "bucket": bucket,
+            "generation": str(generation),
+            "metageneration": "1",
+            "contentType": content_type or "application/octet-stream",
+            "size": str(len(data)),
+            "md5Hash": base64.b64encode(hashlib.md5(data).digest()).decode(),
+            "crc32c": base64.b64encode(
+                struct.pack(">I", google_crc32c.value(data))
+            ).decode(),
+            "storageClass": "STANDARD",
+            "timeCreated": now.replace("+00:00", "Z"),
+            "updated": now.replace("+00:00", "Z"),
+        }
+        self._objects[(bucket, name)] = (data, metadata)
+        return metadata
+
+    def _object_resource(self, request: web.Request, metadata: dict) -> dict:
+        """Adds links pointing back at the emulator, clients download from mediaLink"""
+        name = quote(metadata["name"], safe="")
+        base = f"{request.url.origin()}/storage/v1/b/{metadata['bucket']}/o/{name}"
+        return {
+            **metadata,
+            "selfLink": base,
+            "mediaLink": f"{request.url.origin()}/download/storage/v1/b/"
+            f"{metadata['bucket']}/o/{name}?generation={metadata['generation']}"
+            "&alt=media",
+        }
+
+    async def _read_body(self, request: web.Request) -> bytes:
+        body = bytearray()
+        async for chunk in request.content.iter_chunked(TRANSFER_CHUNK):
+            await self._link.transfer(len(chunk))
+            body += chunk
+        self._stats["bytes_in"] += len(body)
+        return bytes(body)
+
+    async def _send_body(
+        self, request: web.Request, response: web.StreamResponse, data
+    ) -> web.StreamResponse:
+        response.content_length = len(data)
+        await response.prepare(request)
+        view = memoryview(data)
+        for start in range(0, len(view), TRANSFER_CHUNK):
+            chunk = view[start : start + TRANSFER_CHUNK]
+            await self._link.transfer(len(chunk))
+            await response.write(chunk)
+        self._stats["bytes_out"] += len(data)
+        await response.write_eof()
+        return response
+
+    async def _get_bucket(self, request: web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        return web.json_response(
+            {"kind": "storage#bucket", "id": bucket, "name": bucket}
+        )
+
+    async def _list_objects(self, request: web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        prefix = request.query.get("prefix", "")
+        delimiter = request.query.get("delimiter", "")
+        page_token = request.query.get("pageToken", "")
+        max_results = int(request.query.get("maxResults", 1000))
+        names = sorted(
+            name
+            for object_bucket, name in self._objects
+            if object_bucket == bucket and name.startswith(prefix)
+        )
+        items, prefixes = [], set()
+        for name in names[bisect.bisect_right(names, page_token) :]:
+            rest = name[len(prefix) :]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+                continue
+            if len(items) == max_results:
+                break
+            items.append(name)
+        result = {
+            "kind": "storage#objects",
+            "items": [
+                self._object_resource(request, self._objects[(bucket, name)][1])
+                for name in items
+            ],
+        }
+        if prefixes:
+            result["prefixes"] = sorted(prefixes)
+        if len(items) == max_results and names and items[-1] != names[-1]:
+            result["nextPageToken"] = items[-1]
+        return web.json_response(result)
+
+    async def _get_object(self, request: web.Request) -> web.StreamResponse:
+        key = (request.match_info["bucket"], request.match_info["name"])
+        if key not in self._objects:
+            return _error(404, "notFound", f"No such object: {'/'.join(key)}")
+        data, metadata = self._objects[key]
+        if request.query.get("ifGenerationMatch", metadata["generation"]) != (
+            metadata["generation"]
+        ):
+            return _error(412, "conditionNotMet", "generation precondition failed")
+        is_media = request.query.get("alt") == "media" or request.path.startswith(
+            "/download/"
+        )
+        if not is_media:
+            return web.json_response(self._object_resource(request, metadata))
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": metadata["contentType"],
+                "X-Goog-Generation": metadata["generation"],
+                "X-Goog-Stored-Content-Length": metadata["size"],
+            }
+        )
+        byte_range = _RANGE_PATTERN.fullmatch(request.headers.get("Range", ""))
+        if byte_range is None:
+            response.headers["X-Goog-Hash"] = (
+                f"crc32c={metadata['crc32c']},md5={metadata['md5Hash']}"
+            )
+            return await self._send_body(request, response, data)
+        first, last = byte_range.groups()
+        if first:
+            first, last = int(first), min(int(last or len(data) - 1), len(data) - 1)
+        else:
+            first, last = max(len(data) - int(last), 0), len(data) - 1
+        if first >= len(data):
+            return _error(416, "requestedRangeNotSatisfiable", "range not satisfiable")
+        response.set_status(206)
+        response.headers["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+        return await self._send_body(
+            request, response, memoryview(data)[first : last + 1]
+        )
+
+    async def _delete(self, request: web.Request) -> web.Response:
+        key = (request.match_info["bucket"], request.match_info["name"])
+        if self._objects.pop(key, None) is None:
+            return _error(404, "notFound", f"No such object: {'/'.join(key)}")
+        return web.Response(status=204)
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        bucket = request.match_info["bucket"]
+        upload_type = request.query.get("uploadType", "media")
+        body = await self._read_body(request)
+        if upload_type == "resumable":
+            metadata = json.loads(body or b"{}")
+            upload_id = uuid.uuid4().hex
+            self._uploads[upload_id] = {
+                "bucket": bucket,
+                "name": metadata.get("name") or request.query.get("name"),
+                "content_type": metadata.get("contentType")
+                or request.headers.get("X-Upload-Content-Type"),
+                "data": bytearray(),
+            }
+            location = (
+                f"{request.url.origin()}/upload/storage/v1/b/{bucket}/o"
+                f"?uploadType=resumable&upload_id={upload_id}"
+            )
+            return web.json_response({}, headers={"Location": location})
+        if upload_type == "multipart":
+            metadata, data, content_type = _parse_multipart(
+                request.headers.get("Content-Type", ""), body
+            )
+            name = metadata.get("name") or request.query.get("name")
+            content_type = metadata.get("contentType") or content_type
+        else:
+            name, data = request.query.get("name"), body
+            content_type = request.headers.get("Content-Type")
+        if not name:
+            return _error(400, "required", "object name is required")
+        metadata = self._store(bucket, name, data, content_type)
+        return web.json_response(self._object_resource(request, metadata))
+
+    async def _resumable_upload(self, request: web.Request) -> web.Response:
+        """Takes the data of a resumable upload in one or many chunks, incomplete
+        uploads answer 308 with the range received so far"""
+        upload = self._uploads.get(request.query.get("upload_id", ""))
+        if upload is None:
+            return _error(404, "notFound", "No such upload")
+        body = await self._read_body(request)
+        content_range = _CONTENT_RANGE_PATTERN.fullmatch(
+            request.headers.get("Content-Range", "")
+        )
+        total = None
+        if content_range is not None:
+            first, _, total = content_range.groups()
+            if first is not None and int(first) == len(upload["data"]):
+                upload["data"] += body
+            total = None if total == "*" else int(total)
+        else:
+            # a single request without a range carries the whole object
+            upload["data"] += body
+            total = len(upload["data"])
+        if total is None or len(upload["data"]) < total:
+            headers = {}
+            if upload["data"]:
+                headers["Range"] = f"bytes=0-{len(upload['data']) - 1}"
+            return web.Response(status=308, headers=headers)
+        del self._uploads[request.query["upload_id"]]
+        metadata = self._store(
+            upload["bucket"],
+            upload["name"],
+            bytes(upload["data"]),
+            upload["content_type"],
+        )
+        return web.json_response(self._object_resource(request, metadata))
+
+
+class _no_limit:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def _parse_multipart(content_type: str, body: bytes) -> Tuple[dict, bytes, str]:
+    """Returns metadata, data and content type of a multipart/related upload"""
+    boundary = _BOUNDARY_PATTERN.search(content_type)
+    if boundary is None:
+        raise web.HTTPBadRequest(reason="multipart upload without boundary")
+    parts = body.split(b"--" + boundary.group(1).encode())[1:-1]
+    payloads = []
+    for part in parts:
+        headers, payload = part.split(b"\r\n\r\n", 1)
+        part_type = re.search(rb"content-type:\s*([^\r\n]+)", headers, re.IGNORECASE)
+        payloads.append(
+            (part_type.group(1).decode() if part_type else None, payload[:-2])
+        )
+    (_, metadata), (data_type, data) = payloads
+    return json.loads(metadata), data, data_type
@@ -1,20 +1,192 @@
 import asyncio
 import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import logging
 import pathlib
 import uuid
-from io import BytesIO
+from io import BytesIO, StringIO
 from shutil import rmtree
-from typing import Union, List, Tuple, Optional
+from typing import (
+    Union,
+    List,
+    Tuple,
+    Optional,
+    TextIO,
+    Callable,
+    AsyncIterator,
+    Dict,
+    Iterator,
+)
 import os
+import threading
+import time
+
+import aiohttp
+import numpy as np
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 
 from gcloud.aio.storage import Storage, Blob
 
-from mixed_io_cpu_task.async_utils import limit_concurrency
+from mixed_io_cpu_task.async_utils import AdaptiveLimit, limit_concurrency
+from mixed_io_cpu_task.cache import ByteBudgetCache
+from mixed_io_cpu_task.crop_specs import parse_crop_specs
+from mixed_io_cpu_task.executor_utils import submit_with_limit
+from mixed_io_cpu_task.mapped_files import MappedFile, map_file
+from mixed_io_cpu_task.packed_output import (
+    INDEX_SUFFIX,
+    PackedShardWriter,
+    index_name,
+    parse_index,
+)
+from mixed_io_cpu_task.retry import (
+    LatencyTracker,
+    RetryPolicy,
+    call_with_retry,
+    call_with_retry_async,
+    reset_retry_stats,
+)
+from mixed_io_cpu_task.spans import span
 
 logger = logging.getLogger("default")
-storage_client = storage.Client()
+# objects listed per page when removing a gs dir
+REMOVE_PAGE_SIZE = 1000
+_storage_client: Optional[storage.Client] = None
+_storage_client_lock = threading.Lock()
+# process-wide cache of downloaded images and parsed crops, disabled until configured
+download_cache = ByteBudgetCache()
+# run-scoped async client shared by all async gs helpers, set by open_async_storage
+_async_storage: Optional[Storage] = None
+_connection_stats = {"requests": 0, "connections": 0, "reused": 0}
+
+
+def storage_client() -> storage.Client:
+    """Returns the process-wide gcs client, created on first use so importing this
+    module needs no credentials and STORAGE_EMULATOR_HOST may be set after import"""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
+def _reset_storage_client():
+    # a forked child must not reuse the keep-alive connections of its parent's client,
+    # nor a lock the parent may have held
+    global _storage_client, _storage_client_lock
+    _storage_client = None
+    _storage_client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_storage_client)
+
+
+def _connection_trace_config() -> aiohttp.TraceConfig:
+    """Counts requests, new connections and connections reused from the pool"""
+
+    async def on_request_start(session, context, params):
+        _connection_stats["requests"] += 1
+
+    async def on_connection_create_end(session, context, params):
+        _connection_stats["connections"] += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        _connection_stats["reused"] += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
+
+
+@contextlib.asynccontextmanager
+async def open_async_storage(pool_size: int = 100) -> AsyncIterator[Storage]:
+    """Opens one aiohttp session and storage client used by all async gs helpers until
+    the context exits, so connections, TLS sessions and the auth token are reused.
+
+    pool_size limits open connections of the session, 0 means no limit.
+    """
+    global _async_storage
+    for key in _connection_stats:
+        _connection_stats[key] = 0
+    connector = aiohttp.TCPConnector(limit=pool_size)
+    async with aiohttp.ClientSession(
+        connector=connector, trace_configs=[_connection_trace_config()]
+    ) as session:
+        _async_storage = Storage(session=session)
+        try:
+            yield _async_storage
+        finally:
+            _async_storage = None
+
+
+def async_storage_stats() -> dict:
+    """Returns request and connection counters of the last run-scoped async client"""
+    return dict(_connection_stats)
+
+
+# retry policy of gs reads and writes, a single attempt until configured
+_retry_policy = RetryPolicy()
+_latencies = LatencyTracker()
+# runs hedged sync requests, both attempts have to run off the calling thread
+_hedge_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def configure_gcs_retries(
+    max_attempts: int, deadline: float = 60.0, hedge: bool = False
+):
+    """Sets attempts and deadline of every gs read and write of the process, transient
+    errors are retried with jittered exponential backoff. With hedge a duplicate request
+    is sent when a request runs past p95 latency of its operation.
+
+    1 attempt without hedging keeps the retry defaults of the storage client.
+    """
+    global _retry_policy, _hedge_pool
+    _retry_policy = RetryPolicy(
+        max_attempts=max(1, max_attempts), deadline=deadline, hedge=hedge
+    )
+    if _hedge_pool is not None:
+        _hedge_pool.shutdown(wait=False)
+    _hedge_pool = None
+    if hedge:
+        _hedge_pool = concurrent.futures.ThreadPoolExecutor(
+            256, thread_name_prefix="hedge"
+        )
+    reset_retry_stats()
+
+
+def _gs_call(op: str, fn: Callable):
+    """Calls storage client method fn under the retry policy, fn takes timeout and
+    retry keyword arguments"""
+    if not _retry_policy.enabled:
+        return fn()
+    return call_with_retry(
+        op,
+        lambda timeout: fn(timeout=timeout, retry=None),
+        _retry_policy,
+        _latencies,
+        _hedge_pool,
+    )
+
+
+async def _gs_call_async(op: str, make_aw: Callable):
+    """Awaits a fresh make_aw() for every attempt under the retry policy"""
+    if not _retry_policy.enabled:
+        return await make_aw()
+    return await call_with_retry_async(op, make_aw, _retry_policy, _latencies)
+
+
+@contextlib.asynccontextmanager
+async def _storage() -> AsyncIterator[Storage]:
+    """Yields the run-scoped async client or a short-lived one outside of a run"""
+    if _async_storage is not None:
+        yield _async_storage
+    else:
+        async with Storage() as client:
+            yield client
 
 
 def _remove_local_dir(dir: str):
@@ -24,165 +196,727 @@ def _remove_local_dir(dir: str):
         rmtree(dir)
 
 
-def _remove_gs_dir(dir: str):
-    """Removes gs dir"""
+def gs_prefix(dir: str) -> str:
+    """Returns object name prefix of a gs dir, "gs://b/out" must not match "out2/..." """
+    prefix = "/".join(dir.split("/")[3:]).strip("/")
+    return f"{prefix}/" if prefix else ""
+
+
+def _remove_gs_dir(dir: str, max_concurrency: int = 32):
+    """Removes gs dir, listing pages are streamed into at most max_concurrency deletes"""
     logger.debug(f"Removing gs dir {dir}")
+    start = time.perf_counter()
     bucket_name = dir.split("/")[2]
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix="/".join(dir.split("/")[3:]))
-    for blob in blobs:
-        blob.delete()
+    bucket = storage_client().bucket(bucket_name)
+    blobs = bucket.list_blobs(prefix=gs_prefix(dir), page_size=REMOVE_PAGE_SIZE)
+    removed = 0
+    with concurrent.futures.ThreadPoolExecutor(
+        max_concurrency, thread_name_prefix="remove"
+    ) as executor:
+        deletes = ((blob,) for blob in blobs)
+        for future in submit_with_limit(
+            executor, _delete_blob, deletes, limit=2 * max_concurrency
+        ):
+            future.result()
+            removed += 1
+            if removed % REMOVE_PAGE_SIZE == 0:
+                logger.info(f"Removed {removed} objects from {dir}")
+    logger.info(
+        f"Removed {removed} objects from {dir} in {time.perf_counter() - start:.2f} s"
+    )
 
 
-async def _remove_gs_dir_async(dir: str):
-    """Removes gs dir"""
+def _delete_blob(blob: storage.Blob):
+    try:
+        _gs_call("delete", blob.delete)
+    except NotFound:
+        # removed by another run or an earlier attempt
+        pass
+
+
+async def _remove_gs_dir_async(dir: str, max_concurrency: int = 32):
+    """Removes gs dir, the next listing page is fetched while objects of the current
+    one are deleted by at most max_concurrency requests"""
     logger.debug(f"Removing gs dir {dir}")
+    start = time.perf_counter()
     bucket_name = dir.split("/")[2]
-    async with Storage() as client:
-        bucket = client.get_bucket(bucket_name)
-        blobs = await bucket.list_blobs(prefix="/".join(dir.split("/")[3:]))
-        tasks = []
-        for blob in blobs:
-            task = client.delete(bucket_name, blob)
-            tasks.append(task)
-        await asyncio.gather(*tasks)
+    removed = 0
+    async with _storage() as client:
+
+        async def list_page(page_token: Optional[str]) -> dict:
+            params = {"prefix": gs_prefix(dir), "maxResults": str(REMOVE_PAGE_SIZE)}
+            if page_token:
+                params["pageToken"] = page_token
+            return await _gs_call_async(
+                "list", lambda: client.list_objects(bucket_name, params=params)
+            )
+
+        async def delete(name: str):
+            try:
+                await _gs_call_async("delete", lambda: client.delete(bucket_name, name))
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise
+
+        next_page = asyncio.ensure_future(list_page(None))
+        try:
+            while next_page is not None:
+                page = await next_page
+                page_token = page.get("nextPageToken")
+                next_page = (
+                    asyncio.ensure_future(list_page(page_token)) if page_token else None
+                )
+                deletes = (delete(item["name"]) for item in page.get("items", []))
+                async with contextlib.aclosing(
+                    limit_concurrency(deletes, max_concurrency)
+                ) as deleted:
+                    async for done in deleted:
+                        done.result()
+                        removed += 1
+                logger.info(f"Removed {removed} objects from {dir}")
+        finally:
+            # a failed delete leaves the prefetched page behind, cancel it and
+            # retrieve its outcome so no request outlives the call, pending deletes
+            # are cancelled when limit_concurrency is closed
+            if next_page is not None:
+                next_page.cancel()
+                await asyncio.gather(next_page, return_exceptions=True)
+    logger.info(
+        f"Removed {removed} objects from {dir} in {time.perf_counter() - start:.2f} s"
+    )
 
 
-def remove_dir(dir: str):
-    """Removes dir"""
+def remove_dir(dir: str, max_concurrency: int = 32):
+    """Removes dir, gs objects are deleted by at most max_concurrency threads"""
     if dir.startswith("gs://"):
-        _remove_gs_dir(dir)
+        _remove_gs_dir(dir, max_concurrency)
     else:
         _remove_local_dir(dir)
 
 
-async def remove_dir_async(dir: str):
-    """Removes dir"""
+async def remove_dir_async(dir: str, max_concurrency: int = 32):
+    """Removes dir, gs objects are deleted by at most max_concurrency requests"""
     if dir.startswith("gs://"):
-        await _remove_gs_dir_async(dir)
+        await _remove_gs_dir_async(dir, max_concurrency)
     else:
         _remove_local_dir(dir)
 
 
-def _load_local_image(image: Union[pathlib.Path, str]) -> BytesIO:
-    """Loads image and returns bytes IO buffer"""
-    with open(image, "rb") as f:
-        image = f.read()
-    image_buffer = BytesIO(image)
+def open_text(path: str) -> TextIO:
+    """Opens local or gs text file for streaming line by line reads"""
+    if path.startswith("gs://"):
+        bucket_name = path.split("/")[2]
+        bucket = storage_client().bucket(bucket_name)
+        blob = bucket.blob("/".join(path.split("/")[3:]))
+        return blob.open("r", newline="")
+    return open(path, "r", newline="")
+
+
+def join_path(base_dir: str, *parts: str) -> str:
+    """Joins local or gs path parts, ignoring empty parts"""
+    parts = [part.strip("/") for part in parts if part and part.strip("/")]
+    if not parts:
+        return base_dir
+    if base_dir.startswith("gs://"):
+        return "/".join([base_dir.rstrip("/")] + parts)
+    return os.path.join(base_dir, *parts)
+
+
+def configure_download_cache(max_bytes: int):
+    """Sets the byte budget of the download cache shared by sync and async loaders,
+    0 disables caching"""
+    download_cache.resize(max_bytes)
+
+
+# gs objects of at least _slice_threshold bytes are downloaded in parallel byte ranges
+_slice_threshold = 0
+_slice_size = 8 * 2**20
+_slice_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_download_lock = threading.Lock()
+_download_stats = {
+    mode: {"objects": 0, "bytes": 0, "seconds": 0.0} for mode in ("single", "sliced")
+}
+
+
+def configure_sliced_downloads(
+    threshold_bytes: int, slice_bytes: int = 8 * 2**20, max_workers: int = 8
+):
+    """Downloads gs objects of at least threshold_bytes as slices of slice_bytes fetched
+    at the same time into one buffer, 0 downloads every object over a single stream.
+
+    Sync loaders fetch slices on a pool of max_workers threads, async loaders fetch all
+    slices of an object concurrently.
+    """
+    global _slice_threshold, _slice_size, _slice_pool
+    if _slice_pool is not None:
+        _slice_pool.shutdown()
+    _slice_pool = None
+    _slice_threshold = threshold_bytes
+    _slice_size = max(1, slice_bytes)
+    if threshold_bytes > 0:
+        _slice_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="slice"
+        )
+    with _download_lock:
+        for stats in _download_stats.values():
+            stats.update(objects=0, bytes=0, seconds=0.0)
+
+
+def download_throughput_stats() -> dict:
+    """Returns objects, bytes and seconds of single stream and sliced gs downloads"""
+    with _download_lock:
+        return {mode: dict(stats) for mode, stats in _download_stats.items()}
+
+
+def describe_download_throughput(stats: dict) -> str:
+    """Formats download stats, summed over processes, with throughput of both modes"""
+    parts = []
+    for mode in ("single", "sliced"):
+        mode_stats = stats.get(mode, {})
+        seconds = mode_stats.get("seconds", 0)
+        mb_per_s = mode_stats.get("bytes", 0) / 2**20 / seconds if seconds else 0
+        parts.append(
+            f"{mode} {mode_stats.get('objects', 0)} objects {mb_per_s:.1f} MB/s"
+        )
+    return ", ".join(parts)
+
+
+def _slices(size: int) -> List[Tuple[int, int]]:
+    return [
+        (start, min(start + _slice_size, size)) for start in range(0, size, _slice_size)
+    ]
+
+
+def _use_slices(size: Optional[int]) -> bool:
+    return _slice_threshold > 0 and size is not None and size >= _slice_threshold
+
+
+def _record_download(mode: str, size: int, seconds: float, name: str):
+    with _download_lock:
+        stats = _download_stats[mode]
+        stats["objects"] += 1
+        stats["bytes"] += size
+        stats["seconds"] += seconds
+    if mode == "sliced" and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"Sliced download of {name} {size / 2**20:.1f} MB in "
+            f"{len(_slices(size))} slices took {seconds * 1000:.0f} ms, "
+            f"{size / 2**20 / seconds:.1f} MB/s"
+        )
+
+
+def _download_blob(blob: storage.Blob) -> Union[bytes, bytearray]:
+    """Downloads gs object over one stream or as parallel byte ranges of one generation"""
+    start = time.perf_counter()
+    if not _use_slices(blob.size):
+        data = _gs_call("download", blob.download_as_bytes)
+        _record_download("single", len(data), time.perf_counter() - start, blob.name)
+        return data
+    data = bytearray(blob.size)
+    view = memoryview(data)
+
+    def fetch(byte_range: Tuple[int, int]):
+        first, last = byte_range
+        view[first:last] = _gs_call(
+            "download",
+            functools.partial(
+                blob.download_as_bytes,
+                start=first,
+                end=last - 1,
+                if_generation_match=blob.generation,
+            ),
+        )
+
+    list(_slice_pool.map(fetch, _slices(blob.size)))
+    _record_download("sliced", blob.size, time.perf_counter() - start, blob.name)
+    return data
+
+
+async def _download_blob_async(blob: Blob) -> Union[bytes, bytearray]:
+    """Downloads gs object over one stream or as concurrent byte ranges of one
+    generation"""
+    start = time.perf_counter()
+    size = int(blob.size)
+    if not _use_slices(size):
+        data = await _gs_call_async("download", blob.download)
+        _record_download("single", len(data), time.perf_counter() - start, blob.name)
+        return data
+    data = bytearray(size)
+    view = memoryview(data)
+    # Storage.download can't send query parameters, _download is the same request
+    # with the generation precondition, an overwritten object fails with 412
+    params = {"alt": "media", "ifGenerationMatch": str(blob.generation)}
+
+    async def fetch_range(first: int, last: int) -> bytes:
+        chunk = await blob.bucket.storage._download(
+            blob.bucket.name,
+            blob.name,
+            params=params,
+            headers={"Range": f"bytes={first}-{last - 1}"},
+        )
+        if len(chunk) != last - first:
+            raise aiohttp.ClientPayloadError(
+                f"Range {first}-{last - 1} of {blob.name} returned {len(chunk)} bytes"
+            )
+        return chunk
+
+    async def fetch(first: int, last: int):
+        view[first:last] = await _gs_call_async(
+            "download", lambda: fetch_range(first, last)
+        )
+
+    await asyncio.gather(*(fetch(first, last) for first, last in _slices(size)))
+    _record_download("sliced", size, time.perf_counter() - start, blob.name)
+    return data
+
+
+def _parse_crops(data: bytes) -> np.ndarray:
+    """Parses crops csv content into a read-only CROP_DTYPE array, lines are parsed in
+    chunks so the text is never split into a list of all lines"""
+    crops = parse_crop_specs(StringIO(str(data, "utf-8")))
+    # the array is shared by all tasks through the download cache
+    crops.flags.writeable = False
+    return crops
+
+
+def _crops_nbytes(crops: np.ndarray) -> int:
+    return crops.nbytes
+
+
+# local inputs are parsed straight from shared read-only memory mappings when set
+_mmap_inputs = False
+
+
+def configure_mmap_inputs(enabled: bool):
+    """Serves local images and crops from memory mappings shared by all tasks of the
+    process instead of reading a private copy of the file for every task"""
+    global _mmap_inputs
+    _mmap_inputs = enabled
+
+
+def _load_local(path: Union[pathlib.Path, str], parse: Callable, nbytes: Callable):
+    """Reads local file and parses it, cached by path, mtime and size"""
+
+    def load():
+        if _mmap_inputs:
+            return parse(map_file(path))
+        with open(path, "rb") as f:
+            return parse(f.read())
+
+    if not download_cache.enabled:
+        return load()
+    stat = os.stat(path)
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    return download_cache.get_or_load(key, load, nbytes)
+
+
+def _load_gs(path: str, parse: Callable, nbytes: Callable):
+    """Downloads gs object and parses it, cached by path and object generation"""
+    bucket_name = path.split("/")[2]
+    bucket = storage_client().bucket(bucket_name)
+    blob_name = "/".join(path.split("/")[3:])
+    if not download_cache.enabled and _slice_threshold == 0:
+        return parse(_download_blob(bucket.blob(blob_name)))
+    # fetch metadata first, generation changes every time the object is overwritten
+    # and the size decides if the object is downloaded in slices, a missing object
+    # raises NotFound
+    blob = bucket.blob(blob_name)
+    _gs_call("metadata", blob.reload)
+    if not download_cache.enabled:
+        return parse(_download_blob(blob))
+    key = (path, blob.generation)
+    return download_cache.get_or_load(key, lambda: parse(_download_blob(blob)), nbytes)
+
+
+async def _load_gs_async(path: str, parse: Callable, nbytes: Callable):
+    """Downloads gs object and parses it, cached by path and object generation"""
+    bucket_name = path.split("/")[2]
+    async with _storage() as client:
+        bucket = client.get_bucket(bucket_name)
+        blob_name = "/".join(path.split("/")[3:])
+        blob: Blob = await _gs_call_async(
+            "metadata", lambda: bucket.get_blob(blob_name)
+        )
+
+        async def load():
+            return parse(await _download_blob_async(blob))
+
+        key = (path, int(blob.generation))
+        return await download_cache.get_or_load_async(key, load, nbytes)
+
+
+def _load_local_image(image: Union[pathlib.Path, str]) -> Union[BytesIO, MappedFile]:
+    """Loads image and returns bytes IO buffer or a file over the shared mapping"""
+    data = _load_local(image, lambda data: data, len)
+    if isinstance(data, memoryview):
+        # hand the mapping to PIL without copying it into a BytesIO
+        return MappedFile(data)
+    image_buffer = BytesIO(data)
     image_buffer.seek(0)
     return image_buffer
 
 
 def download_crops_and_image(
     crops_path: str, image_path: str, trace_id: str
-) -> Tuple[BytesIO, List[Tuple[int, int, int, int]]]:
-    logger.debug(
-        f"Downloading crops csv and image",
-        extra={"trace_id": trace_id},
-    )
-    if image_path.startswith("gs://"):
-        image_buffer = _load_gs_image(image_path)
-    else:
-        image_buffer = _load_local_image(image_path)
-    if crops_path.startswith("gs://"):
-        lines = _load_gs_crops(crops_path)
-
-    else:
-        lines = _load_local_crops(crops_path)
-    crops_to_cut = [tuple(map(int, line.split(","))) for line in lines if line]
-    logger.debug(f"Loaded {len(crops_to_cut)} crops", extra={"trace_id": trace_id})
+) -> Tuple[BytesIO, np.ndarray]:
+    """Loads image and crops of an image in a download span"""
+    with span("download", trace_id) as timing:
+        if image_path.startswith("gs://"):
+            image_buffer = _load_gs_image(image_path)
+        else:
+            image_buffer = _load_local_image(image_path)
+        if crops_path.startswith("gs://"):
+            crops_to_cut = _load_gs_crops(crops_path)
+        else:
+            crops_to_cut = _load_local_crops(crops_path)
+        timing.bytes = image_buffer.getbuffer().nbytes + crops_to_cut.nbytes
+        timing.items = len(crops_to_cut)
     return image_buffer, crops_to_cut
 
 
 async def download_crops_and_image_async(
     crops_path: str, image_path: str, trace_id: str
-) -> Tuple[BytesIO, List[Tuple[int, int, int, int]]]:
-    logger.debug(
-        f"Downloading crops csv and image",
-        extra={"trace_id": trace_id},
-    )
-    if image_path.startswith("gs://"):
-        image_buffer = await _load_gs_image_async(image_path)
-    else:
-        image_buffer = _load_local_image(image_path)
-    if crops_path.startswith("gs://"):
-        lines = await _load_gs_crops_async(crops_path)
-
-    else:
-        lines = _load_local_crops(crops_path)
-    crops_to_cut = [tuple(map(int, line.split(","))) for line in lines if line]
-    logger.debug(f"Loaded {len(crops_to_cut)} crops", extra={"trace_id": trace_id})
+) -> Tuple[BytesIO, np.ndarray]:
+    """Loads image and crops of an image in a download span"""
+    with span("download", trace_id) as timing:
+        if image_path.startswith("gs://"):
+            image_buffer = await _load_gs_image_async(image_path)
+        else:
+            image_buffer = _load_local_image(image_path)
+        if crops_path.startswith("gs://"):
+            crops_to_cut = await _load_gs_crops_async(crops_path)
+        else:
+            crops_to_cut = _load_local_crops(crops_path)
+        timing.bytes = image_buffer.getbuffer().nbytes + crops_to_cut.nbytes
+        timing.items = len(crops_to_cut)
     return image_buffer, crops_to_cut
 
 
-def _load_local_crops(crops_path: Union[str, pathlib.Path]) -> List[str]:
-    with open(crops_path, "r") as f:
-        lines = f.readlines()[1:]
-    return lines
+def _load_local_crops(
+    crops_path: Union[str, pathlib.Path],
+) -> np.ndarray:
+    return _load_local(crops_path, _parse_crops, _crops_nbytes)
 
 
-def _load_gs_crops(crops_path: str) -> List[str]:
-    bucket_name = crops_path.split("/")[2]
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob("/".join(crops_path.split("/")[3:]))
-    lines = blob.download_as_bytes().decode().split("\n")[1:]
-    return lines
+def _load_gs_crops(crops_path: str) -> np.ndarray:
+    return _load_gs(crops_path, _parse_crops, _crops_nbytes)
 
 
-async def _load_gs_crops_async(crops_path: str) -> List[str]:
-    bucket_name = crops_path.split("/")[2]
-    async with Storage() as client:
-        bucket = client.get_bucket(bucket_name)
-        blob = await bucket.get_blob("/".join(crops_path.split("/")[3:]))
-        lines = (await blob.download()).decode().split("\n")[1:]
-        return lines
+async def _load_gs_crops_async(crops_path: str) -> np.ndarray:
+    return await _load_gs_async(crops_path, _parse_crops, _crops_nbytes)
 
 
 def _load_gs_image(image_path: str) -> BytesIO:
-    bucket_name = image_path.split("/")[2]
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob("/".join(image_path.split("/")[3:]))
-    image_buffer = BytesIO(blob.download_as_bytes())
-    return image_buffer
+    return BytesIO(_load_gs(image_path, lambda data: data, len))
 
 
 async def _load_gs_image_async(image_path: str) -> BytesIO:
-    bucket_name = image_path.split("/")[2]
-    async with Storage() as client:
-        bucket = client.get_bucket(bucket_name)
-        blob: Blob = await bucket.get_blob("/".join(image_path.split("/")[3:]))
-        image_buffer = BytesIO(await blob.download())
-        return image_buffer
+    return BytesIO(await _load_gs_async(image_path, lambda data: data, len))
+
+
+# process-wide pool saving crops of all tasks, a pool per call is used until configured
+_upload_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+# global limit of uploads submitted to the pool and not finished yet
+_upload_slots: Optional[threading.BoundedSemaphore] = None
+_upload_lock = threading.Lock()
+_upload_stats = {
+    "threads": 0,
+    "uploads": 0,
+    "queued": 0,
+    "max_queue_depth": 0,
+    "wait_seconds": 0.0,
+    "upload_seconds": 0.0,
+}
+
+
+def configure_upload_pool(max_workers: int, max_in_flight: int = 0):
+    """Sets number of threads shared by all tasks of the process to save crops,
+    0 creates a new pool for every image.
+
+    max_in_flight caps uploads submitted by all tasks and not finished yet, submitting
+    tasks block until a slot frees up, 0 means no limit.
+    """
+    global _upload_pool, _upload_slots
+    if _upload_pool is not None:
+        _upload_pool.shutdown()
+    _upload_pool = None
+    _upload_slots = None
+    with _upload_lock:
+        for key in _upload_stats:
+            _upload_stats[key] = 0
+    if max_workers > 0:
+        _upload_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix="upload"
+        )
+        _upload_stats["threads"] = max_workers
+    if max_in_flight > 0:
+        _upload_slots = threading.BoundedSemaphore(max_in_flight)
+
+
+def upload_pool_stats() -> dict:
+    """Returns thread count, queue depth and summed wait and upload time of the pool"""
+    with _upload_lock:
+        return dict(_upload_stats)
+
+
+def describe_upload_stats(stats: dict) -> str:
+    """Formats upload pool stats, summed over processes, with mean latencies"""
+    uploads = max(1, stats.get("uploads", 0))
+    return (
+        f"{stats.get('threads', 0)} threads, {stats.get('uploads', 0)} uploads, "
+        f"max queue depth {stats.get('max_queue_depth', 0)}, "
+        f"mean queue wait {1000 * stats.get('wait_seconds', 0) / uploads:.2f} ms, "
+        f"mean upload {1000 * stats.get('upload_seconds', 0) / uploads:.2f} ms"
+    )
+
+
+def _pooled_save(save: Callable, buffer, save_dir, filename, submitted: float):
+    """Runs save on the upload pool and records queue wait and upload latency"""
+    started = time.perf_counter()
+    with _upload_lock:
+        _upload_stats["queued"] -= 1
+    try:
+        return save(buffer, save_dir, filename)
+    finally:
+        finished = time.perf_counter()
+        with _upload_lock:
+            _upload_stats["uploads"] += 1
+            _upload_stats["wait_seconds"] += started - submitted
+            _upload_stats["upload_seconds"] += finished - started
+        if _upload_slots is not None:
+            _upload_slots.release()
+
+
+def _submit_upload(save: Callable, buffer, save_dir, filename):
+    if _upload_slots is not None:
+        _upload_slots.acquire()
+    with _upload_lock:
+        _upload_stats["queued"] += 1
+        _upload_stats["max_queue_depth"] = max(
+            _upload_stats["max_queue_depth"], _upload_stats["queued"]
+        )
+    return _upload_pool.submit(
+        _pooled_save, save, buffer, save_dir, filename, time.perf_counter()
+    )
 
 
 def save_image_buffers_with_threadpool(
     buffers: List[BytesIO], save_dir: str, trace_id: str, max_threads: int = None
 ):
-    """Saves image buffers to save_dir with random uuid as filename"""
-    logger.debug(
-        f"Saving {len(buffers)} images to {save_dir}", extra={"trace_id": trace_id}
+    """Saves image buffers to save_dir with random uuid as filename, in shard
+    subdirectories when configure_output_sharding set them up, or appends them to
+    the tar shard of save_dir when configure_packed_output set packing up.
+
+    Files are saved on the process-wide upload pool when configure_upload_pool set
+    one up, otherwise on a new pool of max_threads threads. All crops are saved in
+    one upload span.
+    """
+    if not save_dir.startswith("gs://"):
+        os.makedirs(save_dir, exist_ok=True)
+    with span("upload", trace_id, _buffers_nbytes(buffers), len(buffers)):
+        writer = _packed_writer(save_dir)
+        if writer is not None:
+            writer.add(trace_id, buffers)
+            return
+        save = _save_gs_file if save_dir.startswith("gs://") else _save_local_file
+        if _upload_pool is not None:
+            futures = [
+                _submit_upload(save, buffer, save_dir, _output_filename())
+                for buffer in buffers
+            ]
+            _wait_for_saves(futures)
+            return
+        # use ThreadPoolExecutor to save files in parallel
+        if max_threads is None:
+            max_threads = max(1, os.cpu_count() // 2)
+        with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
+            futures = [
+                executor.submit(save, buffer, save_dir, _output_filename())
+                for buffer in buffers
+            ]
+            _wait_for_saves(futures)
+
+
+def _wait_for_saves(futures: List[concurrent.futures.Future]):
+    for future in concurrent.futures.as_completed(futures):
+        future.result()
+
+
+def _buffers_nbytes(buffers: List[BytesIO]) -> int:
+    return sum(buffer.getbuffer().nbytes for buffer in buffers)
+
+
+# crops are spread over hash prefixed subdirectories / object name prefixes when set
+_shard_depth = 0
+_shard_fan_out = 256
+# filename suffix of saved crops, matches the output format crops are encoded to
+_output_suffix = ".jpg"
+
+
+def configure_output_suffix(suffix: str):
+    """Sets filename suffix of saved crops and of crops in tar shards, counted by
+    count_output_files"""
+    global _output_suffix
+    _output_suffix = suffix
+
+
+def configure_output_sharding(depth: int, fan_out: int = 256):
+    """Saves crops under depth levels of subdirectories (or gs object name prefixes)
+    with fan_out shards per level picked by a hash of the filename, 0 saves flat.
+
+    Validation and removal walk output dirs recursively and cover both layouts.
+    """
+    global _shard_depth, _shard_fan_out
+    _shard_depth = depth
+    _shard_fan_out = max(2, fan_out)
+
+
+def _output_filename() -> str:
+    """Returns random crop filename, prefixed with its shard path when sharding is on"""
+    filename = f"{uuid.uuid4()}{_output_suffix}"
+    if _shard_depth == 0:
+        return filename
+    digest = int.from_bytes(
+        hashlib.blake2b(filename.encode(), digest_size=8).digest(), "big"
+    )
+    width = len(f"{_shard_fan_out - 1:x}")
+    shards = []
+    for _ in range(_shard_depth):
+        digest, shard = divmod(digest, _shard_fan_out)
+        shards.append(f"{shard:0{width}x}")
+    return "/".join(shards + [filename])
+
+
+def count_output_files(dir: str, suffix: Optional[str] = None) -> int:
+    """Counts files with suffix, the configured output suffix by default, under local
+    dir and all its shard subdirectories"""
+    suffix = suffix or _output_suffix
+    count = 0
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                count += count_output_files(entry.path, suffix)
+            elif entry.name.endswith(suffix):
+                count += 1
+    return count
+
+
+# crops are packed into rolling tar shards per output dir when set, a file per crop
+# is saved otherwise
+_packed_max_bytes = 0
+_packed_max_images = 0
+_packed_writers: Dict[str, PackedShardWriter] = {}
+_packed_lock = threading.Lock()
+
+
+def configure_packed_output(max_bytes: int, max_images: int = 0):
+    """Packs crops of many images into tar shards of at most max_bytes bytes or
+    max_images images with an index per shard, saved as one file or one GCS object
+    per shard instead of one per crop, 0 for both saves a file per crop.
+
+    Shards still open are finished by close_packed_output.
+    """
+    global _packed_max_bytes, _packed_max_images
+    close_packed_output()
+    _packed_max_bytes = max_bytes
+    _packed_max_images = max_images
+
+
+def _packed_writer(save_dir: str) -> Optional[PackedShardWriter]:
+    if not (_packed_max_bytes or _packed_max_images):
+        return None
+    with _packed_lock:
+        writer = _packed_writers.get(save_dir)
+        if writer is None:
+            save = _save_gs_file if save_dir.startswith("gs://") else _save_local_file
+            writer = _packed_writers[save_dir] = PackedShardWriter(
+                save_dir, save, _packed_max_bytes, _packed_max_images, _output_suffix
+            )
+    return writer
+
+
+def close_packed_output():
+    """Finishes open shards of all output dirs of the process, called at the end of
+    a run and by worker processes on exit"""
+    with _packed_lock:
+        writers = list(_packed_writers.values())
+        _packed_writers.clear()
+    for writer in writers:
+        stats = writer.close()
+        logger.debug(f"Closed packed output of {writer.save_dir}: {stats}")
+
+
+def _packed_indexes(dir: str) -> Iterator[str]:
+    """Yields paths of shard indexes under dir and its subdirectories"""
+    if dir.startswith("gs://"):
+        bucket_name = dir.split("/")[2]
+        for blob in storage_client().list_blobs(bucket_name, prefix=gs_prefix(dir)):
+            if blob.name.endswith(INDEX_SUFFIX):
+                yield f"gs://{bucket_name}/{blob.name}"
+        return
+    for root, _, files in os.walk(dir):
+        for name in files:
+            if name.endswith(INDEX_SUFFIX):
+                yield os.path.join(root, name)
+
+
+def _packed_index_nbytes(index: dict) -> int:
+    # rough size of a parsed index entry, a key string and an offset and size tuple
+    return 200 * len(index["members"])
+
+
+def _load_packed_index(index_path: str) -> dict:
+    if index_path.startswith("gs://"):
+        return _load_gs(index_path, parse_index, _packed_index_nbytes)
+    return _load_local(index_path, parse_index, _packed_index_nbytes)
+
+
+def packed_output_stats(dir: str) -> dict:
+    """Returns shard, crop and byte counts of packed output under dir read from the
+    shard indexes, which covers shards written by every process of the run"""
+    stats = {"shards": 0, "crops": 0, "bytes": 0}
+    for index_path in _packed_indexes(dir):
+        index = _load_packed_index(index_path)
+        stats["shards"] += 1
+        stats["crops"] += len(index["members"])
+        stats["bytes"] += index["size"]
+    return stats
+
+
+def describe_packed_output(stats: dict) -> str:
+    """Formats packed output stats with the objects saved by packing"""
+    return (
+        f"{stats['crops']} crops in {stats['shards']} shards, "
+        f"{stats['bytes'] / 2**20:.1f} MB, {2 * stats['shards']} objects with "
+        f"indexes instead of {stats['crops']}"
+    )
+
+
+def read_packed_crop(shard_path: str, key: str) -> bytes:
+    """Returns bytes of crop key (trace_id/0000.jpg) of the tar shard at shard_path,
+    looked up in the index of the shard and read as a single byte range"""
+    offset, size = _load_packed_index(index_name(shard_path))["members"][key]
+    if not shard_path.startswith("gs://"):
+        with open(shard_path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+    bucket = storage_client().bucket(shard_path.split("/")[2])
+    blob = bucket.blob("/".join(shard_path.split("/")[3:]))
+    return _gs_call(
+        "download",
+        functools.partial(blob.download_as_bytes, start=offset, end=offset + size - 1),
     )
-    # use ThreadPoolExecutor to save files in parallel
-    if max_threads is None:
-        max_threads = os.cpu_count() // 2
-    with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
-        futures = []
-        for buffer in buffers:
-            filename = f"{uuid.uuid4()}.jpg"
-            if save_dir.startswith("gs://"):
-                task = executor.submit(_save_gs_file, buffer, save_dir, filename)
-            else:
-                task = executor.submit(_save_local_file, buffer, save_dir, filename)
-            futures.append(task)
-        for i, future in enumerate(concurrent.futures.as_completed(futures)):
-            future.result()
-            if i % 25 == 0:
-                logger.debug(f"Saved crop {i} to storage", extra={"trace_id": trace_id})
-    logger.debug(f"Saved all images", extra={"trace_id": trace_id})
 
 
 def _save_local_file(buffer: BytesIO, save_dir: str, filename: str) -> str:
-    with open(os.path.join(save_dir, filename), "wb") as f:
+    path = os.path.join(save_dir, filename)
+    try:
+        f = open(path, "wb")
+    except FileNotFoundError:
+        # first crop of a shard creates its directory
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, "wb")
+    with f:
         f.write(buffer.read())
         return f.name
 
@@ -194,18 +928,27 @@ async def _save_local_file_async(buffer: BytesIO, save_dir: str, filename: str)
 
 def _save_gs_file(buffer: BytesIO, save_dir: str, filename: str) -> str:
     bucket_name = save_dir.split("/")[2]
-    bucket = storage_client.bucket(bucket_name)
+    bucket = storage_client().bucket(bucket_name)
     blob_name = "/".join(save_dir.split("/")[3:] + [filename])
     blob = bucket.blob(blob_name)
-    blob.upload_from_file(buffer)
+    data = buffer.read()
+    # every attempt reads its own view, hedged attempts upload concurrently, a known
+    # size makes it a single multipart request instead of a resumable upload session
+    _gs_call(
+        "upload",
+        lambda **kwargs: blob.upload_from_file(BytesIO(data), size=len(data), **kwargs),
+    )
     return blob.path
 
 
 async def _save_gs_file_async(buffer: BytesIO, save_dir: str, filename: str) -> str:
     bucket_name = save_dir.split("/")[2]
-    async with Storage() as client:
+    async with _storage() as client:
         blob_name = "/".join(save_dir.split("/")[3:] + [filename])
-        await client.upload(bucket_name, blob_name, buffer)
+        data = buffer.read()
+        await _gs_call_async(
+            "upload", lambda: client.upload(bucket_name, blob_name, BytesIO(data))
+        )
         return blob_name
 
 
@@ -213,31 +956,32 @@ async def save_image_buffers_async(
     buffers: List[BytesIO],
     save_dir: str,
     trace_id: str,
-    max_concurrency: Optional[int] = None,
+    max_concurrency: Optional[Union[int, AdaptiveLimit]] = None,
 ):
-    """Saves image buffers to save_dir with random uuid as filename"""
+    """Saves image buffers to save_dir (or its shards) with random uuid as filename,
+    or appends them to the tar shard of save_dir when packing is on, max_concurrency
+    may be an AdaptiveLimit shared by all images"""
     if max_concurrency is None:
-        max_concurrency = os.cpu_count() // 2
-    logger.debug(
-        f"Saving {len(buffers)} images to save_dir", extra={"trace_id": trace_id}
-    )
-    tasks = []
-    for buffer in buffers:
-        filename = f"{uuid.uuid4()}.jpg"
-        if save_dir.startswith("gs://"):
-            task = _save_gs_file_async(buffer, save_dir, filename)
+        max_concurrency = max(1, os.cpu_count() // 2)
+    if not save_dir.startswith("gs://"):
+        os.makedirs(save_dir, exist_ok=True)
+    with span("upload", trace_id, _buffers_nbytes(buffers), len(buffers)):
+        writer = _packed_writer(save_dir)
+        if writer is not None:
+            # appends are quick, a full gs shard is uploaded by the thread of this image
+            await asyncio.to_thread(writer.add, trace_id, buffers)
         else:
-            task = _save_local_file_async(buffer, save_dir, filename)
-        tasks.append(task)
-    done_counter = 0
-    async for _ in limit_concurrency(tasks, max_concurrency):
-        if done_counter % 25 == 0:
-            logger.debug(
-                f"Saved crop {done_counter} to storage", extra={"trace_id": trace_id}
-            )
-        done_counter += 1
+            tasks = []
+            for buffer in buffers:
+                filename = _output_filename()
+                if save_dir.startswith("gs://"):
+                    task = _save_gs_file_async(buffer, save_dir, filename)
+                else:
+                    task = _save_local_file_async(buffer, save_dir, filename)
+                tasks.append(task)
+            async for _ in limit_concurrency(tasks, max_concurrency):
+                pass
 
     for buffer in buffers:
         buffer.close()
         await asyncio.sleep(0)
-    logger.debug(f"Saved all images", extra={"trace_id": trace_id})
@@ -0,0 +1,172 @@
+import struct
+from io import BytesIO
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from mixed_io_cpu_task.crop_specs import CropSpecs, as_crop_array
+
+# start of frame markers of sequential huffman coded JPEGs (baseline and extended)
+SEQUENTIAL_SOF_MARKERS = {0xC0, 0xC1}
+# all start of frame markers, 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the range
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers without a length field
+STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+class JpegLayout(NamedTuple):
+    """Frame parameters read from JPEG headers"""
+
+    sof_marker: int
+    # byte offset of the 16-bit image height in the start of frame segment
+    height_offset: int
+    width: int
+    height: int
+    mcu_width: int
+    mcu_height: int
+    num_components: int
+    # number of components in the first scan, equal to num_components when interleaved
+    first_scan_components: int
+
+    @property
+    def sequential(self) -> bool:
+        """Returns True for baseline and extended sequential JPEGs"""
+        return self.sof_marker in SEQUENTIAL_SOF_MARKERS
+
+    @property
+    def single_scan(self) -> bool:
+        """Returns True when one sequential scan holds all components"""
+        return self.sequential and self.first_scan_components == self.num_components
+
+
+def read_jpeg_layout(data: bytes) -> Optional[JpegLayout]:
+    """Reads frame layout from JPEG markers, returns None for other formats"""
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    frame = None
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in STANDALONE_MARKERS:
+            pos += 2
+            continue
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        segment = pos + 4
+        if marker in SOF_MARKERS:
+            height, width, num_components = struct.unpack_from(
+                ">HHB", data, segment + 1
+            )
+            sampling = [data[segment + 6 + 3 * i + 1] for i in range(num_components)]
+            max_h = max(factor >> 4 for factor in sampling)
+            max_v = max(factor & 0x0F for factor in sampling)
+            frame = (
+                marker,
+                segment + 1,
+                width,
+                height,
+                8 * max_h,
+                8 * max_v,
+                num_components,
+            )
+        elif marker == 0xDA:
+            if frame is None:
+                return None
+            return JpegLayout(*frame, first_scan_components=data[segment])
+        elif marker == 0xD9:
+            return None
+        pos = segment + length - 2
+    return None
+
+
+def crops_bounding_box(crops_to_cut: CropSpecs) -> Tuple[int, int, int, int]:
+    """Returns (left, upper, right, lower) box covering all crops"""
+    specs = as_crop_array(crops_to_cut)
+    x, y = specs["x"].astype(np.int64), specs["y"].astype(np.int64)
+    left = int(x.min())
+    upper = int(y.min())
+    right = int((x + specs["w"]).max())
+    lower = int((y + specs["h"]).max())
+    return left, upper, right, lower
+
+
+def decode_jpeg_rows(data: bytes, rows: int) -> Optional[Image.Image]:
+    """Decodes only the top rows of a sequential JPEG.
+
+    libjpeg decodes MCU rows top to bottom, so everything below the last needed MCU row
+    is skipped by lowering the frame height in the start of frame segment. One extra MCU
+    row is decoded so chroma upsampling of the last needed row matches a full decode.
+    Returns None when the image can't be decoded partially or when skipping less than
+    1/8 of the rows isn't worth the copy of the patched file.
+    """
+    layout = read_jpeg_layout(data)
+    if layout is None or not layout.single_scan or layout.height == 0:
+        return None
+    mcu_rows = -(-rows // layout.mcu_height) + 1
+    height = mcu_rows * layout.mcu_height
+    if 8 * height > 7 * layout.height:
+        return None
+    patched = bytearray(data)
+    struct.pack_into(">H", patched, layout.height_offset, height)
+    image = Image.open(BytesIO(patched))
+    image.load()
+    return image
+
+
+def mcu_aligned(crops: np.ndarray, layout: JpegLayout) -> np.ndarray:
+    """Returns mask of crops whose top left corner lies on the MCU grid, the right and
+    bottom edge of a crop may cut through an MCU"""
+    return (crops["x"] % layout.mcu_width == 0) & (crops["y"] % layout.mcu_height == 0)
+
+
+def snap_to_mcu(crops: np.ndarray, layout: JpegLayout) -> np.ndarray:
+    """Moves the top left corner of every crop up and left onto the MCU grid and grows
+    the crop by the same amount, so it still covers the requested rect"""
+    snapped = crops.copy()
+    dx = crops["x"] % layout.mcu_width
+    dy = crops["y"] % layout.mcu_height
+    snapped["x"] -= dx
+    snapped["w"] += dx
+    snapped["y"] -= dy
+    snapped["h"] += dy
+    return snapped
+
+
+_turbojpeg = None
+
+
+def load_turbojpeg():
+    """Returns shared TurboJPEG instance, raises ImportError naming the package to
+    install when PyTurboJPEG is missing"""
+    global _turbojpeg
+    if _turbojpeg is None:
+        try:
+            import turbojpeg
+        except ImportError as e:
+            raise ImportError(
+                "lossless crops need the PyTurboJPEG package, "
+                "install it with pip install PyTurboJPEG"
+            ) from e
+        _turbojpeg = turbojpeg.TurboJPEG()
+    return _turbojpeg
+
+
+def crop_jpeg_lossless(data: bytes, crops: np.ndarray) -> List[bytes]:
+    """Cuts MCU aligned crops out of a JPEG in the DCT domain like jpegtran -crop.
+
+    libjpeg-turbo copies the entropy decoded coefficients of the blocks inside every
+    crop without the inverse DCT, colour conversion and re-encoding, so crops keep the
+    quality and the quantization tables of the source.
+    """
+    jpeg = load_turbojpeg()
+    rects = [tuple(crop) for crop in crops.tolist()]
+    if hasattr(jpeg, "crop_multiple"):
+        # the source is parsed once for all crops
+        return list(jpeg.crop_multiple(data, rects))
+    return [jpeg.crop(data, x, y, w, h) for x, y, w, h in rects]
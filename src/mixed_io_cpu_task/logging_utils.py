@@ -1,12 +1,169 @@
+import glob
+import heapq
 import logging
+import logging.handlers
+import os
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from typing import List, NamedTuple, Optional
+
 from pythonjsonlogger import jsonlogger
 
+# how records of worker processes reach the log file: queue puts every record on a
+# multiprocessing queue, batched puts lists of records, files writes a file per
+# process merged after the run
+LOG_TRANSPORTS = ("queue", "batched", "files")
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO}
+
+# keep debug records of 1 in _sample_every traces, 1 keeps all of them
+_sample_every = 1
+
+
+class LogOptions(NamedTuple):
+    """Logging of a run, passed to worker initializers"""
+
+    transport: str = "queue"
+    level: int = logging.DEBUG
+    sample_every: int = 1
+    # log file name without .log, process files of the files transport derive from it
+    filename: str = ""
 
-def configure_logger(logger, filename: str):
-    logger.setLevel(level=logging.DEBUG)
+
+def _json_formatter() -> logging.Formatter:
+    return jsonlogger.JsonFormatter("%(asctime)%(levelname)%(name)%(message)")
+
+
+def configure_logger(logger, filename: str, level: int = logging.DEBUG):
+    logger.setLevel(level=level)
     file_handler = logging.FileHandler(f"{filename}.log", mode="w")
     file_handler.setLevel(level=logging.DEBUG)
-    formatter = jsonlogger.JsonFormatter("%(asctime)%(levelname)%(name)%(message)")
+    formatter = _json_formatter()
     file_handler.setFormatter(formatter)
 
     logger.addHandler(file_handler)
+
+
+def configure_log_sampling(every: int):
+    """Keeps debug records of trace ids of 1 in every traces, 1 keeps all of them"""
+    global _sample_every
+    _sample_every = max(1, every)
+
+
+def log_enabled(logger, level: int, trace_id=None) -> bool:
+    """Returns if a record of trace_id at level is kept, checked before the message
+    of a record on the hot path is built.
+
+    Traces are sampled by a hash of their id, so every process keeps the same traces
+    and a kept trace has all its records.
+    """
+    if not logger.isEnabledFor(level):
+        return False
+    if _sample_every == 1 or trace_id is None or level > logging.DEBUG:
+        return True
+    return zlib.crc32(str(trace_id).encode()) % _sample_every == 0
+
+
+class BatchQueueHandler(logging.handlers.QueueHandler):
+    """Puts lists of records on the queue, a list is sent when it holds batch_size
+    records, when its first record is older than max_delay seconds or on flush"""
+
+    def __init__(self, queue, batch_size: int = 256, max_delay: float = 1.0):
+        super().__init__(queue)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._reset_batch()
+        # a forked worker must not send the records its parent had not sent yet
+        os.register_at_fork(after_in_child=self._reset_batch)
+
+    def _reset_batch(self):
+        self._batch: List[logging.LogRecord] = []
+        self._batch_started = 0.0
+        self._batch_lock = threading.Lock()
+
+    def enqueue(self, record: logging.LogRecord):
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_started = time.monotonic()
+            self._batch.append(record)
+            if (
+                len(self._batch) < self.batch_size
+                and time.monotonic() - self._batch_started < self.max_delay
+            ):
+                return
+            batch, self._batch = self._batch, []
+        self.queue.put_nowait(batch)
+
+    def flush(self):
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self.queue.put_nowait(batch)
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+def handle_queued(item):
+    """Handles a record or a list of records taken from a logging queue"""
+    for record in item if isinstance(item, list) else [item]:
+        logging.getLogger(record.name).handle(record)
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    """Queue listener also taking lists of records put by BatchQueueHandler"""
+
+    def handle(self, record):
+        for item in record if isinstance(record, list) else [record]:
+            super().handle(item)
+
+
+def flush_batches(logger):
+    """Sends records the batching handlers of logger still hold"""
+    for handler in logger.handlers:
+        if isinstance(handler, BatchQueueHandler):
+            handler.flush()
+
+
+def process_log_filename(filename: str, pid: Optional[int] = None) -> str:
+    """Returns the log file of a process of the files transport, not ending in .log
+    so globs of plot-logs skip it"""
+    return f"{filename}.log.{os.getpid() if pid is None else pid}"
+
+
+def configure_process_log_file(logger, filename: str, level: int = logging.DEBUG):
+    """Logs records of this process into its own file, merged by merge_process_logs"""
+    file_handler = logging.FileHandler(process_log_filename(filename), mode="w")
+    file_handler.setFormatter(_json_formatter())
+    logger.addHandler(file_handler)
+    logger.setLevel(level)
+
+
+def remove_process_logs(filename: str):
+    """Removes process log files left by a previous run of filename"""
+    for path in glob.glob(glob.escape(filename) + ".log.*"):
+        os.remove(path)
+
+
+def merge_process_logs(logger, filename: str) -> int:
+    """Merges process log files into filename.log sorted by time and removes them.
+
+    Records of a file are already in order, the files are merged lazily on asctime,
+    the first field of every record. Records of the main log come last when times are
+    equal, so its final elapsed record stays last. Returns the number of files merged.
+    """
+    for handler in logger.handlers:
+        handler.flush()
+    paths = sorted(glob.glob(glob.escape(filename) + ".log.*"))
+    main_log = f"{filename}.log"
+    merged_log = f"{filename}.log.merged"
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(path)) for path in paths + [main_log]]
+        with open(merged_log, "w") as merged:
+            merged.writelines(heapq.merge(*files, key=lambda line: line[:40]))
+    os.replace(merged_log, main_log)
+    for path in paths:
+        os.remove(path)
+    return len(paths)
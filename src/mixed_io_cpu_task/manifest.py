@@ -0,0 +1,64 @@
+import csv
+import json
+import logging
+from typing import Iterator, NamedTuple, Optional, Dict
+
+from mixed_io_cpu_task.io_utils import open_text, join_path
+
+logger = logging.getLogger("default")
+
+MANIFEST_COLUMNS = ("image_path", "crops_path", "output_prefix")
+
+
+class Task(NamedTuple):
+    """Single unit of work - crop one image with one crops spec into one output dir"""
+
+    trace_id: str
+    image_path: str
+    crops_path: str
+    output_dir: str
+
+
+def iter_manifest(manifest_path: str) -> Iterator[Dict[str, str]]:
+    """Streams manifest rows one by one, never loading the whole file.
+
+    CSV manifests need a header row, JSONL manifests hold one object per line.
+    Both use image_path, crops_path and output_prefix keys.
+    """
+    with open_text(manifest_path) as f:
+        if manifest_path.endswith((".jsonl", ".ndjson")):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def iter_tasks(
+    input_image: str,
+    crops: str,
+    output_dir: str,
+    num_repeats: int,
+    manifest: Optional[str] = None,
+) -> Iterator[Task]:
+    """Yields tasks lazily.
+
+    Without manifest the same input image and crops are repeated num_repeats times.
+    With manifest every row becomes a task and the manifest is read num_repeats times,
+    blank image_path / crops_path columns fall back to input_image / crops and
+    output_prefix is resolved relative to output_dir.
+    """
+    if manifest is None:
+        for i in range(num_repeats):
+            yield Task(str(i), input_image, crops, output_dir)
+        return
+    i = 0
+    for _ in range(num_repeats):
+        for row in iter_manifest(manifest):
+            yield Task(
+                str(i),
+                row.get("image_path") or input_image,
+                row.get("crops_path") or crops,
+                join_path(output_dir, row.get("output_prefix") or ""),
+            )
+            i += 1
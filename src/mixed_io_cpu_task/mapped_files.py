@@ -0,0 +1,78 @@
+import io
+import mmap
+import os
+import threading
+from typing import Dict, Tuple, Union
+
+# read-only mappings shared by all tasks of the process, keyed by path, mtime and size
+_mappings: Dict[Tuple[str, int, int], Union[mmap.mmap, bytes]] = {}
+_lock = threading.Lock()
+
+
+def map_file(path: Union[str, os.PathLike]) -> memoryview:
+    """Returns read-only view of the whole file backed by a memory mapping shared with
+    every other caller of the process, pages are read from the page cache on access.
+
+    A file changed on disk gets a new mapping, views of the old one stay valid.
+    """
+    stat = os.stat(path)
+    key = (str(path), stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        mapping = _mappings.get(key)
+        if mapping is None:
+            for old_key in [k for k in _mappings if k[0] == key[0]]:
+                del _mappings[old_key]
+            mapping = _mappings[key] = _map(path, stat.st_size)
+    return memoryview(mapping)
+
+
+def _map(path, size: int) -> Union[mmap.mmap, bytes]:
+    if size == 0:
+        # empty files can't be mapped
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only seekable file over a shared memory view with its own position.
+
+    Stands in for BytesIO so PIL reads the image in blocks straight from the mapping,
+    getbuffer returns the view without copying and getvalue copies it into bytes.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._view[self._pos : self._pos + len(buffer)]
+        buffer[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f"negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def getbuffer(self) -> memoryview:
+        return self._view[:]
+
+    def getvalue(self) -> bytes:
+        return self._view.tobytes()
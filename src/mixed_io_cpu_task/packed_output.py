@@ -0,0 +1,147 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import uuid
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+
+# the index of a shard is saved next to it once the shard is complete
+INDEX_SUFFIX = ".idx.json"
+
+
+def index_name(shard_name: str) -> str:
+    """Returns the name of the index of a shard"""
+    return shard_name + INDEX_SUFFIX
+
+
+def crop_key(trace_id: str, i: int, suffix: str = ".jpg") -> str:
+    """Returns tar member name of crop i of the image of trace_id"""
+    return f"{trace_id}/{i:04d}{suffix}"
+
+
+def parse_index(data: bytes) -> dict:
+    """Returns shard index with size of the shard in bytes and members mapping every
+    crop key to the (offset, size) of its bytes in the shard"""
+    index = json.loads(data)
+    index["members"] = {
+        key: tuple(location) for key, location in index["members"].items()
+    }
+    return index
+
+
+class _Shard:
+    """Tar shard being written, straight to its file or to memory until uploaded"""
+
+    def __init__(self, name: str, fileobj: BinaryIO):
+        self.name = name
+        self.fileobj = fileobj
+        self.tar = tarfile.open(fileobj=fileobj, mode="w", format=tarfile.GNU_FORMAT)
+        self.members: Dict[str, Tuple[int, int]] = {}
+        self.images = 0
+
+    def add(self, key: str, buffer: BinaryIO):
+        size = buffer.seek(0, io.SEEK_END)
+        buffer.seek(0)
+        info = tarfile.TarInfo(key)
+        info.size = size
+        info.mtime = int(time.time())
+        self.tar.addfile(info, buffer)
+        # the data ends on the first 512 byte block boundary before tar.offset
+        padded = -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.members[key] = (self.tar.offset - padded, size)
+
+    @property
+    def size(self) -> int:
+        return self.tar.offset
+
+    def close(self) -> bytes:
+        """Writes the end of archive marker and returns the index of the shard"""
+        self.tar.close()
+        # closing pads the archive to a whole record, the file position is its size
+        self.closed_size = self.fileobj.tell()
+        return json.dumps({"size": self.closed_size, "members": self.members}).encode()
+
+
+class PackedShardWriter:
+    """Packs crops of many images into rolling tar shards of save_dir, so a shard of
+    thousands of crops is one file or one GCS object instead of one per crop.
+
+    A shard is finished once it holds max_images images or max_bytes bytes, 0 leaves
+    that bound off. Local shards are streamed straight to disk, GCS shards are built
+    in memory and uploaded as a single object. Every finished shard gets an index with
+    the offset and size of each crop, saved after the shard with save(buffer,
+    save_dir, filename) so an index is only visible for a complete shard.
+
+    add is thread safe, finished shards are saved outside the lock.
+    """
+
+    def __init__(
+        self,
+        save_dir: str,
+        save: Callable[[BinaryIO, str, str], str],
+        max_bytes: int = 0,
+        max_images: int = 0,
+        suffix: str = ".jpg",
+    ):
+        self.save_dir = save_dir
+        self._save = save
+        self._local = not save_dir.startswith("gs://")
+        self._max_bytes = max_bytes
+        self._max_images = max_images
+        self._suffix = suffix
+        self._prefix = f"shard-{uuid.uuid4().hex[:12]}"
+        self._next_shard = 0
+        self._shard: Optional[_Shard] = None
+        self._lock = threading.Lock()
+        self._stats = {"shards": 0, "images": 0, "crops": 0, "bytes": 0}
+
+    def add(self, trace_id: str, buffers: List[BinaryIO]) -> List[str]:
+        """Appends crops of one image to the current shard and returns their keys"""
+        with self._lock:
+            if self._shard is None:
+                self._shard = self._open_shard()
+            shard = self._shard
+            keys = [crop_key(trace_id, i, self._suffix) for i in range(len(buffers))]
+            for key, buffer in zip(keys, buffers):
+                shard.add(key, buffer)
+            shard.images += 1
+            full = (self._max_images and shard.images >= self._max_images) or (
+                self._max_bytes and shard.size >= self._max_bytes
+            )
+            if full:
+                self._shard = None
+        if full:
+            self._finish(shard)
+        return keys
+
+    def close(self) -> dict:
+        """Finishes the current shard and returns shard, image, crop and byte counts"""
+        with self._lock:
+            shard, self._shard = self._shard, None
+        if shard is not None:
+            self._finish(shard)
+        with self._lock:
+            return dict(self._stats)
+
+    def _open_shard(self) -> _Shard:
+        name = f"{self._prefix}-{self._next_shard:06d}.tar"
+        self._next_shard += 1
+        if self._local:
+            return _Shard(name, open(os.path.join(self.save_dir, name), "wb"))
+        return _Shard(name, io.BytesIO())
+
+    def _finish(self, shard: _Shard):
+        index = shard.close()
+        if self._local:
+            shard.fileobj.close()
+        else:
+            shard.fileobj.seek(0)
+            self._save(shard.fileobj, self.save_dir, shard.name)
+        self._save(io.BytesIO(index), self.save_dir, index_name(shard.name))
+        with self._lock:
+            self._stats["shards"] += 1
+            self._stats["images"] += shard.images
+            self._stats["crops"] += len(shard.members)
+            self._stats["bytes"] += shard.closed_size
@@ -0,0 +1,239 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional
+
+import aiohttp
+import requests
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger("default")
+
+# HTTP statuses worth another attempt: timeouts, throttling and server errors
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+# latency samples of an operation needed before hedging it at p95
+MIN_HEDGE_SAMPLES = 20
+
+
+class RetryPolicy(NamedTuple):
+    """Retries transient failures with jittered exponential backoff within a deadline
+    covering all attempts of an operation, optionally hedging slow attempts"""
+
+    max_attempts: int = 1
+    deadline: float = 60.0
+    initial_backoff: float = 0.1
+    max_backoff: float = 5.0
+    multiplier: float = 2.0
+    hedge: bool = False
+
+    @property
+    def enabled(self) -> bool:
+        """Returns True when failed or slow attempts are repeated"""
+        return self.max_attempts > 1 or self.hedge
+
+    def backoff(self, attempt: int) -> float:
+        """Returns full jitter backoff before the attempt following attempt"""
+        cap = min(self.max_backoff, self.initial_backoff * self.multiplier**attempt)
+        return random.uniform(0, cap)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Returns True for errors a later attempt of the same request may not hit"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in TRANSIENT_STATUS
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code in TRANSIENT_STATUS
+    return isinstance(
+        error,
+        (
+            asyncio.TimeoutError,
+            ConnectionError,
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ),
+    )
+
+
+class LatencyTracker:
+    """Keeps recent latencies of every operation to hedge requests slower than p95"""
+
+    def __init__(self, window: int = 200):
+        self._latencies: Dict[str, collections.deque] = collections.defaultdict(
+            lambda: collections.deque(maxlen=window)
+        )
+        self._lock = threading.Lock()
+
+    def record(self, op: str, latency: float):
+        """Adds latency of a successful attempt of op"""
+        with self._lock:
+            self._latencies[op].append(latency)
+
+    def p95(self, op: str) -> Optional[float]:
+        """Returns p95 latency of op, None until enough samples were recorded"""
+        with self._lock:
+            latencies = sorted(self._latencies[op])
+        if len(latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+_stats_lock = threading.Lock()
+_stats = collections.Counter()
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def retry_stats() -> Dict[str, int]:
+    """Returns attempt, retry, hedge and failure counters of the process"""
+    with _stats_lock:
+        return {
+            name: _stats[name]
+            for name in ("attempts", "retries", "hedges", "hedge_wins", "failures")
+        }
+
+
+def reset_retry_stats():
+    """Zeroes the retry counters of the process"""
+    with _stats_lock:
+        _stats.clear()
+
+
+def _check_retry(op: str, error: Exception, attempt: int, policy, deadline) -> float:
+    """Returns backoff before the next attempt or re-raises error"""
+    if not is_transient(error) or attempt + 1 >= policy.max_attempts:
+        _count("failures")
+        raise error
+    backoff = policy.backoff(attempt)
+    if time.monotonic() + backoff >= deadline:
+        _count("failures")
+        raise error
+    _count("retries")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"Retrying {op} in {backoff * 1000:.0f} ms after attempt {attempt + 1} "
+            f"failed: {error!r}"
+        )
+    return backoff
+
+
+def call_with_retry(
+    op: str,
+    fn: Callable[..., Any],
+    policy: RetryPolicy,
+    tracker: LatencyTracker,
+    hedge_pool: Optional[concurrent.futures.Executor] = None,
+):
+    """Calls fn(timeout=...) retrying transient errors, the timeout of every attempt is
+    the time left until the deadline of the operation"""
+    deadline = time.monotonic() + policy.deadline
+    for attempt in range(policy.max_attempts):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _count("failures")
+            raise TimeoutError(f"{op} exceeded deadline of {policy.deadline} s")
+        try:
+            if policy.hedge and hedge_pool is not None:
+                return _hedged_call(op, fn, remaining, tracker, hedge_pool)
+            _count("attempts")
+            start = time.monotonic()
+            result = fn(timeout=remaining)
+            tracker.record(op, time.monotonic() - start)
+            return result
+        except Exception as e:
+            time.sleep(_check_retry(op, e, attempt, policy, deadline))
+
+
+def _hedged_call(op, fn, timeout, tracker, hedge_pool):
+    """Calls fn on the hedge pool and fires a duplicate once it runs past p95 latency,
+    the first successful response wins"""
+    p95 = tracker.p95(op)
+    start = time.monotonic()
+    _count("attempts")
+    first = hedge_pool.submit(fn, timeout=timeout)
+    pending = {first}
+    if p95 is not None and p95 < timeout:
+        done, _ = concurrent.futures.wait(pending, timeout=p95)
+        if not done:
+            _count("attempts")
+            _count("hedges")
+            pending.add(hedge_pool.submit(fn, timeout=timeout - p95))
+    error = None
+    while pending:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            if future.exception() is None:
+                if future is not first:
+                    _count("hedge_wins")
+                tracker.record(op, time.monotonic() - start)
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def call_with_retry_async(
+    op: str,
+    make_aw: Callable[[], Awaitable],
+    policy: RetryPolicy,
+    tracker: LatencyTracker,
+):
+    """Awaits make_aw() retrying transient errors, every attempt is cancelled at the
+    deadline of the operation"""
+    deadline = time.monotonic() + policy.deadline
+    for attempt in range(policy.max_attempts):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _count("failures")
+            raise TimeoutError(f"{op} exceeded deadline of {policy.deadline} s")
+        try:
+            start = time.monotonic()
+            if policy.hedge:
+                result = await asyncio.wait_for(
+                    _hedged_call_async(op, make_aw, tracker), remaining
+                )
+            else:
+                _count("attempts")
+                result = await asyncio.wait_for(make_aw(), remaining)
+            tracker.record(op, time.monotonic() - start)
+            return result
+        except Exception as e:
+            await asyncio.sleep(_check_retry(op, e, attempt, policy, deadline))
+
+
+async def _hedged_call_async(op, make_aw, tracker):
+    p95 = tracker.p95(op)
+    _count("attempts")
+    first = asyncio.ensure_future(make_aw())
+    pending = {first}
+    try:
+        if p95 is not None:
+            done, _ = await asyncio.wait(pending, timeout=p95)
+            if not done:
+                _count("attempts")
+                _count("hedges")
+                pending.add(asyncio.ensure_future(make_aw()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        _count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,140 @@
+import logging
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from PIL import Image
+
+logger = logging.getLogger("default")
+
+# ready flag, original mode, stored mode, width, height - pixels start at HEADER_SIZE
+HEADER = struct.Struct("<?8s8sII")
+HEADER_SIZE = 32
+SEGMENT_PREFIX = "mict-"
+# PIL keeps RGB pixels padded to 4 bytes, RGBX can be mapped without a copy
+STORED_MODES = {"RGB": "RGBX"}
+
+# names of segments created by this process and not unlinked yet, the process owns
+# them until they are evicted from its cache or it exits
+_created_segments: List[str] = []
+
+
+class _Segment(SharedMemory):
+    """Shared memory segment which tolerates being released before the image mapping it,
+    the mapping is freed together with the image"""
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+
+class DecodedImage(NamedTuple):
+    """Decoded pixels, shm is kept alive as long as the image maps its buffer.
+
+    The image is the last field so it is released before the segment it maps.
+    """
+
+    shm: Optional[SharedMemory]
+    mode: str
+    image: Image.Image
+
+
+def segment_name(key: str) -> str:
+    """Returns the shared memory segment name of a cache key"""
+    return f"{SEGMENT_PREFIX}{key}"
+
+
+def _untrack(shm: SharedMemory):
+    # segments are unlinked explicitly, don't let the resource tracker unlink them
+    # (or warn about leaks) when the first worker which touched them exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def _attach(name: str) -> Optional[DecodedImage]:
+    try:
+        shm = _Segment(name=name)
+    except FileNotFoundError:
+        return None
+    _untrack(shm)
+    ready, mode, stored_mode, width, height = HEADER.unpack_from(shm.buf)
+    if not ready:
+        # another process is still writing pixels
+        shm.close()
+        return None
+    mode = mode.rstrip(b"\0").decode()
+    stored_mode = stored_mode.rstrip(b"\0").decode()
+    image = Image.frombuffer(
+        stored_mode,
+        (width, height),
+        shm.buf[HEADER_SIZE:],
+        "raw",
+        stored_mode,
+        0,
+        1,
+    )
+    return DecodedImage(shm, mode, image)
+
+
+def _create(name: str, image: Image.Image) -> Optional[DecodedImage]:
+    stored_mode = STORED_MODES.get(image.mode, image.mode)
+    pixels = image.tobytes("raw", stored_mode)
+    try:
+        shm = _Segment(name=name, create=True, size=HEADER_SIZE + len(pixels))
+    except FileExistsError:
+        return None
+    _untrack(shm)
+    _created_segments.append(name)
+    shm.buf[HEADER_SIZE : HEADER_SIZE + len(pixels)] = pixels
+    HEADER.pack_into(
+        shm.buf,
+        0,
+        True,
+        image.mode.encode(),
+        stored_mode.encode(),
+        image.width,
+        image.height,
+    )
+    shm.close()
+    return _attach(name)
+
+
+def load_shared_image(key: str, decode: Callable[[], Image.Image]) -> DecodedImage:
+    """Maps pixels of an image decoded by any worker process or decodes the image
+    and publishes it in shared memory for other workers"""
+    name = segment_name(key)
+    decoded = _attach(name)
+    if decoded is not None:
+        return decoded
+    image = decode()
+    return _create(name, image) or DecodedImage(None, image.mode, image)
+
+
+def release_shared_image(decoded: DecodedImage):
+    """Unlinks segment created by this process, mappings in other workers stay valid"""
+    if decoded.shm is not None and decoded.shm.name in _created_segments:
+        _created_segments.remove(decoded.shm.name)
+        unlink_segments([decoded.shm.name])
+
+
+def unlink_created_segments() -> List[str]:
+    """Unlinks segments created by this process which are still cached, called when
+    a worker exits, and returns their names"""
+    names = list(_created_segments)
+    _created_segments.clear()
+    unlink_segments(names)
+    return names
+
+
+def unlink_segments(names: Iterable[str]):
+    """Removes segments, ignoring the ones which are already gone"""
+    for name in names:
+        try:
+            shm = SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        # attaching registered the segment again, unlink unregisters it
+        shm.close()
+        shm.unlink()
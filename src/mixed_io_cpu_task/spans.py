@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List
+
+import numpy as np
+
+from mixed_io_cpu_task.logging_utils import log_enabled
+
+logger = logging.getLogger("default")
+
+# stages an image goes through, in order, lossless only runs with --lossless-crops
+STAGES = ("download", "lossless", "decode", "crop", "encode", "upload")
+
+
+class Span:
+    """Timing of one stage of one image, code inside the span sets bytes and items"""
+
+    __slots__ = ("stage", "trace_id", "start", "end", "bytes", "items")
+
+    def __init__(self, stage: str, trace_id: str, bytes: int = 0, items: int = 0):
+        self.stage = stage
+        self.trace_id = trace_id
+        self.start = 0.0
+        self.end = 0.0
+        self.bytes = bytes
+        self.items = items
+
+    @property
+    def duration(self) -> float:
+        """Returns seconds from the start to the end of the span"""
+        return self.end - self.start
+
+    def record(self) -> dict:
+        """Returns the fields of the log record of the span"""
+        return {
+            "trace_id": self.trace_id,
+            "span": self.stage,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "bytes": self.bytes,
+            "items": self.items,
+        }
+
+
+# durations of spans finished by the process and not popped yet, by stage
+_samples_lock = threading.Lock()
+_samples: Dict[str, List[float]] = {}
+
+
+def _reset_samples():
+    # a forked worker process must not report the spans of its parent again
+    global _samples_lock, _samples
+    _samples_lock = threading.Lock()
+    _samples = {}
+
+
+os.register_at_fork(after_in_child=_reset_samples)
+
+
+@contextmanager
+def span(stage: str, trace_id: str, bytes: int = 0, items: int = 0) -> Iterator[Span]:
+    """Times the block as stage of the image of trace_id.
+
+    A finished span logs one debug record with the stage, start and end
+    time.monotonic() timestamps (comparable between processes of a host), duration
+    in seconds and byte and item counts, and its duration is kept for
+    pop_span_samples. Spans left by an exception are not recorded. The record is only
+    built when debug records of trace_id are logged.
+    """
+    current = Span(stage, trace_id, bytes, items)
+    current.start = time.monotonic()
+    yield current
+    current.end = time.monotonic()
+    with _samples_lock:
+        _samples.setdefault(stage, []).append(current.duration)
+    if log_enabled(logger, logging.DEBUG, trace_id):
+        logger.debug(f"{stage} span", extra=current.record())
+
+
+def pop_span_samples() -> Dict[str, List[float]]:
+    """Returns and forgets span durations recorded by the process so far, worker
+    processes send them back with every task and the main process merges them"""
+    global _samples
+    with _samples_lock:
+        samples, _samples = _samples, {}
+    return samples
+
+
+def merge_span_samples(
+    samples: Iterable[Dict[str, List[float]]], into: Dict[str, List[float]] = None
+) -> Dict[str, List[float]]:
+    """Extends into, a new dict by default, with span durations of many tasks"""
+    merged = {} if into is None else into
+    for task_samples in samples:
+        for stage, durations in task_samples.items():
+            merged.setdefault(stage, []).extend(durations)
+    return merged
+
+
+def span_summary(samples: Dict[str, List[float]]) -> Dict[str, dict]:
+    """Returns count, total and p50, p95 and p99 duration in milliseconds of every
+    stage"""
+    summary = {}
+    stages = sorted(samples, key=lambda s: STAGES.index(s) if s in STAGES else 99)
+    for stage in stages:
+        durations = np.asarray(samples[stage]) * 1000
+        if len(durations) == 0:
+            continue
+        p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+        summary[stage] = {
+            "count": len(durations),
+            "total_s": round(float(durations.sum()) / 1000, 2),
+            "p50_ms": round(float(p50), 2),
+            "p95_ms": round(float(p95), 2),
+            "p99_ms": round(float(p99), 2),
+        }
+    return summary
+
+
+def describe_span_summary(summary: Dict[str, dict]) -> str:
+    """Formats latency percentiles of every stage of a span summary"""
+    if not summary:
+        return "no spans recorded"
+    return ", ".join(
+        f"{stage} p50 {stats['p50_ms']:.1f} / p95 {stats['p95_ms']:.1f} / "
+        f"p99 {stats['p99_ms']:.1f} ms ({stats['count']} spans)"
+        for stage, stats in summary.items()
+    )
@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger("default")
+
+# sentinel closing a queue, every worker puts it back for its siblings
+DONE = object()
+
+
+class Stage:
+    """Pipeline stage running func on every item of inbox with a pool of threads and
+    putting results on outbox.
+
+    Bounded queues between stages apply backpressure - a worker blocks on a full outbox
+    until the next stage catches up. The last worker to finish closes the outbox.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        num_workers: int,
+        inbox: queue.Queue,
+        outbox: Optional[queue.Queue] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.items = 0
+        self.busy = 0.0
+        self.errors: List[BaseException] = []
+        self._lock = threading.Lock()
+        self._running = num_workers
+        self._threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+
+    def start(self):
+        """Starts the worker threads of the stage"""
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        """Waits until every worker thread has finished"""
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self, elapsed: float) -> Dict[str, float]:
+        """Returns processed items, busy time and share of worker time spent working"""
+        with self._lock:
+            return {
+                "workers": self.num_workers,
+                "items": self.items,
+                "errors": len(self.errors),
+                "busy": self.busy,
+                "utilization": self.busy / (self.num_workers * elapsed),
+            }
+
+    def _work(self):
+        while (item := self.inbox.get()) is not DONE:
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                logger.exception(f"Stage {self.name} failed")
+                with self._lock:
+                    self.errors.append(e)
+                continue
+            finally:
+                busy = time.perf_counter() - start
+                with self._lock:
+                    self.busy += busy
+            with self._lock:
+                self.items += 1
+            if self.outbox is not None:
+                self.outbox.put(result)
+        self.inbox.put(DONE)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last and self.outbox is not None:
+            self.outbox.put(DONE)
+
+
+class QueueMonitor:
+    """Samples depth of queues at a fixed interval in a background thread"""
+
+    def __init__(self, queues: Dict[str, queue.Queue], interval: float = 0.5):
+        self.queues = queues
+        self.interval = interval
+        self.samples: Dict[str, List[int]] = {name: [] for name in queues}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        """Starts sampling queue depths"""
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and joins the sampling thread"""
+        self._stop.set()
+        self._thread.join()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns mean and max sampled depth and capacity of every queue"""
+        return {
+            name: {
+                "mean_depth": sum(samples) / len(samples) if samples else 0.0,
+                "max_depth": max(samples, default=0),
+                "capacity": self.queues[name].maxsize,
+            }
+            for name, samples in self.samples.items()
+        }
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            depths = {name: q.qsize() for name, q in self.queues.items()}
+            for name, depth in depths.items():
+                self.samples[name].append(depth)
+            logger.debug(f"Queue depths {depths}")
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from mixed_io_cpu_task.async_utils import AdaptiveLimit
+
+
+@pytest.mark.parametrize("sigma", [0.3, 0.5])
+def test_adaptive_limit_does_not_shrink_under_load_independent_jitter(sigma):
+    rng = random.Random(0)
+    limit = AdaptiveLimit("test", initial=10)
+    limits = []
+    for _ in range(20_000):
+        limit.record(0.05 * rng.lognormvariate(0, sigma))
+        limits.append(limit.limit)
+    assert min(limits) >= 10
+    assert limit.limit > 10
+
+
+def test_adaptive_limit_backs_off_above_capacity():
+    rng = random.Random(0)
+    capacity = 20
+    limit = AdaptiveLimit("test", initial=10)
+    limits = []
+    for _ in range(20_000):
+        # above capacity requests queue, latency grows with the limit
+        load = max(1.0, limit.limit / capacity)
+        limit.record(0.05 * load * rng.lognormvariate(0, 0.3))
+        limits.append(limit.limit)
+    settled = limits[5_000:]
+    assert capacity <= sum(settled) / len(settled) <= 2 * capacity
+    assert max(settled) < 2 * capacity
+
+
+def test_adaptive_limit_follows_a_lasting_rise_of_base_latency():
+    rng = random.Random(0)
+    limit = AdaptiveLimit("test", initial=10)
+    for i in range(20_000):
+        base = 0.05 if i < 10_000 else 0.1
+        limit.record(base * rng.lognormvariate(0, 0.3))
+    assert limit.limit > 10
+
+
+def test_adaptive_limit_halves_on_errors():
+    limit = AdaptiveLimit("test", initial=16)
+    for _ in range(16):
+        limit.record(0.05)
+    limit.record(0.05, error=True)
+    assert limit.limit == 8